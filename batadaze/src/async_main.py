@@ -0,0 +1,140 @@
+"""
+Асинхронный фасад базы данных для asyncio-кода
+
+`AsyncDB` повторяет набор методов `DB` и выполняет те же запросы через пул соединений asyncpg, не блокируя цикл
+событий. Тела методов не дублируются: каждый вызов исполняет метод `DB` через `AsyncSession.run_sync`, в котором
+SQLAlchemy переключает ожидание ответа базы данных на цикл событий.
+"""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Optional
+from weakref import WeakKeyDictionary
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from batadaze.src.main import DB, _unit, db_user, db_pass, db_host, db_port, db_name
+from common.src.logs import get_logger
+
+logger = get_logger("Async DB Connector")
+
+pool_size = int(os.getenv('POSTGRES_ASYNC_POOL_SIZE', 10))
+
+_engines = WeakKeyDictionary()
+
+_async_unit: ContextVar[Optional[AsyncSession]] = ContextVar('async_unit_of_work', default=None)
+
+
+def get_async_local() -> async_sessionmaker:
+    """
+    Возвращает фабрику сессий для текущего цикла событий. Соединения asyncpg привязаны к циклу, в котором
+    созданы, поэтому у каждого цикла свой пул
+
+    :return: Фабрика асинхронных сессий
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _engines:
+        logger.info("New async engine is being generated for loop %s", id(loop))
+        _engine = create_async_engine(
+            url=f"postgresql+asyncpg://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}",
+            echo=False,
+            pool_pre_ping=True,
+            pool_size=pool_size,
+        )
+        _engines[loop] = async_sessionmaker(_engine, expire_on_commit=False)
+    return _engines[loop]
+
+
+def _call(session, method: Callable, *args, **kwargs):
+    """
+    Выполняет синхронный метод `DB` внутри сессии `session`
+
+    :param session: Синхронная сессия, предоставленная `AsyncSession.run_sync`
+    :param method: Метод `DB`
+    :return: Результат метода
+    """
+    token = _unit.set(session)
+    try:
+        return method(*args, **kwargs)
+    finally:
+        _unit.reset(token)
+
+
+def _async(method: Callable) -> staticmethod:
+    """
+    Создаёт асинхронный аналог метода `DB`
+
+    :param method: Метод `DB`
+    :return: Асинхронный статический метод
+    """
+
+    async def wrapper(*args, **kwargs):
+        session = _async_unit.get()
+        if session is not None:
+            return await session.run_sync(_call, method, *args, **kwargs)
+        async with get_async_local()() as session:
+            result = await session.run_sync(_call, method, *args, **kwargs)
+            await session.commit()
+        return result
+
+    wrapper.__name__ = method.__name__
+    wrapper.__qualname__ = f'AsyncDB.{method.__name__}'
+    wrapper.__doc__ = method.__doc__
+    return staticmethod(wrapper)
+
+
+class AsyncDB:
+    """
+    Асинхронный фасад базы данных с тем же набором методов, что и `DB`. Каждый метод выполняется в отдельной
+    транзакции, если не вызван внутри `AsyncDB.unit_of_work`
+    """
+
+    @staticmethod
+    @asynccontextmanager
+    async def unit_of_work() -> AsyncIterator[AsyncSession]:
+        """Объединяет вызовы методов `AsyncDB` внутри блока `async with` в одну транзакцию с одной фиксацией
+        в конце. Вложенный вызов присоединяется к внешней единице работы.
+
+        :return: Сессия единицы работы
+        """
+        session = _async_unit.get()
+        if session is not None:
+            yield session
+            return
+        async with get_async_local()() as session:
+            token = _async_unit.set(session)
+            try:
+                yield session
+                await session.commit()
+            finally:
+                _async_unit.reset(token)
+
+    select_users = _async(DB.select_users)
+    select_videos = _async(DB.select_videos)
+    select_playlists = _async(DB.select_playlists)
+    claim_due_playlists = _async(DB.claim_due_playlists)
+    claim_prefetch_videos = _async(DB.claim_prefetch_videos)
+    add_user = _async(DB.add_user)
+    add_video = _async(DB.add_video)
+    add_videos = _async(DB.add_videos)
+    upsert_video_file_id = _async(DB.upsert_video_file_id)
+    record_video_request = _async(DB.record_video_request)
+    add_playlist = _async(DB.add_playlist)
+    add_playlist_user = _async(DB.add_playlist_user)
+    add_playlist_video = _async(DB.add_playlist_video)
+    add_playlist_videos = _async(DB.add_playlist_videos)
+    get_subscribed_users = _async(DB.get_subscribed_users)
+    get_all_videos = _async(DB.get_all_videos)
+    get_playlist_videos = _async(DB.get_playlist_videos)
+    delete_user = _async(DB.delete_user)
+    delete_video = _async(DB.delete_video)
+    delete_playlist = _async(DB.delete_playlist)
+    delete_playlist_video = _async(DB.delete_playlist_video)
+    delete_playlist_user = _async(DB.delete_playlist_user)
+    update_video = _async(DB.update_video)
+    update_playlist_status = _async(DB.update_playlist_status)
+    get_user = _async(DB.get_user)
+    get_video = _async(DB.get_video)
+    get_videos = _async(DB.get_videos)
+    get_playlist = _async(DB.get_playlist)
@@ -0,0 +1,135 @@
+"""
+Проверка планов частых запросов `DB` через EXPLAIN
+
+Скрипт заполняет таблицы синтетическими данными внутри транзакции, собирает статистику, получает планы частых
+запросов и откатывает транзакцию. Запрос считается проблемным, если в его плане есть последовательное чтение
+(Seq Scan) одной из больших таблиц.
+
+Запуск из корня проекта::
+
+    python -m batadaze.src.explain --videos 2000000
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List
+
+from sqlalchemy import select, delete, update, func, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Executable
+
+from batadaze.src.models import Video, Playlist, Playlist_User, Playlist_Video
+
+LARGE_TABLES = ('video', 'playlist', 'playlist_user', 'playlist_video')
+
+HOT_QUERIES: Dict[str, Executable] = {
+    'get_video': select(Video).where(Video.id == '000000042'),
+    'get_all_videos': select(Playlist_Video.id_video).where(Playlist_Video.id_playlist == 'PL00042'),
+    'get_playlist_videos': select(Playlist_Video.id_video).where(Playlist_Video.id_playlist == 'PL00042').where(
+        Playlist_Video.id_video.in_(['000000042', '000000043'])),
+    'get_subscribed_users': select(Playlist_User.id_chat).where(Playlist_User.id_playlist == 'PL00042'),
+    'claim_due_playlists': update(Playlist).where(Playlist.id.in_(select(Playlist.id).where(
+        ~Playlist.is_updating).where(Playlist.next_update_at <= func.now()).order_by(Playlist.next_update_at).limit(
+        100).with_for_update(skip_locked=True).scalar_subquery())).values(is_updating=True).returning(Playlist),
+    'claim_prefetch_videos': select(Video.id).join(Playlist_Video, Playlist_Video.id_video == Video.id).join(
+        Playlist, Playlist.id == Playlist_Video.id_playlist).where(
+        Playlist.last_requested_at >= func.now() - text("interval '7 days'")).where(Video.file_id.is_(None)).limit(10),
+    'record_video_request playlists': select(Playlist_Video.id_playlist).where(
+        Playlist_Video.id_video == '000000042'),
+    # запросы, которые выполняют каскадные удаления при удалении плейлиста и пользователя
+    'delete_playlist cascade': delete(Playlist_Video).where(Playlist_Video.id_playlist == 'PL00042'),
+    'delete_user cascade': delete(Playlist_User).where(Playlist_User.id_chat == 42),
+}
+
+
+def seed(conn: Connection, videos: int, playlists: int, users: int) -> None:
+    """
+    Заполняет таблицы синтетическими данными и обновляет статистику планировщика
+
+    :param conn: Соединение с открытой транзакцией
+    :param videos: Количество видео, каждое видео входит в один плейлист
+    :param playlists: Количество плейлистов
+    :param users: Количество пользователей, каждый подписан на один плейлист
+    """
+    params = {'videos': videos, 'playlists': playlists, 'users': users}
+    conn.execute(text("INSERT INTO video (id, file_id) SELECT lpad(i::text, 9, '0'), md5(i::text) "
+                      "FROM generate_series(1, :videos) i"), params)
+    conn.execute(text("INSERT INTO playlist (id, host, is_updating, next_update_at) "
+                      "SELECT 'PL' || lpad(i::text, 5, '0'), 'youtube', i % 10 = 0, "
+                      "now() + (i % 600) * interval '1 second' FROM generate_series(1, :playlists) i"), params)
+    conn.execute(text("INSERT INTO user_ (id) SELECT i FROM generate_series(1, :users) i"), params)
+    conn.execute(text("INSERT INTO playlist_video (id_video, id_playlist) "
+                      "SELECT lpad(i::text, 9, '0'), 'PL' || lpad((i % :playlists + 1)::text, 5, '0') "
+                      "FROM generate_series(1, :videos) i"), params)
+    conn.execute(text("INSERT INTO playlist_user (id_playlist, id_chat) "
+                      "SELECT 'PL' || lpad((i % :playlists + 1)::text, 5, '0'), i "
+                      "FROM generate_series(1, :users) i"), params)
+    for table in ('video', 'playlist', 'user_', 'playlist_video', 'playlist_user'):
+        conn.execute(text(f'ANALYZE {table}'))
+
+
+def seq_scans(plan: dict, tables=LARGE_TABLES) -> List[str]:
+    """
+    Находит последовательные чтения больших таблиц в плане запроса
+
+    :param plan: Узел плана в формате `EXPLAIN (FORMAT JSON)`
+    :param tables: Имена больших таблиц
+    :return: Список таблиц, которые читаются последовательно
+    """
+    found = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in tables:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found += seq_scans(child, tables)
+    return found
+
+
+def explain(conn: Connection, query: Executable) -> dict:
+    """
+    Возвращает план запроса
+
+    :param conn: Соединение с базой данных
+    :param query: Запрос
+    :return: Корневой узел плана
+    """
+    compiled = query.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True})
+    result = conn.execute(text(f'EXPLAIN (FORMAT JSON) {compiled}')).scalar()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]['Plan']
+
+
+def check(conn: Connection) -> Dict[str, List[str]]:
+    """
+    Проверяет планы всех частых запросов
+
+    :param conn: Соединение с базой данных
+    :return: Словарь: имя запроса -> таблицы, читаемые последовательно
+    """
+    return {name: seq_scans(explain(conn, query)) for name, query in HOT_QUERIES.items()}
+
+
+def main() -> int:
+    from batadaze.src.main import get_local
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--videos', type=int, default=2_000_000)
+    parser.add_argument('--playlists', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--no-seed', action='store_true', help='проверить планы на текущих данных')
+    args = parser.parse_args()
+
+    failed = False
+    with get_local()[0].connect() as conn:
+        with conn.begin() as transaction:
+            if not args.no_seed:
+                seed(conn, args.videos, args.playlists, args.users)
+            for name, tables in check(conn).items():
+                failed = failed or bool(tables)
+                print(f"{'FAIL' if tables else 'ok':4}  {name}" + (f"  seq scan: {', '.join(tables)}" if tables else ''))
+            transaction.rollback()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Выбор ведущего экземпляра через advisory-блокировку Postgres
+
+Блокировка уровня сессии удерживается, пока открыто соединение, в котором она взята. Если ведущий процесс падает,
+Postgres закрывает его сессию и освобождает блокировку, и её сразу забирает следующий экземпляр. Для случая, когда
+пропадает сетевое соединение, сессии задаются короткие TCP keepalive, чтобы сервер быстро обнаружил обрыв.
+"""
+from typing import Callable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+
+from common.src.logs import get_logger
+
+logger = get_logger("DB Leader")
+
+SCHEDULER_LOCK = 0x766F6273  # произвольный ключ advisory-блокировки планировщика плейлистов
+
+
+class LeaderLease:
+    """
+    Аренда роли ведущего экземпляра
+
+    :ivar `int` key: Ключ advisory-блокировки
+    :ivar `int` keepalive: Время в секундах, за которое сервер обнаруживает обрыв соединения ведущего
+    """
+
+    def __init__(self, key: int, engine: Callable[[], Engine] = None, keepalive: int = 10):
+        if engine is None:
+            from batadaze.src.main import get_local
+
+            engine = lambda: get_local()[0]
+        self.key = key
+        self.keepalive = keepalive
+        self._engine = engine
+        self._conn: Optional[Connection] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._conn is not None
+
+    def hold(self) -> bool:
+        """
+        Проверяет, что роль ведущего всё ещё удерживается, или пытается её получить. Вызывается периодически и
+        перед каждым действием, которое должен выполнять только ведущий
+
+        :return: True, если этот экземпляр ведущий
+        """
+        if self._conn is not None:
+            try:
+                self._conn.execute(text('SELECT 1'))
+                return True
+            except DBAPIError as e:
+                logger.warning("Leadership lost: %s, %s", e.__class__.__name__, e)
+                self._close()
+        return self._acquire()
+
+    def _acquire(self) -> bool:
+        conn = None
+        try:
+            conn = self._engine().connect().execution_options(isolation_level='AUTOCOMMIT')
+            if not conn.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': self.key}).scalar():
+                conn.close()
+                return False
+            interval = max(1, self.keepalive // 5)
+            conn.execute(text(f'SET tcp_keepalives_idle = {interval}'))
+            conn.execute(text(f'SET tcp_keepalives_interval = {interval}'))
+            conn.execute(text(f'SET tcp_keepalives_count = {max(1, self.keepalive // interval - 1)}'))
+        except DBAPIError as e:
+            logger.warning("Leadership acquire failed: %s, %s", e.__class__.__name__, e)
+            if conn is not None:
+                conn.invalidate()
+            return False
+        logger.info("Leadership acquired, lock %s", self.key)
+        self._conn = conn
+        return True
+
+    def _close(self) -> None:
+        try:
+            self._conn.invalidate()
+        finally:
+            self._conn = None
+
+    def release(self) -> None:
+        """
+        Отказывается от роли ведущего
+        """
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.key})
+            self._conn.close()
+        except DBAPIError:
+            self._conn.invalidate()
+        self._conn = None
+        logger.info("Leadership released, lock %s", self.key)
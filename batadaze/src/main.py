@@ -1,23 +1,21 @@
-import logging
+import datetime
 import os
+from contextlib import contextmanager
+from contextvars import ContextVar
 from threading import current_thread
+from typing import Iterator, Optional
 
 from dotenv import load_dotenv
-from sqlalchemy import select, delete, create_engine
+from sqlalchemy import select, delete, update, create_engine, func, extract, or_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 
-from batadaze.src.models import User_, Video, Playlist, Playlist_User, Playlist_Video, Base
+from batadaze.src.migrations import migrate
+from batadaze.src.models import User_, Video, Playlist, Playlist_User, Playlist_Video
+from common.src.logs import get_logger
 
-logger = logging.getLogger("DB Connector")
-
-logger.setLevel(logging.INFO)
-
-handler = logging.StreamHandler()
-
-handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
-
-logger.addHandler(handler)
+logger = get_logger("DB Connector")
 
 load_dotenv()
 
@@ -27,9 +25,13 @@ db_user = os.getenv('POSTGRES_USER')
 db_pass = os.getenv('POSTGRES_PASSWORD')
 db_name = os.getenv('POSTGRES_DB')
 create_tables = os.getenv('CREATE_TABLES', 'False')
+playlist_update_interval = datetime.timedelta(seconds=int(os.getenv('PLAYLIST_UPDATE_INTERVAL', 300)))
+request_rate_half_life = float(os.getenv('REQUEST_RATE_HALF_LIFE', 86400))
 
 _engines = dict()
 
+_unit: ContextVar[Optional[Session]] = ContextVar('unit_of_work', default=None)
+
 
 def get_local():
     thread = current_thread()
@@ -41,31 +43,76 @@ def get_local():
             echo=False,
             pool_pre_ping=True,
         )
-        _sessionmaker = sessionmaker(_engine)
+        _sessionmaker = sessionmaker(_engine, expire_on_commit=False)
         _engines[key] = [_engine, _sessionmaker]
     return _engines[key]
 
 
+def _decayed(rate, since):
+    """Выражение для частоты запросов `rate`, которая уменьшается вдвое за каждые `REQUEST_RATE_HALF_LIFE` секунд
+    после последнего запроса `since`.
+
+    :param rate: колонка с частотой запросов на момент `since`
+    :param since: колонка со временем последнего запроса
+    """
+    age = extract('epoch', func.now() - func.coalesce(since, func.now()))
+    return rate * func.power(0.5, age / request_rate_half_life)
+
+
+@contextmanager
+def _session(commit: bool = False) -> Iterator[Session]:
+    """Возвращает сессию текущей единицы работы (`DB.unit_of_work`), а вне её - новую сессию.
+
+    :param commit: зафиксировать изменения при выходе, если сессия не принадлежит единице работы
+    """
+    session = _unit.get()
+    if session is not None:
+        yield session
+        return
+    with get_local()[1]() as session:
+        yield session
+        if commit:
+            session.commit()
+
+
 class DB:
     """
+    Фасад базы данных. Каждый метод выполняется в отдельной транзакции, если не вызван внутри `DB.unit_of_work`
     """
 
+    @staticmethod
+    @contextmanager
+    def unit_of_work() -> Iterator[Session]:
+        """Объединяет вызовы методов `DB` внутри блока `with` в одну транзакцию с одной фиксацией в конце.
+        Вложенный вызов присоединяется к внешней единице работы.
+
+        :return: Сессия единицы работы
+        """
+        session = _unit.get()
+        if session is not None:
+            yield session
+            return
+        with get_local()[1]() as session:
+            token = _unit.set(session)
+            try:
+                yield session
+                session.commit()
+            finally:
+                _unit.reset(token)
+
     @staticmethod
     def create_tables() -> None:
-        """Создает все таблицы для данного движка"""
+        """Создает все таблицы и индексы для данного движка, применяя недостающие миграции"""
         logger.info("Creating tables")
 
-        engine = get_local()[0]
-        with engine.begin() as conn:
-            # Base.metadata.drop_all(conn) # for tests
-            Base.metadata.create_all(conn)
+        migrate(get_local()[0])
 
     @staticmethod
     def select_users() -> list:
         """Возвращает список всех пользователей бота в виде объектов класса `User_`"""
-        logger.info("Getting list of users")
+        logger.debug("Getting list of users")
 
-        with get_local()[1]() as session:
+        with _session() as session:
             query = select(User_)
             result = session.execute(query)
             users = result.scalars().all()
@@ -74,9 +121,9 @@ class DB:
     @staticmethod
     def select_videos() -> list:
         """Возвращает список всех скачанных видео в виде объектов класса `Video`"""
-        logger.info("Getting list of videos")
+        logger.debug("Getting list of videos")
 
-        with get_local()[1]() as session:
+        with _session() as session:
             query = select(Video)
             result = session.execute(query)
             videos = result.scalars().all()
@@ -85,88 +132,195 @@ class DB:
     @staticmethod
     def select_playlists() -> list:
         """Возвращает список всех плейлистов в виде объектов класса `Playlist`"""
-        logger.info("Getting list of playlists")
+        logger.debug("Getting list of playlists")
 
-        with get_local()[1]() as session:
+        with _session() as session:
             query = select(Playlist)
             result = session.execute(query)
             playlists = result.scalars().all()
         return playlists
 
+    @staticmethod
+    def claim_due_playlists(limit: int = 100) -> list:
+        """Отмечает плейлисты, которые пора обновить, как обновляемые и возвращает их. Строки, которые в этот момент
+        забирает другой экземпляр, пропускаются, поэтому каждый плейлист достаётся только одному вызову.
+
+        :param limit: максимальное количество плейлистов
+
+        :return: Список объектов класса `Playlist`
+        """
+        logger.debug("Claiming due playlists")
+
+        with _session(commit=True) as session:
+            due = select(Playlist.id).where(~Playlist.is_updating).where(
+                Playlist.next_update_at <= func.now()).order_by(Playlist.next_update_at).limit(limit).with_for_update(
+                skip_locked=True)
+            query = update(Playlist).where(Playlist.id.in_(due.scalar_subquery())).values(
+                is_updating=True).returning(Playlist).execution_options(synchronize_session=False)
+            playlists = session.execute(query).scalars().all()
+        return playlists
+
+    @staticmethod
+    def claim_prefetch_videos(limit: int, window: datetime.timedelta, retry: datetime.timedelta,
+                              min_score: float = 0) -> list:
+        """Выбирает ещё не загруженные видео плейлистов, к которым недавно обращались, и отмечает их как
+        поставленные в предварительную загрузку. Плейлисты упорядочиваются по сумме затухающей частоты запросов их
+        видео и числа подписчиков, видео плейлиста - от недавно добавленных. Строки, которые в этот момент
+        забирает другой экземпляр, пропускаются.
+
+        :param limit: максимальное количество видео
+        :param window: плейлисты без запросов дольше этого срока не рассматриваются
+        :param retry: видео, уже поставленное в загрузку, выбирается повторно не раньше, чем через этот срок
+        :param min_score: минимальная оценка плейлиста
+
+        :return: Список пар (id видео, хостинг)
+        """
+        logger.debug("Claiming videos to prefetch")
+
+        with _session(commit=True) as session:
+            subscribers = select(func.count()).where(Playlist_User.id_playlist == Playlist.id).scalar_subquery()
+            score = (_decayed(Playlist.request_rate, Playlist.last_requested_at) + subscribers).label('score')
+            active = select(Playlist.id, Playlist.host, score).where(
+                Playlist.last_requested_at >= func.now() - window).subquery()
+            query = select(Video.id, active.c.host).join(Playlist_Video, Playlist_Video.id_video == Video.id).join(
+                active, active.c.id == Playlist_Video.id_playlist).where(active.c.score >= min_score).where(
+                Video.file_id.is_(None)).where(
+                or_(Video.prefetched_at.is_(None), Video.prefetched_at <= func.now() - retry)).order_by(
+                active.c.score.desc(), Playlist_Video.added_at.desc().nulls_last()).limit(limit).with_for_update(
+                of=Video, skip_locked=True)
+            videos = dict(session.execute(query).all())
+            if videos:
+                session.execute(update(Video).where(Video.id.in_(list(videos))).values(prefetched_at=func.now()))
+        return list(videos.items())
+
     @staticmethod
     def add_user(chat: int) -> None:
-        """Добавляет нового пользователя в базу данных.
+        """Добавляет нового пользователя в базу данных, если его ещё нет.
 
         :param chat: id пользователя
         """
-        logger.info(f"Adding new user: {chat}")
+        logger.debug("Adding new user: %s", chat)
 
-        with get_local()[1]() as session:
-            new_user = User_(id=chat)
-            session.add(new_user)
-            session.flush()
-            session.commit()
+        with _session(commit=True) as session:
+            session.execute(insert(User_).values(id=chat).on_conflict_do_nothing())
 
     @staticmethod
     def add_video(video: str, file: str = None) -> None:
-        """Добавляет новое видео в базу данных.
+        """Добавляет новое видео в базу данных, если его ещё нет.
 
         :param video: id of video (primary key)
         :param file: путь файла, если есть (иначе None)
         """
-        logger.info(f"Adding new video: {video}, {file}")
+        logger.debug("Adding new video: %s, %s", video, file)
 
-        with get_local()[1]() as session:
-            new_video = Video(id=video, file_id=file)
-            session.add(new_video)
-            session.flush()
-            session.commit()
+        with _session(commit=True) as session:
+            session.execute(insert(Video).values(id=video, file_id=file).on_conflict_do_nothing())
+
+    @staticmethod
+    def add_videos(videos: list) -> None:
+        """Добавляет в базу данных видео без файла, уже существующие видео пропускаются.
+
+        :param videos: список id видео
+        """
+        logger.debug("Adding %s videos", len(videos))
+
+        if not videos:
+            return
+        with _session(commit=True) as session:
+            session.execute(insert(Video).on_conflict_do_nothing(), [{'id': video} for video in videos])
+
+    @staticmethod
+    def upsert_video_file_id(video: str, file: str = None) -> None:
+        """Добавляет видео или изменяет путь уже существующего.
+
+        :param video: id видео
+        :param file: путь файла, если есть (иначе None)
+        """
+        logger.debug("Upserting video: %s, %s", video, file)
+
+        with _session(commit=True) as session:
+            query = insert(Video).values(id=video, file_id=file)
+            session.execute(query.on_conflict_do_update(index_elements=[Video.id],
+                                                        set_={'file_id': query.excluded.file_id}))
+
+    @staticmethod
+    def record_video_request(video: str) -> None:
+        """Учитывает запрос видео: увеличивает счётчик запросов видео и частоту запросов плейлистов, в которые оно
+        входит. Видео, которого ещё нет, добавляется без файла.
+
+        :param video: id видео
+        """
+        logger.debug("Recording request of video %s", video)
+
+        with _session(commit=True) as session:
+            query = insert(Video).values(id=video, request_count=1, last_requested_at=func.now())
+            session.execute(query.on_conflict_do_update(index_elements=[Video.id], set_={
+                'request_count': Video.request_count + 1, 'last_requested_at': func.now()}))
+            playlists = select(Playlist_Video.id_playlist).where(Playlist_Video.id_video == video)
+            session.execute(update(Playlist).where(Playlist.id.in_(playlists)).values(
+                request_rate=_decayed(Playlist.request_rate, Playlist.last_requested_at) + 1,
+                last_requested_at=func.now()).execution_options(synchronize_session=False))
 
     @staticmethod
-    def add_playlist(name: str, platform: str, status: bool = False) -> None:
-        """Добавляет новый плейлист в базу данных.
+    def add_playlist(name: str, platform: str, status: bool = False) -> bool:
+        """Добавляет новый плейлист в базу данных, если его ещё нет.
 
         :param name: название плейлиста
         :param platform: платформа, с которой идет скачивание
         :param status: состояние плейлиста в данных момент: True - обновляется в данный момент, False - не обновляется
+
+        :return: True, если плейлист был добавлен
         """
-        logger.info(f"Adding new playlist: {name} from {platform}")
+        logger.debug("Adding new playlist: %s from %s", name, platform)
 
-        with get_local()[1]() as session:
-            new_playlist = Playlist(id=name, host=platform, is_updating=status)
-            session.add(new_playlist)
-            session.flush()
-            session.commit()
+        with _session(commit=True) as session:
+            query = insert(Playlist).values(id=name, host=platform, is_updating=status).on_conflict_do_nothing()
+            created = session.execute(query.returning(Playlist.id)).scalar() is not None
+        return created
 
     @staticmethod
     def add_playlist_user(chat: int, playlist: str) -> None:
-        """Добавляет нового пользователя плейлиста.
+        """Добавляет нового пользователя плейлиста, если он ещё не подписан.
 
         :param chat: id пользователя
         :param playlist: название плейлиста
         """
-        logger.info(f"Adding new playlist user: user {chat} to playlist {playlist}")
+        logger.debug("Adding new playlist user: user %s to playlist %s", chat, playlist)
 
-        with get_local()[1]() as session:
-            new_playlist_user = Playlist_User(id_playlist=playlist, id_chat=chat)
-            session.add(new_playlist_user)
-            session.flush()
-            session.commit()
+        with _session(commit=True) as session:
+            session.execute(insert(Playlist_User).values(id_playlist=playlist, id_chat=chat).on_conflict_do_nothing())
 
     @staticmethod
     def add_playlist_video(video_id: str, playlist_id: str) -> None:
-        """Добавляет новое видео в плейлист.
+        """Добавляет новое видео в плейлист, если его там ещё нет.
 
         :param video_id: id видео
         :param playlist_id: название плейлиста)
         """
-        logger.info(f"Adding new playlist video: {video_id} to playlist {playlist_id}")
+        logger.debug("Adding new playlist video: %s to playlist %s", video_id, playlist_id)
 
-        with get_local()[1]() as session:
-            new_playlist_video = Playlist_Video(id_playlist=playlist_id, id_video=video_id)
-            session.add(new_playlist_video)
-            session.flush()
-            session.commit()
+        with _session(commit=True) as session:
+            session.execute(insert(Playlist_Video).values(id_playlist=playlist_id, id_video=video_id)
+                            .on_conflict_do_nothing())
+
+    @staticmethod
+    def add_playlist_videos(playlist_id: str, videos: list) -> list:
+        """Добавляет видео в плейлист, видео уже из плейлиста пропускаются. Видео должны существовать в базе данных.
+
+        :param playlist_id: название плейлиста
+        :param videos: список id видео
+
+        :return: Список id видео, которых раньше не было в плейлисте
+        """
+        logger.debug("Adding %s videos to playlist %s", len(videos), playlist_id)
+
+        if not videos:
+            return []
+        with _session(commit=True) as session:
+            query = insert(Playlist_Video).values([{'id_playlist': playlist_id, 'id_video': video} for video in videos])
+            result = session.execute(query.on_conflict_do_nothing().returning(Playlist_Video.id_video))
+            added = result.scalars().all()
+        return added
 
     @staticmethod
     def get_subscribed_users(playlist: str) -> list:
@@ -176,9 +330,9 @@ class DB:
 
         :return: Список всех id пользователей использующих данный плейлист
         """
-        logger.info(f"Getting all playlist {playlist} users")
+        logger.debug("Getting all playlist %s users", playlist)
 
-        with get_local()[1]() as session:
+        with _session() as session:
             query = (select(Playlist_User.id_chat).select_from(Playlist_User)).where(
                 Playlist_User.id_playlist == playlist)
             result = session.execute(query)
@@ -193,28 +347,44 @@ class DB:
 
         :return: Список всех id video данного плейлиста
         """
-        logger.info(f"Getting all playlist {playlist} videos")
+        logger.debug("Getting all playlist %s videos", playlist)
 
-        with get_local()[1]() as session:
+        with _session() as session:
             query = (select(Playlist_Video.id_video).select_from(Playlist_Video)).where(
                 Playlist_Video.id_playlist == playlist)
             result = session.execute(query)
             videos = result.scalars().all()
         return videos
 
+    @staticmethod
+    def get_playlist_videos(playlist: str, videos: list) -> list:
+        """Получает те из переданных видео, которые уже есть в плейлисте.
+
+        :param playlist: название плейлиста
+        :param videos: список id видео для проверки
+
+        :return: Список id видео из `videos`, уже добавленных в плейлист
+        """
+        logger.debug("Getting %s videos of playlist %s", len(videos), playlist)
+
+        with _session() as session:
+            query = (select(Playlist_Video.id_video).select_from(Playlist_Video)).where(
+                Playlist_Video.id_playlist == playlist).where(Playlist_Video.id_video.in_(videos))
+            result = session.execute(query)
+            videos = result.scalars().all()
+        return videos
+
     @staticmethod
     def delete_user(chat: int) -> None:
         """Удаляет пользователя из базы данных.
 
         :param chat: id пользователя
         """
-        logger.info(f"Deleting user {chat}")
+        logger.debug("Deleting user %s", chat)
 
-        with get_local()[1]() as session:
+        with _session(commit=True) as session:
             query = (delete(User_).where(User_.id == chat))
             session.execute(query)
-            session.flush()
-            session.commit()
 
     @staticmethod
     def delete_video(video: str) -> None:
@@ -222,13 +392,11 @@ class DB:
 
         :param video: id видео
         """
-        logger.info(f"Deleting video {video}")
+        logger.debug("Deleting video %s", video)
 
-        with get_local()[1]() as session:
+        with _session(commit=True) as session:
             query = (delete(Video).where(Video.id == video))
             session.execute(query)
-            session.flush()
-            session.commit()
 
     @staticmethod
     def delete_playlist(key: str) -> None:
@@ -236,13 +404,11 @@ class DB:
 
         :param key: название плейлиста
         """
-        logger.info(f"Deleting playlist {key}")
+        logger.debug("Deleting playlist %s", key)
 
-        with get_local()[1]() as session:
+        with _session(commit=True) as session:
             query = (delete(Playlist).where(Playlist.id == key))
             session.execute(query)
-            session.flush()
-            session.commit()
 
     @staticmethod
     def delete_playlist_video(playlist: str, video: str) -> None:
@@ -251,14 +417,12 @@ class DB:
         :param playlist: название плейлиста
         :param video: id видео
         """
-        logger.info(f"Deleting video {video} from playlist {playlist}")
+        logger.debug("Deleting video %s from playlist %s", video, playlist)
 
-        with get_local()[1]() as session:
+        with _session(commit=True) as session:
             query = (delete(Playlist_Video).where(Playlist_Video.id_video == video).where(
                 Playlist_Video.id_playlist == playlist))
             session.execute(query)
-            session.flush()
-            session.commit()
 
     @staticmethod
     def delete_playlist_user(playlist: str, chat: int) -> None:
@@ -267,14 +431,12 @@ class DB:
         :param playlist: название плейлиста
         :param chat: id пользователя
         """
-        logger.info(f"Deleting user {chat} from playlist {playlist}")
+        logger.debug("Deleting user %s from playlist %s", chat, playlist)
 
-        with get_local()[1]() as session:
+        with _session(commit=True) as session:
             query = (
                 delete(Playlist_User).where(Playlist_User.id_chat == chat).where(Playlist_User.id_playlist == playlist))
             session.execute(query)
-            session.flush()
-            session.commit()
 
     @staticmethod
     def update_video(id: str, new_file_id: str) -> None:
@@ -283,26 +445,26 @@ class DB:
         :param id: id видео
         :param new_file_id: новый путь
         """
-        logger.info(f"Changing file_id of video {id} to {new_file_id}")
+        logger.debug("Changing file_id of video %s to %s", id, new_file_id)
 
-        with get_local()[1]() as session:
+        with _session(commit=True) as session:
             changable = session.get(Video, id)
             changable.file_id = new_file_id
-            session.commit()
 
     @staticmethod
     def update_playlist_status(id: str, status: bool) -> None:
-        """Изменяет статус плейлиста.
+        """Изменяет статус плейлиста. При завершении обновления назначает время следующего обновления.
 
         :param id: название плейлиста
         :param status: новый статус
         """
-        logger.info(f"Changing status of playlist {id}")
+        logger.debug("Changing status of playlist %s", id)
 
-        with get_local()[1]() as session:
-            changable = session.get(Playlist, id)
-            changable.is_updating = status
-            session.commit()
+        with _session(commit=True) as session:
+            values = {'is_updating': status}
+            if not status:
+                values['next_update_at'] = func.now() + playlist_update_interval
+            session.execute(update(Playlist).where(Playlist.id == id).values(**values))
 
     @staticmethod
     def get_user(id: str) -> User_:
@@ -312,9 +474,9 @@ class DB:
 
         :return: объект класса User_
         """
-        logger.info(f"getting user {id} info")
+        logger.debug("getting user %s info", id)
 
-        with get_local()[1]() as session:
+        with _session() as session:
             target = session.get(User_, id)
         return target
 
@@ -326,12 +488,29 @@ class DB:
 
         :return: объект класса Video
         """
-        logger.info(f"getting video {id} info")
+        logger.debug("getting video %s info", id)
 
-        with get_local()[1]() as session:
+        with _session() as session:
             target = session.get(Video, id)
         return target
 
+    @staticmethod
+    def get_videos(ids: list) -> list:
+        """Получает информацию о нескольких видео по id.
+
+        :param ids: список id видео
+
+        :return: Список найденных объектов класса Video
+        """
+        logger.debug("getting %s videos info", len(ids))
+
+        if not ids:
+            return []
+        with _session() as session:
+            result = session.execute(select(Video).where(Video.id.in_(ids)))
+            videos = result.scalars().all()
+        return videos
+
     @staticmethod
     def get_playlist(id: str) -> Playlist:
         """Получает информацию о плейлисте по id.
@@ -340,9 +519,9 @@ class DB:
 
         :return: объект класса Playlist
         """
-        logger.info(f"getting playlist {id} info")
+        logger.debug("getting playlist %s info", id)
 
-        with get_local()[1]() as session:
+        with _session() as session:
             target = session.get(Playlist, id)
         return target
 
@@ -0,0 +1,170 @@
+"""
+Миграции схемы базы данных
+
+Каждая миграция применяется один раз, номер применённой миграции записывается в таблицу `schema_version`.
+Одновременный запуск из нескольких процессов сериализуется advisory-блокировкой Postgres. Индексы создаются
+через `CREATE INDEX CONCURRENTLY`, поэтому такие миграции выполняются вне транзакции и не блокируют запись в таблицы.
+
+Запуск из корня проекта::
+
+    python -m batadaze.src.migrations
+"""
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from common.src.logs import get_logger
+
+logger = get_logger("DB Migrations")
+
+MIGRATION_LOCK = 0x766F626C  # произвольный ключ advisory-блокировки миграций
+
+
+class Migration(NamedTuple):
+    """
+    Описание миграции
+
+    :ivar `int` version: Номер миграции, миграции применяются по возрастанию номера
+    :ivar `str` description: Краткое описание
+    :ivar `Callable` upgrade: Функция, применяющая миграцию к соединению
+    :ivar `bool` transactional: Если False, миграция выполняется вне транзакции (для `CONCURRENTLY`)
+    """
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    transactional: bool = True
+
+
+def _execute(*statements: str) -> Callable[[Connection], None]:
+    """
+    Создаёт миграцию из последовательности SQL-запросов
+
+    :param statements: SQL-запросы
+    :return: Функция миграции
+    """
+
+    def upgrade(conn: Connection) -> None:
+        for statement in statements:
+            conn.execute(text(statement))
+
+    return upgrade
+
+
+def _create_index(name: str, table: str, columns: str, where: str = None) -> Callable[[Connection], None]:
+    """
+    Создаёт миграцию, строящую индекс без блокировки записи. Недостроенный индекс от прерванного запуска
+    удаляется перед повторной попыткой
+
+    :param name: Имя индекса
+    :param table: Имя таблицы
+    :param columns: Список колонок индекса
+    :param where: Условие частичного индекса
+    :return: Функция миграции
+    """
+    return _execute(
+        f'DROP INDEX CONCURRENTLY IF EXISTS {name}',
+        f'CREATE INDEX CONCURRENTLY {name} ON {table} ({columns})' + (f' WHERE {where}' if where else ''),
+    )
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'baseline schema', _execute(
+        'CREATE TABLE IF NOT EXISTS user_ (id SERIAL NOT NULL, PRIMARY KEY (id))',
+        'CREATE TABLE IF NOT EXISTS video (id VARCHAR(256) NOT NULL, file_id VARCHAR(256), PRIMARY KEY (id))',
+        'CREATE TABLE IF NOT EXISTS playlist (id VARCHAR(256) NOT NULL, host VARCHAR(256) NOT NULL, '
+        'is_updating BOOLEAN NOT NULL, PRIMARY KEY (id))',
+        'CREATE TABLE IF NOT EXISTS playlist_user (id_playlist VARCHAR(256) NOT NULL, id_chat INTEGER NOT NULL, '
+        'PRIMARY KEY (id_playlist, id_chat), '
+        'FOREIGN KEY(id_playlist) REFERENCES playlist (id) ON DELETE CASCADE, '
+        'FOREIGN KEY(id_chat) REFERENCES user_ (id) ON DELETE CASCADE)',
+        'CREATE TABLE IF NOT EXISTS playlist_video (id_video VARCHAR(256) NOT NULL, '
+        'id_playlist VARCHAR(256) NOT NULL, PRIMARY KEY (id_video, id_playlist), '
+        'FOREIGN KEY(id_video) REFERENCES video (id) ON DELETE CASCADE, '
+        'FOREIGN KEY(id_playlist) REFERENCES playlist (id) ON DELETE CASCADE)',
+    )),
+    Migration(2, 'index playlist_video by playlist',
+              _create_index('ix_playlist_video_id_playlist', 'playlist_video', 'id_playlist, id_video'), False),
+    Migration(3, 'index playlist_user by chat',
+              _create_index('ix_playlist_user_id_chat', 'playlist_user', 'id_chat'), False),
+    Migration(4, 'playlist due time', _execute(
+        'ALTER TABLE playlist ADD COLUMN IF NOT EXISTS next_update_at TIMESTAMP WITH TIME ZONE '
+        'NOT NULL DEFAULT now()',
+    )),
+    Migration(5, 'index playlist by due time',
+              _create_index('ix_playlist_next_update_at', 'playlist', 'next_update_at', 'NOT is_updating'), False),
+    Migration(6, 'video and playlist demand', _execute(
+        'ALTER TABLE video ADD COLUMN IF NOT EXISTS request_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE video ADD COLUMN IF NOT EXISTS last_requested_at TIMESTAMP WITH TIME ZONE',
+        'ALTER TABLE video ADD COLUMN IF NOT EXISTS prefetched_at TIMESTAMP WITH TIME ZONE',
+        'ALTER TABLE playlist ADD COLUMN IF NOT EXISTS request_rate DOUBLE PRECISION NOT NULL DEFAULT 0',
+        'ALTER TABLE playlist ADD COLUMN IF NOT EXISTS last_requested_at TIMESTAMP WITH TIME ZONE',
+        # у существующих строк время добавления неизвестно, новым оно назначается по умолчанию
+        'ALTER TABLE playlist_video ADD COLUMN IF NOT EXISTS added_at TIMESTAMP WITH TIME ZONE',
+        'ALTER TABLE playlist_video ALTER COLUMN added_at SET DEFAULT now()',
+    )),
+    Migration(7, 'index playlist by last request',
+              _create_index('ix_playlist_last_requested_at', 'playlist', 'last_requested_at'), False),
+]
+
+
+def applied_versions(conn: Connection) -> set:
+    """
+    Возвращает номера применённых миграций
+
+    :param conn: Соединение с базой данных
+    :return: Множество номеров
+    """
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL PRIMARY KEY, '
+                      'description VARCHAR(256) NOT NULL, '
+                      'applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())'))
+    return set(conn.execute(text('SELECT version FROM schema_version')).scalars().all())
+
+
+def migrate(engine: Engine, migrations: List[Migration] = None) -> List[int]:
+    """
+    Применяет все недостающие миграции
+
+    :param engine: Движок базы данных
+    :param migrations: Список миграций, по умолчанию `MIGRATIONS`
+    :return: Номера применённых миграций
+    """
+    migrations = sorted(migrations or MIGRATIONS, key=lambda m: m.version)
+    applied = []
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock:
+        lock.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK})
+        try:
+            done = applied_versions(lock)
+            for migration in migrations:
+                if migration.version in done:
+                    continue
+                logger.info("Applying migration %s: %s", migration.version, migration.description)
+                if migration.transactional:
+                    with engine.begin() as conn:
+                        migration.upgrade(conn)
+                        _record(conn, migration)
+                else:
+                    migration.upgrade(lock)
+                    _record(lock, migration)
+                applied.append(migration.version)
+        finally:
+            lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK})
+    logger.info("Schema is up to date, applied: %s", applied)
+    return applied
+
+
+def _record(conn: Connection, migration: Migration) -> None:
+    """
+    Записывает миграцию как применённую
+
+    :param conn: Соединение с базой данных
+    :param migration: Миграция
+    """
+    conn.execute(text('INSERT INTO schema_version (version, description) VALUES (:version, :description)'),
+                 {'version': migration.version, 'description': migration.description})
+
+
+if __name__ == '__main__':
+    from batadaze.src.main import get_local
+
+    migrate(get_local()[0])
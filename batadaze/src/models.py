@@ -1,8 +1,10 @@
+import datetime
 from typing import Annotated
 from typing import Optional
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import DateTime, ForeignKey, Index
 from sqlalchemy import String
+from sqlalchemy import func, text
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -41,6 +43,9 @@ class Video(Base):
 
     id: Mapped[str_256pk]
     file_id: Mapped[Optional[str_256]]
+    request_count: Mapped[int] = mapped_column(server_default=text('0'))
+    last_requested_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True))
+    prefetched_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True))
 
 
 class Playlist(Base):
@@ -49,6 +54,14 @@ class Playlist(Base):
     id: Mapped[str_256pk]
     host: Mapped[str_256]
     is_updating: Mapped[bool]
+    next_update_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    request_rate: Mapped[float] = mapped_column(server_default=text('0'))
+    last_requested_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index('ix_playlist_next_update_at', 'next_update_at', postgresql_where=text('NOT is_updating')),
+        Index('ix_playlist_last_requested_at', 'last_requested_at'),
+    )
 
 
 class Playlist_User(Base):
@@ -63,6 +76,10 @@ class Playlist_User(Base):
         primary_key=True,
     )
 
+    __table_args__ = (
+        Index('ix_playlist_user_id_chat', 'id_chat'),
+    )
+
 
 class Playlist_Video(Base):
     __tablename__ = "playlist_video"
@@ -75,3 +92,8 @@ class Playlist_Video(Base):
         ForeignKey("playlist.id", ondelete="CASCADE"),
         primary_key=True,
     )
+    added_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_playlist_video_id_playlist', 'id_playlist', 'id_video'),
+    )
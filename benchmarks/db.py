@@ -0,0 +1,86 @@
+"""
+Сравнение синхронного `DB` и асинхронного `AsyncDB` при конкурентных запросах
+
+Использует базу данных из переменных окружения `POSTGRES_*`, создаёт тестовые видео и удаляет их после замера.
+Синхронный фасад нагружается пулом потоков, асинхронный - корутинами в одном потоке.
+
+Запуск из корня проекта::
+
+    python -m benchmarks.db --requests 5000 --concurrency 1 10 50
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batadaze.src.async_main import AsyncDB
+from batadaze.src.main import DB
+
+VIDEO_IDS = [f'bench{i:06d}' for i in range(1000)]
+
+
+def bench_sync(pool: ThreadPoolExecutor, requests: int, concurrency: int) -> float:
+    """
+    Замеряет пропускную способность `DB.get_video` из пула потоков
+
+    :param pool: Пул потоков. `DB` создаёт движок на каждый поток, поэтому пул переиспользуется между замерами
+    :param requests: Количество запросов
+    :param concurrency: Количество одновременных запросов
+    :return: Запросов в секунду
+    """
+    ids = (VIDEO_IDS[i % len(VIDEO_IDS)] for i in range(requests))
+    start = time.perf_counter()
+    batch = []
+    for video_id in ids:
+        batch.append(pool.submit(DB.get_video, video_id))
+        if len(batch) == concurrency:
+            [future.result() for future in batch]
+            batch = []
+    [future.result() for future in batch]
+    return requests / (time.perf_counter() - start)
+
+
+async def bench_async(requests: int, concurrency: int) -> float:
+    """
+    Замеряет пропускную способность `AsyncDB.get_video` из корутин
+
+    :param requests: Количество запросов
+    :param concurrency: Максимальное количество одновременных запросов
+    :return: Запросов в секунду
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _get(video_id: str):
+        async with semaphore:
+            return await AsyncDB.get_video(video_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_get(VIDEO_IDS[i % len(VIDEO_IDS)]) for i in range(requests)))
+    return requests / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+
+    async def _bench_async_all() -> list:
+        await bench_async(max(args.concurrency), max(args.concurrency))
+        return [await bench_async(args.requests, concurrency) for concurrency in args.concurrency]
+
+    DB.add_videos(VIDEO_IDS)
+    try:
+        with ThreadPoolExecutor(max(args.concurrency)) as pool:
+            list(pool.map(DB.get_video, VIDEO_IDS[:max(args.concurrency)]))
+            sync_rates = [bench_sync(pool, args.requests, concurrency) for concurrency in args.concurrency]
+        async_rates = asyncio.run(_bench_async_all())
+        for concurrency, sync_rate, async_rate in zip(args.concurrency, sync_rates, async_rates):
+            print(f'concurrency {concurrency:4}: DB {sync_rate:9.0f} req/s, AsyncDB {async_rate:9.0f} req/s')
+    finally:
+        for video_id in VIDEO_IDS:
+            DB.delete_video(video_id)
+
+
+if __name__ == '__main__':
+    main()
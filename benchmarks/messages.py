@@ -0,0 +1,70 @@
+"""
+Сравнение схемы сообщений `common.src.messages` с прежними JSON-сообщениями
+
+Запуск из корня проекта::
+
+    python -m benchmarks.messages
+"""
+import json
+import timeit
+
+from common.src.messages import VideoTask, PlaylistAnswer, encode, decode
+
+PLAYLIST_SIZE = 5000
+
+VIDEO_IDS = [f'{i:011d}' for i in range(PLAYLIST_SIZE)]
+
+PLAYLIST_URL = 'https://www.youtube.com/playlist?list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs'
+
+LEGACY_PLAYLIST_ANSWER = {'type': 'playlist', 'playlist_id': 'PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs',
+                          'hosting': 'youtube', 'upload': True, 'video_ids': VIDEO_IDS, 'error_code': None,
+                          'playlist_url': PLAYLIST_URL}
+
+LEGACY_PLAYLIST_TASK = LEGACY_PLAYLIST_ANSWER | {'type': 'download', 'video_id': VIDEO_IDS[0]}
+
+LEGACY_VIDEO_TASK = {'chat_id': 123456789, 'message_id': 1024, 'url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+                     'type': 'download', 'video_id': 'dQw4w9WgXcQ', 'hosting': 'youtube'}
+
+PLAYLIST_ANSWER = PlaylistAnswer('PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs', 'youtube', True, VIDEO_IDS, None, PLAYLIST_URL)
+
+PLAYLIST_TASK = VideoTask('download', VIDEO_IDS[0], 'youtube', playlist_id='PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs')
+
+VIDEO_TASK = VideoTask('download', 'dQw4w9WgXcQ', 'youtube', chat_id=123456789, message_id=1024)
+
+
+def measure(name: str, legacy: dict, message, number: int) -> None:
+    """
+    Печатает размер сообщения и время кодирования/декодирования в обоих форматах
+
+    :param name: Название случая
+    :param legacy: Сообщение в прежнем формате
+    :param message: Сообщение в новом формате
+    :param number: Количество повторений
+    """
+    legacy_body = json.dumps(legacy).encode('utf-8')
+    body = encode(message)
+    rows = [
+        ('json', len(legacy_body),
+         timeit.timeit(lambda: json.dumps(legacy).encode('utf-8'), number=number),
+         timeit.timeit(lambda: json.loads(legacy_body.decode('utf-8')), number=number)),
+        ('msgpack', len(body),
+         timeit.timeit(lambda: encode(message), number=number),
+         timeit.timeit(lambda: decode(body), number=number)),
+    ]
+    print(name)
+    for fmt, size, enc, dec in rows:
+        print(f'  {fmt:8} {size:>8} B  encode {enc / number * 1e6:9.2f} us  decode {dec / number * 1e6:9.2f} us')
+
+
+def main() -> None:
+    measure('video task', LEGACY_VIDEO_TASK, VIDEO_TASK, 100000)
+    measure('playlist download task', LEGACY_PLAYLIST_TASK, PLAYLIST_TASK, 1000)
+    measure(f'playlist answer ({PLAYLIST_SIZE} ids)', LEGACY_PLAYLIST_ANSWER, PLAYLIST_ANSWER, 1000)
+    legacy_total = len(json.dumps(LEGACY_PLAYLIST_TASK)) * PLAYLIST_SIZE
+    total = len(encode(PLAYLIST_TASK)) * PLAYLIST_SIZE
+    print(f'playlist fan-out ({PLAYLIST_SIZE} tasks): json {legacy_total / 2 ** 20:.1f} MiB, '
+          f'msgpack {total / 2 ** 20:.2f} MiB')
+
+
+if __name__ == '__main__':
+    main()
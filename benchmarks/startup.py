@@ -0,0 +1,75 @@
+"""
+Время запуска сервисов: импорт модуля, создание сервиса и время до готовности
+
+Каждый замер выполняется в отдельном процессе, чтобы модули не оставались в кеше импорта. Время до готовности -
+выполнение фоновых шагов `Readiness`; без доступных внешних сервисов (брокера, базы данных, Bot API) шаги не
+завершатся, поэтому ожидание ограничено `--ready-timeout`. Переменные окружения сервисов берутся из окружения или .env.
+
+Запуск из корня проекта::
+
+    python -m benchmarks.startup --repeat 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+SERVICES = {
+    'bot': ('src.bot.bot_handler', 'TBotHandler'),
+    'downloader': ('src.downloader.load', 'Loader'),
+    'youtube': ('src.youtube.youtube_loader', 'YoutubeLoader'),
+    'vk': ('src.vk.vk_loader', 'VKLoader'),
+    'worker': ('src.worker.worker', None),
+}
+
+PROBE = """
+import importlib, json, sys, time
+module, cls, timeout = sys.argv[1], sys.argv[2], float(sys.argv[3])
+start = time.perf_counter()
+mod = importlib.import_module(module)
+result = {'import': time.perf_counter() - start}
+if cls:
+    start = time.perf_counter()
+    service = getattr(mod, cls)()
+    result['construct'] = time.perf_counter() - start
+    ready = service.readiness.wait(timeout)
+    result['ready'] = time.perf_counter() - start if ready else None
+print(json.dumps(result))
+"""
+
+
+def measure(module: str, cls: str, ready_timeout: float) -> dict:
+    """
+    Запускает сервис в новом процессе и возвращает время этапов запуска
+
+    :param module: Модуль сервиса
+    :param cls: Класс сервиса, пусто - только импорт
+    :param ready_timeout: Максимальное время ожидания готовности, в секундах
+    :return: Время импорта, создания и готовности, в секундах
+    """
+    output = subprocess.run([sys.executable, '-c', PROBE, module, cls or '', str(ready_timeout)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ready-timeout', type=float, default=5.0)
+    parser.add_argument('services', nargs='*', default=list(SERVICES))
+    args = parser.parse_args()
+    for name in args.services:
+        module, cls = SERVICES[name]
+        runs = [measure(module, cls, args.ready_timeout) for _ in range(args.repeat)]
+        row = f'{name:12} import {statistics.median(run["import"] for run in runs) * 1000:8.1f} ms'
+        if cls:
+            row += f'  construct {statistics.median(run["construct"] for run in runs) * 1000:8.1f} ms'
+            ready = [run['ready'] for run in runs if run['ready'] is not None]
+            row += (f'  ready {statistics.median(ready) * 1000:8.1f} ms' if len(ready) == len(runs)
+                    else f'  ready > {args.ready_timeout:.0f} s')
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Допуск задач в очередь по её текущей загрузке
+
+`Admission` раз в `interval` секунд узнаёт у транспорта, сколько задач ожидает в очереди и сколько Worker-ов её
+получают, а из ответов Worker-ов - среднее время выполнения задачи. По ним для новой задачи оцениваются позиция в
+очереди и время до её выполнения::
+
+    eta = ceil(position / (consumers * slots)) * service_time
+
+Задачи разделены по приоритетам, у каждого свой предел числа ожидающих задач и времени ожидания. Задача
+отклоняется, если предел её приоритета превышен, поэтому при перегрузке сначала перестают ставиться фоновые
+задачи, а запросы пользователей - только после них. Если состояние очереди неизвестно, задачи допускаются.
+"""
+import math
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+from common.src.logs import get_logger
+from common.src.transport import QueueStats, Transport
+
+logger = get_logger("Admission")
+
+
+class Limit(NamedTuple):
+    """
+    Пределы очереди для приоритета
+
+    :ivar `int | None` max_depth: Максимальное число ожидающих задач, None - без ограничения
+    :ivar `float | None` max_wait: Максимальное оценочное время выполнения новой задачи, в секундах, None - без
+        ограничения
+    """
+    max_depth: Optional[int] = None
+    max_wait: Optional[float] = None
+
+
+class Estimate(NamedTuple):
+    """
+    Оценка очереди для новой задачи
+
+    :ivar `bool` admitted: Задачу можно поставить в очередь
+    :ivar `int | None` position: Позиция задачи в очереди, None - неизвестна
+    :ivar `float | None` eta: Оценочное время до выполнения задачи, в секундах, None - неизвестно
+    :ivar `float | None` retry_after: Через сколько секунд повторить отклонённую задачу
+    """
+    admitted: bool
+    position: Optional[int] = None
+    eta: Optional[float] = None
+    retry_after: Optional[float] = None
+
+
+class Admission:
+    """
+    Оценка очереди задач и допуск новых задач по приоритетам
+
+    :ivar `common.src.transport.Transport` transport: Транспорт, у которого запрашивается состояние очереди
+    :ivar `str` queue_name: Имя очереди задач
+    :ivar `int` slots: Число задач, которые один получатель очереди выполняет одновременно
+    :ivar `dict[str, Limit]` limits: Пределы очереди по приоритетам
+    :ivar `float` interval: Период опроса состояния очереди, в секундах
+    :ivar `float` retry_after: Пауза до повтора отклонённой задачи, если время выполнения очереди неизвестно
+    :ivar `float` alpha: Вес нового значения в скользящем среднем времени выполнения задачи
+    """
+
+    def __init__(self, transport: Transport, queue_name: str, slots: int, limits: Dict[str, Limit],
+                 interval: float = 1.0, retry_after: float = 60.0, alpha: float = 0.1,
+                 clock=time.monotonic):
+        self.transport = transport
+        self.queue_name = queue_name
+        self.slots = max(slots, 1)
+        self.limits = limits
+        self.interval = interval
+        self.retry_after = retry_after
+        self.alpha = alpha
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stats: Optional[QueueStats] = None
+        self._sampled = 0.0
+        self._enqueued = 0
+        self._service_time: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def service_time(self) -> Optional[float]:
+        """
+        :return: Скользящее среднее времени выполнения задачи, в секундах, None - ещё не известно
+        """
+        return self._service_time
+
+    def start(self) -> None:
+        """
+        Запускает опрос состояния очереди в фоновом потоке, повторный вызов ничего не делает
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f'admission-{self.queue_name}', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self) -> Optional[QueueStats]:
+        """
+        Запрашивает состояние очереди у транспорта
+
+        :return: Состояние очереди, None - не удалось узнать
+        """
+        try:
+            stats = self.transport.stats(self.queue_name)
+        except Exception as e:
+            logger.warning("Queue %s stats fail: %s, %s", self.queue_name, e.__class__.__name__, e)
+            stats = None
+        with self._lock:
+            self._stats = stats
+            self._sampled = self._clock()
+            self._enqueued = 0
+        return stats
+
+    def observe(self, elapsed: float) -> None:
+        """
+        Учитывает время выполнения задачи Worker-ом
+
+        :param elapsed: Время выполнения, в секундах
+        """
+        with self._lock:
+            if self._service_time is None:
+                self._service_time = elapsed
+            else:
+                self._service_time += self.alpha * (elapsed - self._service_time)
+
+    def enqueued(self, count: int = 1) -> None:
+        """
+        Учитывает задачи, поставленные в очередь после последнего опроса
+
+        :param count: Количество задач
+        """
+        with self._lock:
+            self._enqueued += count
+
+    def estimate(self, priority: str) -> Estimate:
+        """
+        Оценивает позицию и время выполнения новой задачи и решает, можно ли её поставить
+
+        :param priority: Приоритет задачи, ключ `limits`
+        :return: Оценка очереди
+        """
+        limit = self.limits.get(priority, Limit())
+        with self._lock:
+            stats, service_time = self._stats, self._service_time
+            if stats is None or self._clock() - self._sampled > 3 * self.interval:
+                return Estimate(True)
+            depth = stats.depth + self._enqueued
+        position = depth + 1
+        throughput = stats.consumers * self.slots / service_time if service_time and stats.consumers else None
+        eta = math.ceil(position / (stats.consumers * self.slots)) * service_time if throughput else None
+        waits = []
+        if limit.max_depth is not None and depth >= limit.max_depth:
+            waits.append((depth - limit.max_depth + 1) / throughput if throughput else self.retry_after)
+        if limit.max_wait is not None and eta is not None and eta > limit.max_wait:
+            waits.append(eta - limit.max_wait)
+        if waits:
+            logger.info("Task of priority %s rejected, depth: %s, eta: %s", priority, depth, eta)
+            return Estimate(False, position, eta, max(max(waits), 1.0))
+        return Estimate(True, position, eta)
@@ -0,0 +1,165 @@
+"""
+Автоматы защиты обращений к загрузчикам видео-хостингов
+
+Автомат считает результаты последних `window` обращений к сервису. Если среди них доля ошибок не меньше
+`failure_rate` или доля медленных обращений не меньше `slow_rate`, автомат размыкается: обращения не выполняются
+`open_timeout` секунд, задачи сразу получают отказ или откладываются. Затем автомат пропускает `half_open_calls`
+пробных обращений: если они успешны, он замыкается, если хотя бы одно неудачно - снова размыкается::
+
+    closed --(ошибки)--> open --(open_timeout)--> half_open --(пробы успешны)--> closed
+                                                            --(проба неудачна)--> open
+
+Решение о размыкании принимается не раньше, чем накопится `min_calls` обращений, поэтому единичная ошибка после
+простоя не размыкает автомат.
+"""
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from common.src.logs import get_logger
+
+logger = get_logger("CircuitBreaker")
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты обращений к одному сервису
+
+    :cvar `str` CLOSED: Обращения выполняются
+    :cvar `str` OPEN: Обращения не выполняются
+    :cvar `str` HALF_OPEN: Выполняются только пробные обращения
+    :ivar `str` name: Имя сервиса в журнале и метриках
+    :ivar `int` window: Количество последних обращений, по которым оценивается сервис
+    :ivar `int` min_calls: Минимальное количество обращений для размыкания
+    :ivar `float` failure_rate: Доля ошибок, при которой автомат размыкается
+    :ivar `float | None` slow_call: Обращение дольше `slow_call` секунд считается медленным, None - не учитывается
+    :ivar `float` slow_rate: Доля медленных обращений, при которой автомат размыкается
+    :ivar `float` open_timeout: Время в разомкнутом состоянии до пробных обращений, в секундах
+    :ivar `int` half_open_calls: Количество успешных пробных обращений для замыкания
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 slow_call: Optional[float] = None, slow_rate: float = 0.5, open_timeout: float = 30.0,
+                 half_open_calls: int = 1, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = max(min_calls, 1)
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_timeout = open_timeout
+        self.half_open_calls = max(half_open_calls, 1)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._calls: Deque[Tuple[bool, bool]] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_started = 0.0
+        self._successes = 0
+        self._opens = 0
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        """
+        :return: Состояние автомата
+        """
+        with self._lock:
+            self._advance()
+            return self._state
+
+    def _advance(self) -> None:
+        if self._state == self.OPEN and self._clock() >= self._opened_at + self.open_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            self._successes = 0
+            logger.info("Circuit %s half-open", self.name)
+
+    def allow(self) -> bool:
+        """
+        Решает, можно ли обратиться к сервису. В полуразомкнутом состоянии выдаёт разрешения на пробные обращения;
+        если проба не сообщила результат за `open_timeout` секунд, выдаётся новая
+
+        :return: True, если обращение можно выполнить
+        """
+        with self._lock:
+            self._advance()
+            if self._state == self.CLOSED:
+                return True
+            now = self._clock()
+            if self._state == self.HALF_OPEN and (self._probes < self.half_open_calls or
+                                                  now - self._probe_started > self.open_timeout):
+                if now - self._probe_started > self.open_timeout:
+                    self._probes = 0
+                self._probes += 1
+                self._probe_started = now
+                return True
+            self._rejected += 1
+            return False
+
+    def record(self, failed: bool, elapsed: Optional[float] = None) -> None:
+        """
+        Учитывает результат обращения к сервису
+
+        :param failed: Обращение завершилось ошибкой сервиса
+        :param elapsed: Время обращения в секундах, None - время не учитывается
+        """
+        slow = self.slow_call is not None and elapsed is not None and elapsed > self.slow_call
+        with self._lock:
+            self._advance()
+            if self._state == self.HALF_OPEN:
+                if failed or slow:
+                    self._open('probe failed' if failed else f'probe took {elapsed:.1f}s')
+                else:
+                    self._successes += 1
+                    if self._successes >= self.half_open_calls:
+                        self._close()
+            elif self._state == self.CLOSED:
+                self._calls.append((failed, slow))
+                if len(self._calls) < self.min_calls:
+                    return
+                failures = sum(call[0] for call in self._calls) / len(self._calls)
+                slows = sum(call[1] for call in self._calls) / len(self._calls)
+                if failures >= self.failure_rate:
+                    self._open(f'failure rate {failures:.2f}')
+                elif slows >= self.slow_rate:
+                    self._open(f'slow call rate {slows:.2f}')
+
+    def _open(self, reason: str) -> None:
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._calls.clear()
+        self._opens += 1
+        logger.warning("Circuit %s open: %s", self.name, reason)
+
+    def _close(self) -> None:
+        self._state = self.CLOSED
+        self._calls.clear()
+        logger.info("Circuit %s closed", self.name)
+
+    def retry_after(self) -> float:
+        """
+        :return: Время до пробных обращений в секундах, 0 - если автомат не разомкнут
+        """
+        with self._lock:
+            self._advance()
+            if self._state != self.OPEN:
+                return 0.0
+            return max(self._opened_at + self.open_timeout - self._clock(), 0.0)
+
+    def stats(self) -> dict:
+        """
+        :return: Состояние автомата, доли ошибок и медленных обращений в окне, количество размыканий и отказов
+        """
+        with self._lock:
+            self._advance()
+            calls = len(self._calls)
+            return {'state': self._state, 'calls': calls,
+                    'failure_rate': round(sum(call[0] for call in self._calls) / calls, 3) if calls else 0.0,
+                    'slow_rate': round(sum(call[1] for call in self._calls) / calls, 3) if calls else 0.0,
+                    'opens': self._opens, 'rejected': self._rejected}
@@ -0,0 +1,151 @@
+"""
+Получение сообщений из очереди RabbitMQ с автоматическим переподключением
+"""
+import threading
+import time
+from functools import partial
+from typing import Callable, NoReturn, Optional
+
+import pika
+from pika.exceptions import AMQPError, ConnectionClosedByBroker
+
+from common.src.logs import get_logger
+
+logger = get_logger("Consumer")
+
+
+class Consumer:
+    """
+    Получатель сообщений из одной очереди. Держит собственное соединение с heartbeat, поэтому обрыв соединения
+    обнаруживается, и после него получатель переподключается. Обработчик вызывается в потоке получателя
+
+    При `prefetch` больше нуля брокер выдаёт не больше `prefetch` неподтверждённых сообщений, и каждое нужно
+    подтвердить вызовом `ack` из любого потока. Сообщения, не подтверждённые до обрыва соединения, брокер выдаст
+    повторно. При остановке получатель ожидает подтверждения всех выданных сообщений
+
+    :ivar `str` host: Хост RabbitMQ
+    :ivar `int` port: Порт RabbitMQ
+    :ivar `str` queue: Имя очереди
+    :ivar `Callable` callback: Обработчик сообщений с сигнатурой `pika` (channel, method, properties, body)
+    :ivar `int` heartbeat: Интервал heartbeat соединения, в секундах
+    :ivar `float` reconnect_delay: Пауза перед повторным подключением, в секундах
+    :ivar `int` prefetch: Максимальное число неподтверждённых сообщений, 0 - подтверждать сразу
+    :ivar `dict | None` arguments: Аргументы объявления очереди, например `x-expires`
+    """
+
+    def __init__(self, host: str, port: int, queue: str, callback: Callable, heartbeat: int = 60,
+                 reconnect_delay: float = 1.0, prefetch: int = 0, arguments: Optional[dict] = None):
+        self.host = host
+        self.port = int(port)
+        self.queue = queue
+        self.callback = callback
+        self.heartbeat = heartbeat
+        self.reconnect_delay = reconnect_delay
+        self.prefetch = prefetch
+        self.arguments = arguments
+        self._unacked = 0
+        self._connection: Optional[pika.BlockingConnection] = None
+        self._channel = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> NoReturn:
+        """
+        Запускает получение сообщений в фоновом потоке, повторный вызов ничего не делает
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, name=f'consumer-{self.queue}', daemon=True)
+        self._thread.start()
+
+    def run(self) -> NoReturn:
+        """
+        Получает сообщения в текущем потоке до вызова `stop`, переподключаясь при обрыве соединения
+        """
+        while not self._stopping.is_set():
+            try:
+                self._connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(host=self.host, port=self.port, heartbeat=self.heartbeat))
+                self._channel = self._connection.channel()
+                self._channel.queue_declare(self.queue, arguments=self.arguments)
+                self._unacked = 0
+                if self.prefetch:
+                    self._channel.basic_qos(prefetch_count=self.prefetch)
+                    self._channel.basic_consume(self.queue, self._deliver)
+                else:
+                    self._channel.basic_consume(self.queue, self.callback, auto_ack=True)
+                logger.info("Consuming %s from %s:%s", self.queue, self.host, self.port)
+                self._channel.start_consuming()
+                if self._unacked:
+                    logger.info("Consumer of %s stopping, waiting for %s acks", self.queue, self._unacked)
+                while self._unacked and self._stopping.is_set():
+                    self._connection.process_data_events(time_limit=1)
+            except ConnectionClosedByBroker as e:
+                logger.warning("Connection closed by broker: %s", e)
+            except AMQPError as e:
+                logger.warning("Connection lost, reconnecting: %s, %s", e.__class__.__name__, e)
+            except Exception as e:
+                logger.exception("Message handler failed, reconnecting: %s, %s", e.__class__.__name__, e)
+            finally:
+                self._close()
+            if not self._stopping.is_set():
+                time.sleep(self.reconnect_delay)
+        logger.info("Consumer of %s stopped", self.queue)
+
+    def _deliver(self, channel, method, properties, body: bytes) -> NoReturn:
+        """
+        Передаёт сообщение обработчику и учитывает его как неподтверждённое
+        """
+        self._unacked += 1
+        self.callback(channel, method, properties, body)
+
+    def ack(self, channel, delivery_tag: int) -> NoReturn:
+        """
+        Подтверждает сообщение. Можно вызывать из любого потока: подтверждение передаётся в поток соединения.
+        Сообщения, полученные до переподключения, не подтверждаются - брокер выдаст их повторно
+
+        :param channel: Канал, из которого получено сообщение
+        :param delivery_tag: Номер доставки сообщения
+        """
+        connection = self._connection
+        if connection is None or channel is not self._channel:
+            return
+        try:
+            connection.add_callback_threadsafe(partial(self._ack, channel, delivery_tag))
+        except AMQPError:
+            pass
+
+    def _ack(self, channel, delivery_tag: int) -> NoReturn:
+        if channel is self._channel and channel.is_open:
+            channel.basic_ack(delivery_tag)
+            self._unacked -= 1
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        """
+        Останавливает получение сообщений после обработки текущего и подтверждения выданных
+
+        :param timeout: Максимальное время ожидания фонового потока, в секундах
+        """
+        self._stopping.set()
+        connection, channel = self._connection, self._channel
+        if connection is not None and channel is not None:
+            try:
+                connection.add_callback_threadsafe(channel.stop_consuming)
+            except AMQPError:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _close(self) -> NoReturn:
+        """
+        Закрывает текущее соединение, ошибки закрытия игнорируются
+        """
+        if self._connection is not None:
+            try:
+                if self._connection.is_open:
+                    self._connection.close()
+            except AMQPError:
+                pass
+        self._connection = None
+        self._channel = None
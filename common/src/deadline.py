@@ -0,0 +1,83 @@
+"""
+Сроки выполнения задач
+
+Loader назначает задаче срок один раз при постановке в очередь, срок передаётся в сообщении (`deadline`) и в
+HTTP-заголовке `X-Deadline` запросов к загрузчикам. Каждый этап ограничивает им своё ожидание и прекращает работу
+после его наступления, поэтому загрузчик не продолжает загрузку, результат которой Worker уже не ждёт::
+
+    deadline = deadline_after(3600)
+    requests.post(url, json=payload, headers=to_headers(deadline), timeout=remaining(deadline, 1000))
+
+Срок - абсолютное время Unix в секундах, поэтому он одинаково понимается сервисами на разных машинах при
+синхронизированных часах.
+"""
+import time
+from typing import Mapping, Optional
+
+HEADER = 'X-Deadline'
+
+
+class DeadlineExceeded(Exception):
+    """
+    Срок задачи наступил
+    """
+
+
+def deadline_after(seconds: float) -> float:
+    """
+    :param seconds: Время на выполнение задачи, в секундах
+    :return: Срок через `seconds` секунд
+    """
+    return time.time() + seconds
+
+
+def remaining(deadline: Optional[float], default: Optional[float] = None) -> Optional[float]:
+    """
+    Возвращает время до срока, но не больше `default`
+
+    :param deadline: Срок, None - без срока
+    :param default: Ограничение ожидания этапа, используется и при отсутствии срока
+    :return: Время до срока в секундах, не меньше нуля
+    """
+    if deadline is None:
+        return default
+    left = max(deadline - time.time(), 0.0)
+    return left if default is None else min(left, default)
+
+
+def expired(deadline: Optional[float]) -> bool:
+    """
+    :param deadline: Срок, None - без срока
+    :return: True, если срок наступил
+    """
+    return deadline is not None and time.time() >= deadline
+
+
+def check(deadline: Optional[float]) -> None:
+    """
+    Прерывает работу, если срок наступил
+
+    :param deadline: Срок, None - без срока
+    :raises DeadlineExceeded: Если срок наступил
+    """
+    if expired(deadline):
+        raise DeadlineExceeded(f'deadline {deadline:.3f} exceeded')
+
+
+def to_headers(deadline: Optional[float]) -> dict:
+    """
+    :param deadline: Срок, None - без срока
+    :return: HTTP-заголовки со сроком
+    """
+    return {HEADER: f'{deadline:.3f}'} if deadline is not None else {}
+
+
+def from_headers(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    :param headers: HTTP-заголовки запроса
+    :return: Срок из заголовка `X-Deadline` или None, если его нет или он некорректен
+    """
+    try:
+        return float(headers[HEADER])
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,42 @@
+"""
+Канонические ссылки на видео и плейлисты поддерживаемых видеохостингов
+
+Ссылки строятся по идентификатору, поэтому все сервисы обращаются к загрузчикам с одинаковыми url, и кэши
+загрузчиков (`common.src.probe.TTLCache`) срабатывают для запросов от разных сервисов.
+"""
+import re
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+VIDEO_URLS = {
+    'youtube': 'https://www.youtube.com/watch?v={0}',
+    'vk': 'https://vk.com/video?z=video{0}',
+}
+
+PLAYLIST_URLS = {
+    'youtube': 'https://www.youtube.com/playlist?list={0}',
+    'vk': 'https://vk.com/video/playlist/{0}',
+}
+
+_YOUTUBE_VIDEO_ID = re.compile(r'(?:v=|/)([0-9A-Za-z_-]{11}).*')
+
+
+def youtube_video_id(url: str) -> Optional[str]:
+    """
+    Извлекает идентификатор видео из ссылки на youtube, как `pytube.extract.video_id`, но без загрузки pytube
+
+    :param url: Ссылка на видео
+    :return: video_id или None, если ссылка его не содержит
+    """
+    match = _YOUTUBE_VIDEO_ID.search(url)
+    return match.group(1) if match else None
+
+
+def youtube_playlist_id(url: str) -> Optional[str]:
+    """
+    Извлекает идентификатор плейлиста из ссылки на youtube
+
+    :param url: Ссылка на плейлист
+    :return: playlist_id или None, если ссылка его не содержит
+    """
+    return parse_qs(urlparse(url).query).get('list', [None])[0]
@@ -0,0 +1,129 @@
+"""
+Общая настройка журналирования сервисов
+
+Записи передаются в очередь и выводятся одним фоновым потоком, поэтому потоки обработчиков не ждут записи в stderr.
+Сообщение форматируется только в фоновом потоке и только если запись прошла фильтры, поэтому в горячих местах
+сообщения передаются шаблоном с аргументами, а не f-строкой::
+
+    logger = get_logger("Worker")
+    logger.info("Download start", extra={'url': url})
+    logger.debug("Adding video %s", video)
+
+Поля из `extra` выводятся после сообщения как `key=value`. Повторяющиеся записи одного шаблона ограничиваются
+`RateLimitFilter`: после `burst` записей за `per` секунд остальные отбрасываются до конца интервала, а первая
+пропущенная после этого запись получает поле `suppressed` с количеством отброшенных. Ошибки не ограничиваются.
+
+Уровень задаётся переменной окружения LOG_LEVEL, по умолчанию INFO.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict
+
+FORMAT = '%(name)s - %(levelname)s - %(message)s'
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+_RESERVED = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Добавляет к сообщению поля, переданные через `extra`, в виде `key=value`
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        fields = ' '.join(f'{key}={value}' for key, value in record.__dict__.items() if key not in _RESERVED)
+        return f'{message} {fields}' if fields else message
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничивает количество записей с одним шаблоном сообщения
+
+    :ivar `int` burst: Количество записей одного шаблона за интервал
+    :ivar `float` per: Длина интервала, в секундах
+    """
+
+    def __init__(self, burst: int = 20, per: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.per = per
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._windows: Dict[tuple, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or not self.burst:
+            return True
+        key = (record.name, record.msg)
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                suppressed = window[2] if window is not None else 0
+                if len(self._windows) > 10000:
+                    self._windows.clear()
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class _LazyQueueHandler(QueueHandler):
+    """
+    Передаёт запись в очередь без форматирования, сообщение форматируется в фоновом потоке
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+_output = logging.StreamHandler()
+_output.setFormatter(StructuredFormatter(FORMAT))
+
+_handler = _LazyQueueHandler(_queue)
+_handler.addFilter(RateLimitFilter())
+
+_listener = QueueListener(_queue, _output, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
+
+
+def _restart_listener() -> None:
+    """
+    В дочернем процессе поток вывода родителя не существует, поэтому запускается новый
+    """
+    _listener._thread = None
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Возвращает журнал с общим фоновым выводом. Записи не передаются корневому журналу, чтобы обработчики,
+    которые добавляют туда библиотеки, не выводили их повторно и не форматировали в вызывающем потоке
+
+    :param name: Имя журнала
+    :return: Журнал
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    if _handler not in logger.handlers:
+        logger.addHandler(_handler)
+    return logger
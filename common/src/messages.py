@@ -0,0 +1,191 @@
+"""
+Схема сообщений очередей `task_queue` и `answer_queue`
+
+Сообщение кодируется msgpack-массивом `[версия, вид, *поля]`. Поля идут в порядке объявления в dataclass, поэтому
+новые необязательные поля добавляются только в конец: старый получатель отбрасывает незнакомый хвост, новый
+подставляет значения по умолчанию для недостающих полей.
+"""
+from dataclasses import dataclass, field, fields
+from typing import ClassVar, Optional, Union
+
+import msgpack
+from pika.spec import BasicProperties
+
+VERSION = 1
+
+CONTENT_TYPE = 'application/x-msgpack'
+
+PROPERTIES = BasicProperties(content_type=CONTENT_TYPE)
+
+
+class MessageError(ValueError):
+    """
+    Сообщение не соответствует схеме
+    """
+
+
+@dataclass
+class VideoTask:
+    """
+    Задача на загрузку видео (`download`) или на возврат уже загруженного (`return`)
+
+    :ivar `str` type: Тип задачи, `download` или `return`
+    :ivar `str` video_id: Идентификатор видео
+    :ivar `str` hosting: Имя видеохостинга
+    :ivar `int | None` chat_id: Чат, запросивший видео, None для задач плейлиста
+    :ivar `int | None` message_id: Сообщение с запросом
+    :ivar `str | None` playlist_id: Плейлист, к которому относится видео
+    :ivar `str | None` reply_to: Очередь для ответа, None - общая `answer_queue`
+    :ivar `float | None` deadline: Срок выполнения, время Unix в секундах, None - без срока (`common.src.deadline`)
+    """
+    kind: ClassVar[int] = 1
+
+    type: str
+    video_id: str
+    hosting: str
+    chat_id: Optional[int] = None
+    message_id: Optional[int] = None
+    playlist_id: Optional[str] = None
+    reply_to: Optional[str] = None
+    deadline: Optional[float] = None
+
+
+@dataclass
+class PlaylistTask:
+    """
+    Задача на получение списка видео плейлиста
+
+    :ivar `str` playlist_id: Идентификатор плейлиста
+    :ivar `str` hosting: Имя видеохостинга
+    :ivar `bool` upload: Если True, новые видео плейлиста нужно загрузить
+    :ivar `str | None` reply_to: Очередь для ответа, None - общая `answer_queue`
+    :ivar `float | None` deadline: Срок выполнения, время Unix в секундах, None - без срока (`common.src.deadline`)
+    """
+    kind: ClassVar[int] = 2
+    type: ClassVar[str] = 'playlist'
+
+    playlist_id: str
+    hosting: str
+    upload: bool = False
+    reply_to: Optional[str] = None
+    deadline: Optional[float] = None
+
+
+@dataclass
+class VideoAnswer:
+    """
+    Ответ на `VideoTask`
+
+    :ivar `str` type: Тип исходной задачи
+    :ivar `str | None` file_id: Идентификатор файла на сервере Telegram
+    :ivar `int | None` error_code: HTTP-код ошибки загрузки, None при успехе
+    :ivar `str | None` video_url: Ссылка на видео
+    :ivar `str | None` playlist_url: Ссылка на плейлист
+    :ivar `str | None` reply_to: Очередь, в которую публикуется ответ, копируется из задачи
+    :ivar `float | None` elapsed: Время выполнения задачи Worker-ом, в секундах
+    :ivar `float | None` deadline: Срок выполнения задачи, копируется из задачи
+    """
+    kind: ClassVar[int] = 3
+
+    type: str
+    video_id: str
+    hosting: str
+    chat_id: Optional[int] = None
+    message_id: Optional[int] = None
+    playlist_id: Optional[str] = None
+    file_id: Optional[str] = None
+    error_code: Optional[int] = None
+    video_url: Optional[str] = None
+    playlist_url: Optional[str] = None
+    reply_to: Optional[str] = None
+    elapsed: Optional[float] = None
+    deadline: Optional[float] = None
+
+    @classmethod
+    def from_task(cls, task: VideoTask, **values) -> 'VideoAnswer':
+        """
+        Создаёт ответ, копируя поля задачи
+
+        :param task: Исходная задача
+        :param values: Поля ответа
+        """
+        return cls(**vars(task), **values)
+
+
+@dataclass
+class PlaylistAnswer:
+    """
+    Часть ответа на `PlaylistTask`. Плейлист передаётся несколькими сообщениями по порядку `seq`,
+    последнее из них помечено `last`
+
+    :ivar `list[str]` video_ids: Идентификаторы видео очередной части плейлиста
+    :ivar `int | None` error_code: HTTP-код ошибки, None при успехе
+    :ivar `str | None` playlist_url: Ссылка на плейлист
+    :ivar `int` seq: Номер части
+    :ivar `bool` last: Признак последней части
+    :ivar `str | None` reply_to: Очередь, в которую публикуется ответ, копируется из задачи
+    :ivar `float | None` deadline: Срок выполнения задачи, копируется из задачи
+    """
+    kind: ClassVar[int] = 4
+    type: ClassVar[str] = 'playlist'
+
+    playlist_id: str
+    hosting: str
+    upload: bool = False
+    video_ids: list = field(default_factory=list)
+    error_code: Optional[int] = None
+    playlist_url: Optional[str] = None
+    seq: int = 0
+    last: bool = True
+    reply_to: Optional[str] = None
+    deadline: Optional[float] = None
+
+    @classmethod
+    def from_task(cls, task: PlaylistTask, **values) -> 'PlaylistAnswer':
+        """
+        Создаёт ответ, копируя поля задачи
+
+        :param task: Исходная задача
+        :param values: Поля ответа
+        """
+        return cls(**vars(task), **values)
+
+
+Message = Union[VideoTask, PlaylistTask, VideoAnswer, PlaylistAnswer]
+
+_schemas = {cls.kind: (cls, tuple(f.name for f in fields(cls)))
+            for cls in (VideoTask, PlaylistTask, VideoAnswer, PlaylistAnswer)}
+
+
+def encode(message: Message) -> bytes:
+    """
+    Кодирует сообщение
+
+    :param message: Сообщение
+    :return: Тело сообщения для RabbitMQ
+    """
+    cls, names = _schemas[message.kind]
+    return msgpack.packb([VERSION, message.kind, *(getattr(message, name) for name in names)])
+
+
+def decode(body: bytes) -> Message:
+    """
+    Декодирует сообщение
+
+    :param body: Тело сообщения из RabbitMQ
+    :return: Сообщение
+    :raises MessageError: Если тело не соответствует схеме
+    """
+    try:
+        version, kind, *values = msgpack.unpackb(body)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise MessageError(f"Malformed message: {e}") from e
+    if version != VERSION:
+        raise MessageError(f"Unsupported message version: {version}")
+    if kind not in _schemas:
+        raise MessageError(f"Unknown message kind: {kind}")
+    cls, names = _schemas[kind]
+    try:
+        return cls(*values[:len(names)])
+    except TypeError as e:
+        raise MessageError(f"Missing fields for {cls.__name__}: {e}") from e
@@ -0,0 +1,109 @@
+"""
+Потоковая передача списка видео плейлиста частями
+
+Загрузчик отвечает на `/api/get/playlist` потоком строк JSON (NDJSON): каждая строка вида
+`{"seq": 0, "video_ids": [...]}` содержит очередную часть идентификаторов, последняя строка вида
+`{"seq": 5, "end": true, "error_code": null}` завершает поток и сообщает об ошибке, если она возникла во время обхода.
+"""
+import json
+import time
+from http import HTTPStatus
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Tuple, Type, Optional
+
+from common.src.deadline import DeadlineExceeded
+
+CONTENT_TYPE = 'application/x-ndjson'
+
+CHUNK_SIZE = 50
+
+FLUSH_INTERVAL = 1.0
+
+
+def stream_chunks(video_ids: Iterable[str], errors: Tuple[Type[BaseException], ...] = (),
+                  chunk_size: int = CHUNK_SIZE, flush_interval: float = FLUSH_INTERVAL) -> Iterator[str]:
+    """
+    Разбивает ленивый обход плейлиста на строки NDJSON
+
+    Часть отправляется, когда набрано `chunk_size` идентификаторов или с отправки предыдущей прошло больше
+    `flush_interval` секунд, поэтому первые видео плейлиста уходят получателю сразу после первой страницы.
+
+    :param video_ids: Ленивая последовательность идентификаторов видео
+    :param errors: Исключения обхода, которые превращаются в `error_code` 400 завершающей строки. `DeadlineExceeded`
+        превращается в `error_code` 504
+    :param chunk_size: Максимальный размер части
+    :param flush_interval: Максимальная задержка отправки неполной части, в секундах
+    :return: Строки NDJSON
+    """
+    seq = 0
+    chunk = []
+    error_code = None
+    last_flush = time.monotonic()
+    try:
+        for video_id in video_ids:
+            chunk.append(video_id)
+            if len(chunk) >= chunk_size or time.monotonic() - last_flush >= flush_interval:
+                yield json.dumps({'seq': seq, 'video_ids': chunk}) + '\n'
+                seq += 1
+                chunk = []
+                last_flush = time.monotonic()
+    except DeadlineExceeded:
+        error_code = HTTPStatus.GATEWAY_TIMEOUT
+    except errors:
+        error_code = HTTPStatus.BAD_REQUEST
+    if chunk:
+        yield json.dumps({'seq': seq, 'video_ids': chunk}) + '\n'
+        seq += 1
+    yield json.dumps({'seq': seq, 'end': True, 'error_code': error_code}) + '\n'
+
+
+def _parse_chunk(line: bytes) -> Tuple[int, list, bool, Optional[int]]:
+    """
+    Разбирает одну строку потока
+
+    :param line: Строка ответа загрузчика
+    :return: Кортеж (номер части, идентификаторы видео, признак последней части, код ошибки)
+    """
+    chunk = json.loads(line)
+    if chunk.get('end'):
+        return chunk['seq'], chunk.get('video_ids', []), True, chunk.get('error_code')
+    return chunk['seq'], chunk['video_ids'], False, None
+
+
+def iter_chunks(lines: Iterable[bytes]) -> Iterator[Tuple[int, list, bool, Optional[int]]]:
+    """
+    Читает поток, созданный `stream_chunks`
+
+    Если поток оборвался до завершающей строки, возвращает завершающую часть с кодом 502.
+
+    :param lines: Строки ответа загрузчика
+    :return: Кортежи (номер части, идентификаторы видео, признак последней части, код ошибки)
+    """
+    seq = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        part = _parse_chunk(line)
+        yield part
+        if part[2]:
+            return
+        seq = part[0] + 1
+    yield seq, [], True, HTTPStatus.BAD_GATEWAY
+
+
+async def aiter_chunks(lines: AsyncIterable[bytes]) -> AsyncIterator[Tuple[int, list, bool, Optional[int]]]:
+    """
+    Асинхронный вариант `iter_chunks`
+
+    :param lines: Строки ответа загрузчика
+    :return: Кортежи (номер части, идентификаторы видео, признак последней части, код ошибки)
+    """
+    seq = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        part = _parse_chunk(line)
+        yield part
+        if part[2]:
+            return
+        seq = part[0] + 1
+    yield seq, [], True, HTTPStatus.BAD_GATEWAY
@@ -0,0 +1,104 @@
+"""
+Предварительная проверка видео перед загрузкой
+
+Загрузчики отвечают на `GET /api/probe?url=...` описанием видео без его скачивания::
+
+    {"status": 200, "duration": 212, "format": "22", "size": 12345678,
+     "formats": [{"id": "18", "ext": "mp4", "height": 360, "size": 5678901}, ...]}
+
+`status` - код, с которым завершилась бы загрузка: 200, 401 если видео требует авторизации, 413 если нет формата
+меньше `MAX_SIZE`. `format` - лучший подходящий формат, который передаётся в `/api/download`. Результаты хранятся
+в `TTLCache`, поэтому повторная проверка того же видео не обращается к видеохостингу.
+"""
+import threading
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Callable, Hashable, List, Optional
+
+MAX_SIZE = 1000 * 1024 * 1024  # максимальный размер видео, которое принимает локальный сервер Telegram
+
+PROBE_TTL = 600
+
+REJECTED = (HTTPStatus.UNAUTHORIZED, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с ограниченным временем жизни записей
+
+    :ivar `float` ttl: Время жизни записи, в секундах
+    :ivar `int` maxsize: Максимальное количество записей
+    """
+
+    def __init__(self, ttl: float = PROBE_TTL, maxsize: int = 4096, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable):
+        """
+        Возвращает запись
+
+        :param key: Ключ
+        :return: Значение или None, если записи нет или её время жизни истекло
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= self._clock():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value) -> None:
+        """
+        Сохраняет запись, вытесняя самую давно использованную при переполнении
+
+        :param key: Ключ
+        :param value: Значение
+        """
+        with self._lock:
+            self._items[key] = (self._clock() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+def select_format(formats: List[dict], limit: int = MAX_SIZE) -> Optional[dict]:
+    """
+    Выбирает лучший формат с известным размером меньше `limit`
+
+    :param formats: Форматы в порядке возрастания качества
+    :param limit: Максимальный размер, в байтах
+    :return: Формат или None, если подходящего нет
+    """
+    for fmt in reversed(formats):
+        if fmt.get('size') and fmt['size'] < limit:
+            return fmt
+    return None
+
+
+def probe_result(formats: List[dict], duration: Optional[int] = None, restricted: bool = False) -> dict:
+    """
+    Составляет ответ `/api/probe`
+
+    :param formats: Форматы в порядке возрастания качества
+    :param duration: Длительность видео, в секундах
+    :param restricted: Видео требует авторизации
+    :return: Описание видео
+    """
+    chosen = None if restricted else select_format(formats)
+    if restricted:
+        status = HTTPStatus.UNAUTHORIZED
+    elif chosen is None:
+        status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    else:
+        status = HTTPStatus.OK
+    return {'status': int(status), 'duration': duration, 'formats': formats,
+            'format': chosen['id'] if chosen else None, 'size': chosen['size'] if chosen else None}
@@ -0,0 +1,330 @@
+"""
+Профилирование обработчиков запросов и задач, включаемое во время работы
+
+Обработчики оборачиваются декоратором `Profiler.profile`. Пока профилирование выключено, обёртка только проверяет
+флаг и вызывает обработчик. Когда оно включено, для каждого вызова записывается время выполнения. Стеки отслеживаемых
+вызовов снимаются фоновым потоком каждые `interval` секунд. Отслеживается каждый `every`-й вызов, а при заданном
+`threshold` - все вызовы, но в профиль попадают только те, что выполнялись дольше `threshold` секунд.
+
+Профиль доступен по `/admin/profile` с заголовком `X-Admin-Token`::
+
+    GET /admin/profile                  - время обработчиков, время функций и самые частые стеки в JSON
+    GET /admin/profile?format=folded    - стеки в формате flamegraph.pl / speedscope
+    POST /admin/profile {"every": 10, "threshold": 2.5}  - включает профилирование, 0 выключает
+    DELETE /admin/profile               - очищает собранный профиль
+
+Сервисы могут добавить в ответ собственные показатели через `Profiler.expose`, например состояние автоматов защиты
+загрузчиков в Worker.
+"""
+import functools
+import hmac
+import inspect
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from common.src.logs import get_logger
+
+logger = get_logger("Profiler")
+
+ADMIN_PATH = '/admin/profile'
+
+
+class _Call:
+    """
+    Отслеживаемый вызов обработчика
+    """
+    __slots__ = ('name', 'ident', 'frame', 'start', 'sampled', 'samples')
+
+    def __init__(self, name: str, frame, sampled: bool):
+        self.name = name
+        self.ident = threading.get_ident()
+        self.frame = frame
+        self.start = time.perf_counter()
+        self.sampled = sampled
+        self.samples: Counter = Counter()
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class Profiler:
+    """
+    Семплирующий профилировщик обработчиков
+
+    :ivar `int` every: Профилируется каждый `every`-й вызов, 0 - выборка выключена
+    :ivar `float` threshold: Профилируются вызовы дольше `threshold` секунд, 0 - порог выключен
+    :ivar `float` interval: Интервал снятия стеков, в секундах
+    :ivar `bool` enabled: Профилирование включено
+    """
+
+    def __init__(self, every: int = 0, threshold: float = 0.0, interval: float = 0.005, slow: int = 100):
+        self.interval = interval
+        self.every = 0
+        self.threshold = 0.0
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._active: Dict[int, _Call] = {}
+        self._timings: Dict[str, list] = {}
+        self._stacks: Counter = Counter()
+        self._slow: deque = deque(maxlen=slow)
+        self._sampler: Optional[threading.Thread] = None
+        self._gauges: Dict[str, Callable[[], dict]] = {}
+        self.configure(every, threshold)
+
+    def configure(self, every: int = None, threshold: float = None) -> None:
+        """
+        Изменяет параметры профилирования
+
+        :param every: Профилировать каждый `every`-й вызов, 0 - выключить выборку
+        :param threshold: Профилировать вызовы дольше `threshold` секунд, 0 - выключить порог
+        """
+        if every is not None:
+            self.every = max(0, int(every))
+        if threshold is not None:
+            self.threshold = max(0.0, float(threshold))
+        self.enabled = bool(self.every or self.threshold)
+        logger.info("Profiling %s, every: %s, threshold: %s", 'enabled' if self.enabled else 'disabled', self.every,
+                    self.threshold)
+
+    def expose(self, name: str, gauge: Callable[[], dict]) -> None:
+        """
+        Добавляет показатели сервиса в ответ `/admin/profile`
+
+        :param name: Ключ показателей в ответе
+        :param gauge: Функция, возвращающая текущие показатели
+        """
+        self._gauges[name] = gauge
+
+    def profile(self, name: str) -> Callable:
+        """
+        Декоратор обработчика, поддерживает обычные функции и корутины
+
+        :param name: Имя обработчика в профиле
+        :return: Декоратор
+        """
+
+        def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    call = self._enter(name, sys._getframe())
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self._exit(call)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return func(*args, **kwargs)
+                    call = self._enter(name, sys._getframe())
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self._exit(call)
+            return wrapper
+
+        return decorator
+
+    def _enter(self, name: str, frame) -> _Call:
+        sampled = bool(self.every) and next(self._counter) % self.every == 0
+        call = _Call(name, frame, sampled)
+        if sampled or self.threshold:
+            self._active[id(call)] = call
+            if self._sampler is None or not self._sampler.is_alive():
+                self._start_sampler()
+        return call
+
+    def _exit(self, call: _Call) -> None:
+        duration = time.perf_counter() - call.start
+        slow = bool(self.threshold) and duration >= self.threshold
+        with self._lock:
+            self._active.pop(id(call), None)
+            timing = self._timings.setdefault(call.name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += duration
+            timing[2] = max(timing[2], duration)
+            if call.sampled or slow:
+                self._stacks.update(call.samples)
+            if slow:
+                self._slow.append({'name': call.name, 'duration': round(duration, 6), 'at': time.time()})
+
+    def _start_sampler(self) -> None:
+        with self._lock:
+            if self._sampler is not None and self._sampler.is_alive():
+                return
+            self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+            self._sampler.start()
+
+    def _sample(self) -> None:
+        """
+        Снимает стеки отслеживаемых вызовов, пока профилирование включено
+        """
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for call in list(self._active.values()):
+                frame = frames.get(call.ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame))
+                    if frame is call.frame:
+                        call.samples[';'.join([call.name] + stack[-2::-1])] += 1
+                        break
+                    frame = frame.f_back
+
+    def reset(self) -> None:
+        """
+        Очищает собранный профиль
+        """
+        with self._lock:
+            self._timings.clear()
+            self._stacks.clear()
+            self._slow.clear()
+
+    def stats(self, top: int = 100) -> dict:
+        """
+        Возвращает собранный профиль. Время функций оценивается по количеству снятых стеков: `self` - функция
+        выполнялась сама, `total` - вместе с вызванными ей функциями
+
+        :param top: Количество функций и стеков в ответе
+        :return: Профиль
+        """
+        with self._lock:
+            timings = {name: {'count': count, 'total': round(total, 6), 'max': round(peak, 6),
+                              'mean': round(total / count, 6)}
+                       for name, (count, total, peak) in self._timings.items()}
+            stacks = Counter(self._stacks)
+            slow = list(self._slow)
+        functions: Dict[str, list] = {}
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            for label in set(frames[1:]):
+                functions.setdefault(label, [0, 0])[1] += count
+            if len(frames) > 1:
+                functions[frames[-1]][0] += count
+        functions = dict(sorted(functions.items(), key=lambda item: -item[1][1])[:top])
+        return {'every': self.every, 'threshold': self.threshold, 'interval': self.interval,
+                'timings': timings,
+                'functions': {label: {'self': round(own * self.interval, 6), 'total': round(total * self.interval, 6)}
+                              for label, (own, total) in functions.items()},
+                'stacks': dict(stacks.most_common(top)), 'slow': slow,
+                **{name: gauge() for name, gauge in self._gauges.items()}}
+
+    def folded(self) -> str:
+        """
+        :return: Стеки в свёрнутом формате, по строке `стек количество` на стек
+        """
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.items())
+
+    def handle(self, method: str, query: str, body: bytes) -> Tuple[int, str, str]:
+        """
+        Обрабатывает запрос к `/admin/profile`
+
+        :param method: HTTP-метод
+        :param query: Строка запроса
+        :param body: Тело запроса
+        :return: Код ответа, тело и Content-Type
+        """
+        if method == 'POST':
+            try:
+                params = json.loads(body or b'{}')
+                self.configure(params.get('every'), params.get('threshold'))
+            except (ValueError, TypeError, AttributeError):
+                return HTTPStatus.BAD_REQUEST, '', 'text/plain'
+        elif method == 'DELETE':
+            self.reset()
+        if parse_qs(query).get('format') == ['folded']:
+            return HTTPStatus.OK, self.folded(), 'text/plain'
+        return HTTPStatus.OK, json.dumps(self.stats()), 'application/json'
+
+
+def authorized(token: str, header: Optional[str]) -> bool:
+    """
+    Проверяет токен администратора. Без настроенного токена доступ закрыт
+
+    :param token: Настроенный токен
+    :param header: Значение заголовка `X-Admin-Token`
+    :return: True, если доступ разрешён
+    """
+    return bool(token) and header is not None and hmac.compare_digest(token.encode(), header.encode())
+
+
+def register_admin(app, profiler: Profiler, token: str) -> None:
+    """
+    Добавляет `/admin/profile` во Flask-приложение. Без токена путь не добавляется
+
+    :param app: Flask-приложение
+    :param profiler: Профилировщик
+    :param token: Токен администратора
+    """
+    if not token:
+        return
+    from flask import Response, request
+
+    def admin_profile():
+        if not authorized(token, request.headers.get('X-Admin-Token')):
+            return Response(status=HTTPStatus.FORBIDDEN)
+        status, body, content_type = profiler.handle(request.method, request.query_string.decode(),
+                                                     request.get_data())
+        return Response(body, status=status, content_type=content_type)
+
+    app.add_url_rule(ADMIN_PATH, view_func=admin_profile, methods=['GET', 'POST', 'DELETE'])
+
+
+def serve_admin(profiler: Profiler, port: int, token: str, host: str = '0.0.0.0') -> Optional[ThreadingHTTPServer]:
+    """
+    Запускает в фоновом потоке HTTP-сервер с `/admin/profile` для сервисов без собственного HTTP-сервера
+
+    :param profiler: Профилировщик
+    :param port: Порт
+    :param token: Токен администратора, без него сервер не запускается
+    :param host: Адрес
+    :return: Сервер или None, если он не запущен
+    """
+    if not token or not port:
+        return None
+
+    class AdminHandler(BaseHTTPRequestHandler):
+        def _handle(self):
+            url = urlparse(self.path)
+            if url.path != ADMIN_PATH:
+                status, body, content_type = HTTPStatus.NOT_FOUND, '', 'text/plain'
+            elif not authorized(token, self.headers.get('X-Admin-Token')):
+                status, body, content_type = HTTPStatus.FORBIDDEN, '', 'text/plain'
+            else:
+                length = int(self.headers.get('Content-Length') or 0)
+                status, body, content_type = profiler.handle(self.command, url.query, self.rfile.read(length))
+            data = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_DELETE = _handle
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), AdminHandler)
+    threading.Thread(target=server.serve_forever, name='profiler-admin', daemon=True).start()
+    logger.info("Profiler admin endpoint on %s:%s%s", host, port, ADMIN_PATH)
+    return server
@@ -0,0 +1,314 @@
+"""
+Публикация сообщений в RabbitMQ из нескольких потоков через одно соединение
+
+Сообщения публикуются из фонового потока с циклом событий `pika.SelectConnection`. Подтверждения доставки
+(publisher confirms) обрабатываются конвейером: поток не ждёт подтверждения каждого сообщения, а держит
+до `max_inflight` неподтверждённых сообщений и завершает их Future, когда брокер подтверждает или отклоняет их
+по номеру доставки (`delivery_tag`, в том числе сразу несколько с флагом `multiple`).
+"""
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Deque, Dict, NoReturn, Optional, Iterable, Tuple
+
+import pika
+from pika.exceptions import AMQPError, NackError
+from pika.spec import Basic, BasicProperties
+
+from common.src.logs import get_logger
+
+logger = get_logger("Publisher")
+
+Message = Tuple[str, str, bytes, Optional[BasicProperties], Future]
+
+
+class Publisher:
+    """
+    Потокобезопасный издатель сообщений. Принимает сообщения из любых потоков через очередь и публикует их из одного
+    фонового потока, не дожидаясь подтверждения предыдущих. При потере соединения переподключается и повторяет
+    отправку неподтверждённых сообщений. Отклонённое брокером сообщение публикуется повторно через
+    `reconnect_delay` секунд, после `max_attempts` отказов отбрасывается: его Future завершается ошибкой `NackError`.
+    Повторно публикуемые сообщения могут обогнать более поздние
+
+    :ivar `str` host: Хост RabbitMQ
+    :ivar `int` port: Порт RabbitMQ
+    :ivar `tuple[str]` queues: Очереди, объявляемые при каждом подключении
+    :ivar `int` max_inflight: Максимальное число опубликованных, но ещё не подтверждённых брокером сообщений
+    :ivar `int` heartbeat: Интервал heartbeat соединения, в секундах
+    :ivar `float` reconnect_delay: Пауза перед повторным подключением и повторной публикацией, в секундах
+    :ivar `int` max_attempts: Количество попыток публикации сообщения, отклонённого брокером
+    """
+
+    def __init__(self, host: str, port: int, queues: Iterable[str] = (), max_inflight: int = 100,
+                 heartbeat: int = 60, reconnect_delay: float = 1.0, max_attempts: int = 5):
+        self.host = host
+        self.port = int(port)
+        self.queues = tuple(queues)
+        self.max_inflight = max(max_inflight, 1)
+        self.heartbeat = heartbeat
+        self.reconnect_delay = reconnect_delay
+        self.max_attempts = max(max_attempts, 1)
+        self._arguments: Dict[str, Optional[dict]] = {name: None for name in self.queues}
+        self._undeclared: set = set()
+        self._lock = threading.Lock()
+        self._messages: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._connection: Optional[pika.SelectConnection] = None
+        self._channel = None
+        self._waking = False
+        # состояние ниже меняется только в фоновом потоке
+        self._retry: Deque[Message] = deque()
+        self._delayed: Deque[Tuple[float, Message]] = deque()
+        self._pending: Dict[int, Message] = {}
+        self._rejections: Dict[Future, int] = {}
+        self._tag = 0
+        self._timer = None
+        self._ready = False
+        self._declaring = False
+        self._stopping = False
+
+    def start(self) -> NoReturn:
+        """
+        Запускает фоновый поток публикации, повторный вызов ничего не делает
+        """
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='publisher', daemon=True)
+        self._thread.start()
+
+    def declare(self, name: str, arguments: Optional[dict] = None) -> NoReturn:
+        """
+        Добавляет очередь, объявляемую перед первой публикацией в неё и при каждом подключении. Повторный вызов
+        ничего не делает
+
+        :param name: Имя очереди
+        :param arguments: Аргументы очереди, например `x-message-ttl`
+        """
+        with self._lock:
+            if name not in self._arguments:
+                self._arguments[name] = arguments
+                self._undeclared.add(name)
+
+    def publish(self, routing_key: str, body: bytes, properties: BasicProperties = None,
+                exchange: str = '') -> Future:
+        """
+        Добавляет сообщение в очередь на публикацию
+
+        :param routing_key: Ключ маршрутизации (имя очереди)
+        :param body: Тело сообщения
+        :param properties: Свойства сообщения
+        :param exchange: Точка обмена
+        :return: Future, которое завершается после подтверждения сообщения брокером
+        """
+        future = Future()
+        self._messages.put((exchange, routing_key, body, properties, future))
+        self._wake()
+        return future
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        """
+        Публикует уже принятые сообщения и останавливает фоновый поток
+
+        :param timeout: Максимальное время ожидания, в секундах
+        """
+        if self._thread is None:
+            return
+        self._messages.put(None)
+        self._wake()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _wake(self) -> NoReturn:
+        """
+        Просит фоновый поток опубликовать новые сообщения. Запросы, поступившие до их обработки, объединяются
+        """
+        with self._lock:
+            if self._waking or self._connection is None:
+                return
+            self._waking = True
+            connection = self._connection
+        connection.ioloop.add_callback_threadsafe(self._flush)
+
+    def _run(self) -> NoReturn:
+        """
+        Основной цикл фонового потока: подключается и выполняет цикл событий соединения до его закрытия
+        """
+        while True:
+            connection = pika.SelectConnection(
+                pika.ConnectionParameters(host=self.host, port=self.port, heartbeat=self.heartbeat),
+                on_open_callback=self._on_connection_open, on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed)
+            with self._lock:
+                self._connection = connection
+                self._waking = False
+            try:
+                connection.ioloop.start()
+            finally:
+                with self._lock:
+                    self._connection = None
+                connection.ioloop.close()
+            if self._stopping and self._idle():
+                break
+            time.sleep(self.reconnect_delay)
+        logger.info("Publisher stopped")
+
+    def _on_connection_open(self, connection: pika.SelectConnection) -> NoReturn:
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection: pika.SelectConnection, error: Exception) -> NoReturn:
+        logger.warning("Connection failed, reconnecting: %s, %s", error.__class__.__name__, error)
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection: pika.SelectConnection, reason: Exception) -> NoReturn:
+        """
+        Возвращает неподтверждённые сообщения в начало очереди повторной публикации и останавливает цикл событий
+        """
+        self._ready = False
+        self._declaring = False
+        self._channel = None
+        self._timer = None
+        self._retry.extendleft(reversed(list(self._pending.values())))
+        self._pending.clear()
+        if not (self._stopping and self._idle()):
+            logger.warning("Connection lost, reconnecting: %s, %s", reason.__class__.__name__, reason)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel) -> NoReturn:
+        """
+        Объявляет очереди и включает режим подтверждений. Запросы канала выполняются по порядку, поэтому
+        подтверждение режима приходит после объявления всех очередей
+        """
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        with self._lock:
+            arguments = dict(self._arguments)
+            self._undeclared.clear()
+        for name, args in arguments.items():
+            channel.queue_declare(name, arguments=args, callback=lambda frame: None)
+        channel.confirm_delivery(self._on_confirm, callback=self._on_ready)
+
+    def _on_channel_closed(self, channel, reason: Exception) -> NoReturn:
+        self._ready = False
+        if self._connection is not None and self._connection.is_open:
+            logger.warning("Channel closed: %s, %s", reason.__class__.__name__, reason)
+            self._connection.close()
+
+    def _on_ready(self, frame) -> NoReturn:
+        self._tag = 0
+        self._ready = True
+        logger.info("Connected to %s:%s", self.host, self.port)
+        self._flush()
+
+    def _on_declared(self, frame) -> NoReturn:
+        self._declaring = False
+        self._flush()
+
+    def _on_timer(self) -> NoReturn:
+        self._timer = None
+        self._flush()
+
+    def _next(self) -> Optional[Message]:
+        """
+        :return: Следующее сообщение для публикации: сначала повторные, затем новые. None, если сообщений нет
+        """
+        if self._retry:
+            return self._retry.popleft()
+        while True:
+            try:
+                item = self._messages.get_nowait()
+            except queue.Empty:
+                return None
+            if item is None:
+                self._stopping = True
+                continue
+            return item
+
+    def _idle(self) -> bool:
+        """
+        :return: True, если все принятые сообщения подтверждены брокером или отброшены
+        """
+        return not (self._pending or self._retry or self._delayed) and self._messages.empty()
+
+    def _flush(self) -> NoReturn:
+        """
+        Публикует сообщения, пока неподтверждённых меньше `max_inflight`. Очередь, объявленная через `declare`,
+        объявляется перед первой публикацией в неё; публикация продолжается после ответа брокера
+        """
+        with self._lock:
+            self._waking = False
+        if not self._ready or self._declaring:
+            return
+        self._release_delayed()
+        while len(self._pending) < self.max_inflight:
+            message = self._next()
+            if message is None:
+                break
+            exchange, routing_key, body, properties, future = message
+            if routing_key in self._undeclared:
+                with self._lock:
+                    self._undeclared.discard(routing_key)
+                    args = self._arguments[routing_key]
+                self._retry.appendleft(message)
+                self._declaring = True
+                self._channel.queue_declare(routing_key, arguments=args, callback=self._on_declared)
+                return
+            try:
+                self._channel.basic_publish(exchange, routing_key, body, properties)
+            except AMQPError as e:
+                logger.warning("Publish failed: %s, %s", e.__class__.__name__, e)
+                self._retry.appendleft(message)
+                return
+            self._tag += 1
+            self._pending[self._tag] = message
+        if self._stopping and self._idle():
+            self._ready = False
+            self._connection.close()
+
+    def _release_delayed(self) -> NoReturn:
+        """
+        Переносит отклонённые сообщения, время повтора которых наступило, в очередь повторной публикации
+        """
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._retry.append(self._delayed.popleft()[1])
+        if self._delayed and self._timer is None:
+            self._timer = self._connection.ioloop.call_later(self._delayed[0][0] - now, self._on_timer)
+
+    def _on_confirm(self, frame) -> NoReturn:
+        """
+        Завершает Future сообщений, подтверждённых или отклонённых брокером
+
+        :param frame: Кадр `Basic.Ack` или `Basic.Nack`
+        """
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._pending else []
+        for tag in tags:
+            message = self._pending.pop(tag)
+            if isinstance(method, Basic.Ack):
+                self._rejections.pop(message[4], None)
+                message[4].set_result(True)
+            else:
+                self._reject(message)
+        self._flush()
+
+    def _reject(self, message: Message) -> NoReturn:
+        """
+        Откладывает повторную публикацию отклонённого сообщения или отбрасывает его после `max_attempts` отказов
+
+        :param message: Сообщение
+        """
+        future = message[4]
+        attempts = self._rejections.pop(future, 0) + 1
+        if attempts >= self.max_attempts:
+            logger.error("Broker rejected message to %s %s times, dropping", message[1], attempts)
+            future.set_exception(NackError([]))
+            return
+        logger.warning("Broker rejected message to %s, retrying", message[1])
+        self._rejections[future] = attempts
+        self._delayed.append((time.monotonic() + self.reconnect_delay, message))
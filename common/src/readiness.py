@@ -0,0 +1,121 @@
+"""
+Отложенная инициализация сервисов и отчёт о готовности
+
+Сервис начинает принимать соединения сразу, а медленные шаги запуска - подключения к внешним сервисам, настройку
+веб-хука, импорт тяжёлых библиотек - выполняет в фоне через `Readiness.run`. Состояние шагов доступно по HTTP::
+
+    GET /health/live    - 200, пока процесс работает
+    GET /health/ready   - 200, если все шаги выполнены, иначе 503; в теле состояние каждого шага:
+                          {"ready": false, "uptime": 1.2, "steps": {"webhook": "pending", "yt_dlp": "ok"}}
+
+Оркестратор направляет запросы на экземпляр только после готовности, а перезапускает его по `/health/live`.
+"""
+import threading
+import time
+from http import HTTPStatus
+from typing import Callable, Dict
+
+from common.src.logs import get_logger
+
+logger = get_logger("Readiness")
+
+LIVE_PATH = '/health/live'
+READY_PATH = '/health/ready'
+
+
+class Readiness:
+    """
+    Набор шагов запуска, выполняемых в фоновых потоках
+
+    :ivar `float` started: Время создания, по `time.monotonic`
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._steps: Dict[str, str] = {}
+        self._done = threading.Event()
+        self._done.set()
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return all(status == 'ok' for status in self._steps.values())
+
+    def run(self, name: str, step: Callable[[], object], retry_delay: float = 1.0,
+            max_delay: float = 30.0) -> threading.Thread:
+        """
+        Выполняет шаг в фоновом потоке, повторяя его при ошибке с растущей паузой, пока он не завершится успешно
+
+        :param name: Имя шага
+        :param step: Функция шага
+        :param retry_delay: Начальная пауза между попытками, в секундах
+        :param max_delay: Максимальная пауза между попытками, в секундах
+        :return: Поток шага
+        """
+        with self._lock:
+            self._steps[name] = 'pending'
+            self._done.clear()
+
+        def _run():
+            delay = retry_delay
+            while True:
+                start = time.monotonic()
+                try:
+                    step()
+                except Exception as e:
+                    logger.warning("Startup step %s failed, retry in %.0fs: %s, %s", name, delay,
+                                   e.__class__.__name__, e)
+                    with self._lock:
+                        self._steps[name] = f'failed: {e.__class__.__name__}'
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+                    continue
+                logger.info("Startup step %s done in %.2fs", name, time.monotonic() - start)
+                with self._lock:
+                    self._steps[name] = 'ok'
+                    if all(status == 'ok' for status in self._steps.values()):
+                        self._done.set()
+                return
+
+        thread = threading.Thread(target=_run, name=f'startup-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Ожидает выполнения всех шагов
+
+        :param timeout: Максимальное время ожидания, в секундах
+        :return: True, если все шаги выполнены
+        """
+        return self._done.wait(timeout)
+
+    def report(self) -> dict:
+        """
+        :return: Готовность, время с запуска и состояние шагов
+        """
+        with self._lock:
+            steps = dict(self._steps)
+        return {'ready': all(status == 'ok' for status in steps.values()),
+                'uptime': round(time.monotonic() - self.started, 3), 'steps': steps}
+
+
+def register_health(app, readiness: Readiness) -> None:
+    """
+    Добавляет `/health/live` и `/health/ready` во Flask-приложение
+
+    :param app: Flask-приложение
+    :param readiness: Шаги запуска сервиса
+    """
+    from flask import Response, jsonify
+
+    def health_live():
+        return Response(status=HTTPStatus.OK)
+
+    def health_ready():
+        report = readiness.report()
+        return jsonify(report), HTTPStatus.OK if report['ready'] else HTTPStatus.SERVICE_UNAVAILABLE
+
+    app.add_url_rule(LIVE_PATH, view_func=health_live, methods=['GET'])
+    app.add_url_rule(READY_PATH, view_func=health_ready, methods=['GET'])
@@ -0,0 +1,386 @@
+"""
+Планировщик исходящих сообщений телеграм-бота с соблюдением ограничений Bot API
+
+Сообщения ставятся в постоянную очередь и отправляются одним фоновым потоком не быстрее глобального ограничения
+(token bucket) и не чаще одного сообщения в `chat_interval` секунд в один чат. Ответ 429 не теряет сообщение: чат
+приостанавливается на `retry_after` секунд, после чего сообщение отправляется повторно. Сообщение удаляется из очереди
+только после успешной отправки или ошибки, которую повтор не исправит.
+
+При нескольких процессах обработчика бота отправляет только один из них - тот, кто удерживает аренду в Redis, поэтому
+глобальное ограничение соблюдается для всего бота. Очередь в памяти (`MemorySendQueue`) допустима только при одном
+процессе: `create_send_queue` отказывается создавать её для нескольких.
+
+Из постоянной очереди в расписание за один проход переносится не больше `pull_batch` сообщений, и всего в
+расписании не больше `max_scheduled`, поэтому большая очередь не задерживает отправку и не переносится в память
+процесса целиком.
+"""
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, NoReturn, Optional, Tuple
+
+from requests import RequestException
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+from telebot.types import ReplyParameters
+
+from common.src.logs import get_logger
+
+logger = get_logger("Send Scheduler")
+
+
+class TokenBucket:
+    """
+    Глобальное ограничение частоты отправки
+
+    :ivar `float` rate: Скорость пополнения, токенов в секунду
+    :ivar `float` capacity: Максимальное количество накопленных токенов
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated: Optional[float] = None
+
+    def take(self, now: float) -> float:
+        """
+        Забирает токен, если он есть
+
+        :param now: Текущее время
+        :return: 0, если токен получен, иначе время в секундах до появления токена
+        """
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class MemorySendQueue:
+    """
+    Очередь сообщений в памяти процесса для запуска одного экземпляра и тестов. Аренда отправителя всегда
+    принадлежит процессу, поэтому при нескольких процессах каждый соблюдал бы ограничение Bot API отдельно
+    """
+
+    def __init__(self):
+        self._pending = deque()
+        self._processing = []
+        self._cond = threading.Condition()
+
+    def push(self, raw: bytes) -> None:
+        with self._cond:
+            self._pending.append(raw)
+            self._cond.notify()
+
+    def pop(self, timeout: float) -> Optional[bytes]:
+        with self._cond:
+            if not self._pending and timeout > 0:
+                self._cond.wait(timeout)
+            if not self._pending:
+                return None
+            raw = self._pending.popleft()
+            self._processing.append(raw)
+            return raw
+
+    def ack(self, raw: bytes) -> None:
+        with self._cond:
+            self._processing.remove(raw)
+
+    def recover(self) -> int:
+        with self._cond:
+            count = len(self._processing)
+            self._pending.extendleft(reversed(self._processing))
+            self._processing.clear()
+            return count
+
+    def lead(self, owner: str, lease: float) -> bool:
+        return True
+
+
+class RedisSendQueue:
+    """
+    Постоянная очередь сообщений в Redis. Взятое сообщение переносится в список обрабатываемых и удаляется из него
+    после подтверждения, поэтому при падении отправителя оно возвращается в очередь следующим отправителем
+
+    :ivar `redis.Redis` redis: Клиент Redis
+    :ivar `str` prefix: Префикс ключей
+    """
+
+    def __init__(self, redis, prefix: str = 'tbot_outbox:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def push(self, raw: bytes) -> None:
+        self.redis.lpush(self.prefix + 'pending', raw)
+
+    def pop(self, timeout: float) -> Optional[bytes]:
+        if timeout > 0:
+            return self.redis.blmove(self.prefix + 'pending', self.prefix + 'processing', timeout, 'RIGHT', 'LEFT')
+        return self.redis.lmove(self.prefix + 'pending', self.prefix + 'processing', 'RIGHT', 'LEFT')
+
+    def ack(self, raw: bytes) -> None:
+        self.redis.lrem(self.prefix + 'processing', 1, raw)
+
+    def recover(self) -> int:
+        count = 0
+        while self.redis.lmove(self.prefix + 'processing', self.prefix + 'pending', 'LEFT', 'RIGHT') is not None:
+            count += 1
+        return count
+
+    def lead(self, owner: str, lease: float) -> bool:
+        """
+        Захватывает или продлевает аренду отправителя
+
+        :param owner: Идентификатор процесса
+        :param lease: Срок аренды, в секундах
+        :return: True, если процесс является отправителем
+        """
+        key = self.prefix + 'leader'
+        if self.redis.set(key, owner, nx=True, px=int(lease * 1000)):
+            return True
+        current = self.redis.get(key)
+        if current is not None and current.decode() == owner:
+            self.redis.pexpire(key, int(lease * 1000))
+            return True
+        return False
+
+
+class SendScheduler:
+    """
+    Планировщик отправки сообщений бота
+
+    :ivar `telebot.TeleBot` bot: Бот, через которого отправляются сообщения
+    :ivar queue: Постоянная очередь сообщений (`MemorySendQueue` или `RedisSendQueue`)
+    :ivar `TokenBucket` bucket: Глобальное ограничение частоты
+    :ivar `float` chat_interval: Минимальный интервал между сообщениями в личный чат, в секундах
+    :ivar `float` group_interval: Минимальный интервал между сообщениями в группу, в секундах
+    :ivar `int` max_attempts: Количество попыток при сетевых ошибках и ошибках сервера
+    :ivar `float` lease: Срок аренды отправителя, в секундах
+    :ivar `int` pull_batch: Максимальное количество сообщений, переносимых из очереди в расписание за один проход
+    :ivar `int` max_scheduled: Максимальное количество сообщений в расписании
+    """
+
+    def __init__(self, bot: TeleBot, queue, rate: float = 30, chat_interval: float = 1.0,
+                 group_interval: float = 3.0, max_attempts: int = 5, lease: float = 10.0,
+                 pull_batch: int = 100, max_scheduled: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.bot = bot
+        self.queue = queue
+        self.bucket = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.pull_batch = max(pull_batch, 1)
+        self.max_scheduled = max(max_scheduled, 1)
+        self._clock = clock
+        self._owner = f'{os.getpid()}-{uuid.uuid4().hex}'
+        self._leading = False
+        self._scheduled: List[Tuple[float, int, bytes, dict]] = []
+        self._order = itertools.count()
+        self._chat_ready: Dict[int, float] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, method: str, chat_id: int, *args, reply_to: int = None, **kwargs) -> None:
+        """
+        Ставит сообщение в очередь на отправку
+
+        :param method: Метод `TeleBot`, например `send_video`
+        :param chat_id: Идентификатор чата
+        :param args: Позиционные аргументы метода после `chat_id`
+        :param reply_to: Идентификатор сообщения, на которое отвечает бот
+        :param kwargs: Именованные аргументы метода
+        """
+        job = {'id': uuid.uuid4().hex, 'method': method, 'chat_id': chat_id, 'args': list(args),
+               'kwargs': kwargs, 'reply_to': reply_to}
+        self.queue.push(json.dumps(job).encode())
+
+    def start(self) -> NoReturn:
+        """
+        Запускает фоновый поток отправки, повторный вызов ничего не делает
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        """
+        Останавливает фоновый поток. Неотправленные сообщения остаются в очереди
+
+        :param timeout: Максимальное время ожидания потока, в секундах
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> NoReturn:
+        while not self._stop.is_set():
+            try:
+                if not self._ensure_leader():
+                    self._stop.wait(self.lease / 2)
+                    continue
+                self.step()
+            except Exception as e:
+                logger.exception("Send loop failed: %s", e)
+                self._stop.wait(1)
+
+    def step(self) -> int:
+        """
+        Переносит в расписание до `pull_batch` сообщений и отправляет те, время которых подошло. Первое сообщение
+        ожидается не дольше, чем до ближайшей отправки по расписанию
+
+        :return: Количество отправленных сообщений
+        """
+        now = self._clock()
+        wait = min(max(self._scheduled[0][0] - now, 0), self.lease / 2) if self._scheduled else self.lease / 2
+        if len(self._scheduled) >= self.max_scheduled:
+            self._stop.wait(wait)
+        else:
+            for _ in range(self.pull_batch):
+                if len(self._scheduled) >= self.max_scheduled or not self.pull(wait):
+                    break
+                wait = 0
+        return self.send_due(self._clock())
+
+    def _ensure_leader(self) -> bool:
+        """
+        Продлевает аренду отправителя. Получив аренду, возвращает в очередь сообщения, взятые прошлым отправителем
+
+        :return: True, если этот процесс отправляет сообщения
+        """
+        leading = self.queue.lead(self._owner, self.lease)
+        if leading and not self._leading:
+            self._scheduled.clear()
+            recovered = self.queue.recover()
+            if recovered:
+                logger.info("Recovered %s unsent messages", recovered)
+        self._leading = leading
+        return leading
+
+    def pull(self, timeout: float) -> bool:
+        """
+        Забирает одно сообщение из постоянной очереди в расписание отправки
+
+        :param timeout: Максимальное время ожидания сообщения, в секундах
+        :return: True, если сообщение получено
+        """
+        raw = self.queue.pop(timeout)
+        if raw is None:
+            return False
+        try:
+            job = json.loads(raw)
+        except ValueError:
+            logger.error("Dropping malformed message %r", raw)
+            self.queue.ack(raw)
+            return True
+        self._schedule(self._clock(), raw, job)
+        return True
+
+    def _schedule(self, at: float, raw: bytes, job: dict) -> None:
+        heapq.heappush(self._scheduled, (at, next(self._order), raw, job))
+
+    def send_due(self, now: float) -> int:
+        """
+        Отправляет сообщения, время которых подошло, с учётом ограничений чатов и глобального ограничения
+
+        :param now: Текущее время
+        :return: Количество отправленных сообщений
+        """
+        sent = 0
+        while self._scheduled and self._scheduled[0][0] <= now:
+            _, _, raw, job = heapq.heappop(self._scheduled)
+            chat_id = job['chat_id']
+            ready = self._chat_ready.get(chat_id, 0)
+            if ready > now:
+                self._schedule(ready, raw, job)
+                continue
+            delay = self.bucket.take(now)
+            if delay > 0:
+                self._schedule(now + delay, raw, job)
+                break
+            if self._send(now, raw, job):
+                sent += 1
+        if len(self._chat_ready) > 10000:
+            self._chat_ready = {chat: ready for chat, ready in self._chat_ready.items() if ready > now}
+        return sent
+
+    def _send(self, now: float, raw: bytes, job: dict) -> bool:
+        """
+        Отправляет одно сообщение и решает судьбу сообщения при ошибке
+
+        :param now: Текущее время
+        :param raw: Сообщение в виде, в котором оно хранится в очереди
+        :param job: Разобранное сообщение
+        :return: True, если сообщение отправлено
+        """
+        chat_id = job['chat_id']
+        kwargs = dict(job['kwargs'])
+        if job.get('reply_to') is not None:
+            kwargs['reply_parameters'] = ReplyParameters(job['reply_to'], chat_id, True)
+        interval = self.group_interval if chat_id < 0 else self.chat_interval
+        try:
+            getattr(self.bot, job['method'])(chat_id, *job['args'], **kwargs)
+        except ApiTelegramException as e:
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after')
+            if e.error_code == 429:
+                retry_after = float(retry_after or interval)
+                logger.warning("Rate limited in chat %s, retry after %ss", chat_id, retry_after)
+                self._chat_ready[chat_id] = now + retry_after
+                self._schedule(now + retry_after, raw, job)
+            elif e.error_code >= 500:
+                self._retry(now, raw, job, e)
+            else:
+                logger.error("Dropping message %s to chat %s: %s", job['id'], chat_id, e)
+                self.queue.ack(raw)
+            return False
+        except RequestException as e:
+            self._retry(now, raw, job, e)
+            return False
+        self._chat_ready[chat_id] = now + interval
+        self.queue.ack(raw)
+        return True
+
+    def _retry(self, now: float, raw: bytes, job: dict, error: Exception) -> None:
+        """
+        Повторяет отправку с экспоненциальной задержкой или отбрасывает сообщение после `max_attempts` попыток
+
+        :param now: Текущее время
+        :param raw: Сообщение в виде, в котором оно хранится в очереди
+        :param job: Разобранное сообщение
+        :param error: Ошибка отправки
+        """
+        job['attempt'] = job.get('attempt', 0) + 1
+        if job['attempt'] >= self.max_attempts:
+            logger.error("Dropping message %s to chat %s after %s attempts: %s", job['id'], job['chat_id'],
+                         job['attempt'], error)
+            self.queue.ack(raw)
+            return
+        logger.warning("Send to chat %s failed, attempt %s: %s", job['chat_id'], job['attempt'], error)
+        self._schedule(now + 2 ** job['attempt'], raw, job)
+
+
+def create_send_queue(url: str = '', processes: int = 1):
+    """
+    Создаёт очередь исходящих сообщений
+
+    :param url: Адрес Redis вида `redis://host:port/db`. Если не задан, очередь хранится в памяти процесса
+    :param processes: Количество процессов обработчика бота
+    :return: Очередь сообщений
+    :raises ValueError: Если адрес Redis не задан, а процессов больше одного
+    """
+    if not url:
+        if processes > 1:
+            raise ValueError(f"Memory send queue supports one process, got {processes}: set a Redis url")
+        return MemorySendQueue()
+    from redis import Redis
+
+    return RedisSendQueue(Redis.from_url(url))
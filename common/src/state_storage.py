@@ -0,0 +1,208 @@
+"""
+Хранилища состояний диалогов телеграм-бота с ограниченным временем жизни
+
+`RedisStateStorage` хранит состояния в Redis и позволяет нескольким экземплярам обработчика бота вести один и тот же
+диалог, а также переживает их перезапуск. `TTLMemoryStorage` хранит состояния в памяти процесса и используется
+в тестах и при запуске одного экземпляра. Оба хранилища удаляют диалог, если в нём не было изменений дольше `ttl`
+секунд.
+"""
+import json
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from telebot.storage import StateStorageBase, StateContext
+
+DEFAULT_TTL = 3600
+
+
+def _state_name(state) -> str:
+    """
+    Возвращает имя состояния
+
+    :param state: Состояние `telebot.handler_backends.State` или его имя
+    :return: Имя состояния
+    """
+    return state.name if hasattr(state, 'name') else state
+
+
+class TTLMemoryStorage(StateStorageBase):
+    """
+    Хранилище состояний в памяти процесса с истечением срока жизни записей
+
+    :ivar `int` ttl: Время жизни диалога без изменений, в секундах
+    """
+
+    def __init__(self, ttl: int = DEFAULT_TTL, clock: Callable[[], float] = time.monotonic) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._records: Dict[Tuple[int, int], Tuple[float, dict]] = {}
+
+    def _get(self, chat_id: int, user_id: int) -> Optional[dict]:
+        """
+        Возвращает запись диалога, удаляя её, если срок жизни истёк. Вызывается под блокировкой
+
+        :param chat_id: Идентификатор чата
+        :param user_id: Идентификатор пользователя
+        :return: Запись вида {'state': ..., 'data': {...}} или None
+        """
+        item = self._records.get((chat_id, user_id))
+        if item is None:
+            return None
+        expires, record = item
+        if expires <= self._clock():
+            del self._records[(chat_id, user_id)]
+            return None
+        return record
+
+    def _put(self, chat_id: int, user_id: int, record: dict) -> None:
+        """
+        Сохраняет запись диалога и продлевает срок её жизни. Вызывается под блокировкой
+
+        :param chat_id: Идентификатор чата
+        :param user_id: Идентификатор пользователя
+        :param record: Запись диалога
+        """
+        self._records[(chat_id, user_id)] = (self._clock() + self.ttl, record)
+
+    def set_state(self, chat_id, user_id, state) -> bool:
+        with self._lock:
+            record = self._get(chat_id, user_id) or {'data': {}}
+            record['state'] = _state_name(state)
+            self._put(chat_id, user_id, record)
+        return True
+
+    def delete_state(self, chat_id, user_id) -> bool:
+        with self._lock:
+            exists = self._get(chat_id, user_id) is not None
+            self._records.pop((chat_id, user_id), None)
+        return exists
+
+    def get_state(self, chat_id, user_id) -> Optional[str]:
+        with self._lock:
+            record = self._get(chat_id, user_id)
+        return record['state'] if record else None
+
+    def get_data(self, chat_id, user_id) -> Optional[dict]:
+        with self._lock:
+            record = self._get(chat_id, user_id)
+        return record['data'] if record else None
+
+    def reset_data(self, chat_id, user_id) -> bool:
+        with self._lock:
+            record = self._get(chat_id, user_id)
+            if record is None:
+                return False
+            record['data'] = {}
+            self._put(chat_id, user_id, record)
+        return True
+
+    def set_data(self, chat_id, user_id, key, value) -> bool:
+        with self._lock:
+            record = self._get(chat_id, user_id)
+            if record is None:
+                raise RuntimeError(f'chat_id {chat_id} and user_id {user_id} does not exist')
+            record['data'][key] = value
+            self._put(chat_id, user_id, record)
+        return True
+
+    def get_interactive_data(self, chat_id, user_id) -> StateContext:
+        return StateContext(self, chat_id, user_id)
+
+    def save(self, chat_id, user_id, data) -> None:
+        with self._lock:
+            record = self._get(chat_id, user_id)
+            if record is not None:
+                record['data'] = data
+                self._put(chat_id, user_id, record)
+
+
+class RedisStateStorage(StateStorageBase):
+    """
+    Хранилище состояний в Redis. Диалог хранится в хэше `<prefix><chat_id>:<user_id>` с полями `state` и `data`
+    (JSON), каждое изменение продлевает время жизни ключа
+
+    :ivar `redis.Redis` redis: Клиент Redis
+    :ivar `int` ttl: Время жизни диалога без изменений, в секундах
+    :ivar `str` prefix: Префикс ключей
+    """
+
+    def __init__(self, redis, ttl: int = DEFAULT_TTL, prefix: str = 'tbot_state:') -> None:
+        super().__init__()
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, chat_id: int, user_id: int) -> str:
+        return f'{self.prefix}{chat_id}:{user_id}'
+
+    def _write(self, key: str, mapping: dict) -> None:
+        """
+        Записывает поля диалога и продлевает время жизни ключа одной транзакцией
+
+        :param key: Ключ диалога
+        :param mapping: Изменяемые поля
+        """
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def set_state(self, chat_id, user_id, state) -> bool:
+        key = self._key(chat_id, user_id)
+        mapping = {'state': _state_name(state)}
+        if not self.redis.hexists(key, 'data'):
+            mapping['data'] = '{}'
+        self._write(key, mapping)
+        return True
+
+    def delete_state(self, chat_id, user_id) -> bool:
+        return self.redis.delete(self._key(chat_id, user_id)) > 0
+
+    def get_state(self, chat_id, user_id) -> Optional[str]:
+        state = self.redis.hget(self._key(chat_id, user_id), 'state')
+        return state.decode() if isinstance(state, bytes) else state
+
+    def get_data(self, chat_id, user_id) -> Optional[dict]:
+        data = self.redis.hget(self._key(chat_id, user_id), 'data')
+        return json.loads(data) if data is not None else None
+
+    def reset_data(self, chat_id, user_id) -> bool:
+        key = self._key(chat_id, user_id)
+        if not self.redis.exists(key):
+            return False
+        self._write(key, {'data': '{}'})
+        return True
+
+    def set_data(self, chat_id, user_id, key, value) -> bool:
+        data = self.get_data(chat_id, user_id)
+        if data is None:
+            raise RuntimeError(f'chat_id {chat_id} and user_id {user_id} does not exist')
+        data[key] = value
+        self._write(self._key(chat_id, user_id), {'data': json.dumps(data)})
+        return True
+
+    def get_interactive_data(self, chat_id, user_id) -> StateContext:
+        return StateContext(self, chat_id, user_id)
+
+    def save(self, chat_id, user_id, data) -> None:
+        key = self._key(chat_id, user_id)
+        if self.redis.exists(key):
+            self._write(key, {'data': json.dumps(data)})
+
+
+def create_state_storage(url: str = '', ttl: int = DEFAULT_TTL) -> StateStorageBase:
+    """
+    Создаёт хранилище состояний
+
+    :param url: Адрес Redis вида `redis://host:port/db`. Если не задан, состояния хранятся в памяти процесса
+    :param ttl: Время жизни диалога без изменений, в секундах
+    :return: Хранилище состояний
+    """
+    if not url:
+        return TTLMemoryStorage(ttl)
+    from redis import Redis
+
+    return RedisStateStorage(Redis.from_url(url), ttl)
@@ -0,0 +1,434 @@
+"""
+Транспорт сообщений между Loader и Worker
+
+Loader и Worker обмениваются сообщениями `common.src.messages` через очереди `task_queue` и `answer_queue`, не
+зная, как они доставляются. Транспорт выбирается адресом `TRANSPORT_URL`::
+
+    amqp://broker:5672  - RabbitMQ, сообщения кодируются `encode` и переживают перезапуск сервисов
+    memory://           - очереди в памяти процесса: Loader и Worker запускаются одним процессом
+                          (`src.standalone.standalone`), сообщения передаются объектами без кодирования
+
+Обработчик получает сообщение и функцию подтверждения `ack`. При `prefetch` больше нуля обработчику выдаётся не больше
+`prefetch` неподтверждённых сообщений, и каждое нужно подтвердить вызовом `ack` из любого потока. При нулевом
+`prefetch` сообщения подтверждаются сразу. Очереди в памяти не сохраняются: неподтверждённые и не полученные
+сообщения теряются при остановке процесса.
+
+Очередь, объявленная `consume` с `expires`, удаляется брокером, если её никто не получает `expires` секунд. Так
+устроены очереди ответов экземпляров Loader: задача несёт имя очереди в `reply_to`, Worker публикует ответ туда, и
+после остановки экземпляра его очередь не остаётся у брокера навсегда.
+
+`stats` возвращает число сообщений, ожидающих в очереди, и число её получателей. По ним Loader оценивает время
+ожидания новых задач и не ставит их при перегрузке (`common.src.admission`), а фоновые задачи низкого приоритета,
+например предварительная загрузка популярных видео, ставит только когда Worker-ы успевают разбирать очередь.
+
+`defer` возвращает сообщение в очередь через `delay` секунд, не удерживая его у получателя. В RabbitMQ сообщение
+ждёт в очереди отложенных сообщений (`deferred_queue`) с `x-message-ttl`, по истечении которого брокер
+перекладывает его в исходную очередь (`x-dead-letter-routing-key`). Так Worker откладывает задачи хостинга
+с разомкнутым автоматом защиты: задача остаётся у брокера и не теряется при падении процесса.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, NamedTuple, NoReturn, Optional, Tuple
+from urllib.parse import urlparse
+
+import pika
+from pika.exceptions import AMQPError, ChannelClosedByBroker
+
+from common.src.consumer import Consumer
+from common.src.logs import get_logger
+from common.src.messages import Message, MessageError, PROPERTIES, encode, decode
+from common.src.publisher import Publisher
+
+logger = get_logger("Transport")
+
+Handler = Callable[[Message, Callable[[], None]], None]
+
+
+def deferred_queue(queue_name: str, delay: float, key: str = '') -> str:
+    """
+    :param queue_name: Имя очереди, в которую возвращаются сообщения
+    :param delay: Задержка, в секундах
+    :param key: Группа отложенных сообщений, например видео-хостинг
+    :return: Имя очереди отложенных сообщений. Задержка входит в имя, потому что аргументы существующей очереди
+        RabbitMQ изменить нельзя
+    """
+    return f"{queue_name}.deferred.{key + '.' if key else ''}{int(delay * 1000)}ms"
+
+
+def deferred_arguments(queue_name: str, delay: float) -> dict:
+    """
+    :param queue_name: Имя очереди, в которую возвращаются сообщения
+    :param delay: Задержка, в секундах
+    :return: Аргументы очереди RabbitMQ, возвращающей сообщения в `queue_name` через `delay` секунд
+    """
+    return {'x-message-ttl': int(delay * 1000), 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': queue_name}
+
+
+class QueueStats(NamedTuple):
+    """
+    Состояние очереди
+
+    :ivar `int` depth: Число сообщений, ожидающих получения. Выданные, но не подтверждённые сообщения не учитываются
+    :ivar `int` consumers: Число получателей очереди
+    """
+    depth: int
+    consumers: int
+
+
+def _once(func: Callable[[], None]) -> Callable[[], None]:
+    """
+    Оборачивает подтверждение, чтобы повторный вызов ничего не делал
+
+    :param func: Функция подтверждения
+    :return: Функция, выполняющая `func` не больше одного раза
+    """
+    lock = threading.Lock()
+
+    def wrapper() -> None:
+        if lock.acquire(blocking=False):
+            func()
+
+    return wrapper
+
+
+class Transport:
+    """
+    Базовый класс транспорта
+    """
+
+    def start(self) -> NoReturn:
+        """
+        Запускает публикацию и получение сообщений, повторный вызов ничего не делает
+        """
+        raise NotImplementedError
+
+    def publish(self, queue_name: str, message: Message) -> Future:
+        """
+        Публикует сообщение
+
+        :param queue_name: Имя очереди
+        :param message: Сообщение
+        :return: Future, которое завершается после приёма сообщения очередью
+        """
+        raise NotImplementedError
+
+    def consume(self, queue_name: str, handler: Handler, prefetch: int = 0, expires: float = 0) -> NoReturn:
+        """
+        Подписывает обработчик на очередь. Если транспорт уже запущен, получение начинается сразу
+
+        :param queue_name: Имя очереди
+        :param handler: Обработчик с сигнатурой (message, ack)
+        :param prefetch: Максимальное число неподтверждённых сообщений, 0 - подтверждать сразу
+        :param expires: Время, через которое неиспользуемая очередь удаляется, в секундах, 0 - не удаляется
+        """
+        raise NotImplementedError
+
+    def defer(self, queue_name: str, message: Message, delay: float, key: str = '') -> Future:
+        """
+        Публикует сообщение, которое попадёт в очередь через `delay` секунд
+
+        :param queue_name: Имя очереди
+        :param message: Сообщение
+        :param delay: Задержка, в секундах
+        :param key: Группа отложенных сообщений, у каждой своя очередь `deferred_queue`
+        :return: Future, которое завершается после приёма сообщения
+        """
+        raise NotImplementedError
+
+    def stats(self, queue_name: str) -> Optional[QueueStats]:
+        """
+        Возвращает состояние очереди
+
+        :param queue_name: Имя очереди
+        :return: Состояние очереди или None, если его не удалось узнать
+        """
+        raise NotImplementedError
+
+    def depth(self, queue_name: str) -> Optional[int]:
+        """
+        Возвращает число сообщений, ожидающих получения. Выданные, но не подтверждённые сообщения не учитываются
+
+        :param queue_name: Имя очереди
+        :return: Число сообщений или None, если его не удалось узнать
+        """
+        stats = self.stats(queue_name)
+        return stats.depth if stats is not None else None
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        """
+        Прекращает получение сообщений, ожидает подтверждения выданных и публикует уже принятые
+
+        :param timeout: Максимальное время ожидания, в секундах
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _dispatch(handler: Handler, message: Message, ack: Callable[[], None]) -> NoReturn:
+        """
+        Вызывает обработчик. Если он упал, сообщение подтверждается и отбрасывается
+
+        :param handler: Обработчик
+        :param message: Сообщение
+        :param ack: Функция подтверждения
+        """
+        ack = _once(ack)
+        try:
+            handler(message, ack)
+        except Exception as e:
+            logger.exception("Message handler failed: %s, %s", e.__class__.__name__, e)
+            ack()
+
+
+class RabbitMQTransport(Transport):
+    """
+    Транспорт через RabbitMQ: публикация через общий `Publisher`, получение через `Consumer` на каждую очередь.
+    Состояние очередей (`stats`) читается через одно долгоживущее соединение, которое открывается при первом
+    обращении и переоткрывается после обрыва
+
+    :ivar `str` host: Хост RabbitMQ
+    :ivar `int` port: Порт RabbitMQ
+    :ivar `common.src.publisher.Publisher` publisher: Издатель сообщений
+    """
+
+    def __init__(self, host: str, port: int, queues: Iterable[str] = ()):
+        self.host = host
+        self.port = int(port)
+        self.publisher = Publisher(host, port, queues=queues)
+        self._consumers: List[Consumer] = []
+        self._started = False
+        self._stats_lock = threading.Lock()
+        self._stats_connection: Optional[pika.BlockingConnection] = None
+        self._stats_channel = None
+
+    def start(self) -> NoReturn:
+        self._started = True
+        self.publisher.start()
+        for consumer in self._consumers:
+            consumer.start()
+
+    def publish(self, queue_name: str, message: Message) -> Future:
+        return self.publisher.publish(queue_name, encode(message), PROPERTIES)
+
+    def defer(self, queue_name: str, message: Message, delay: float, key: str = '') -> Future:
+        name = deferred_queue(queue_name, delay, key)
+        self.publisher.declare(name, deferred_arguments(queue_name, delay))
+        return self.publish(name, message)
+
+    def consume(self, queue_name: str, handler: Handler, prefetch: int = 0, expires: float = 0) -> NoReturn:
+        consumer = Consumer(self.host, self.port, queue_name, None, prefetch=prefetch,
+                            arguments={'x-expires': int(expires * 1000)} if expires else None)
+
+        def _deliver(channel, method, properties, body: bytes) -> NoReturn:
+            ack = (lambda: consumer.ack(channel, method.delivery_tag)) if prefetch else (lambda: None)
+            try:
+                message = decode(body)
+            except MessageError as e:
+                logger.error("Skip message: %s", e)
+                ack()
+                return
+            self._dispatch(handler, message, ack)
+
+        consumer.callback = _deliver
+        self._consumers.append(consumer)
+        if self._started:
+            consumer.start()
+
+    def stats(self, queue_name: str) -> Optional[QueueStats]:
+        with self._stats_lock:
+            for attempt in range(2):
+                try:
+                    method = self._channel().queue_declare(queue_name, passive=True).method
+                    return QueueStats(method.message_count, method.consumer_count)
+                except ChannelClosedByBroker as e:
+                    logger.warning("Queue %s stats are unknown: %s, %s", queue_name, e.__class__.__name__, e)
+                    return None
+                except AMQPError as e:
+                    # соединение могло быть закрыто брокером за время простоя, повторяем через новое
+                    self._close_stats()
+                    if attempt:
+                        logger.warning("Queue %s stats are unknown: %s, %s", queue_name, e.__class__.__name__, e)
+        return None
+
+    def _channel(self):
+        """
+        :return: Канал для чтения состояния очередей, при необходимости открывает соединение и канал заново
+        """
+        if self._stats_connection is None or self._stats_connection.is_closed:
+            self._stats_connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host,
+                                                                                       port=self.port))
+            self._stats_channel = None
+        if self._stats_channel is None or self._stats_channel.is_closed:
+            self._stats_channel = self._stats_connection.channel()
+        return self._stats_channel
+
+    def _close_stats(self) -> NoReturn:
+        """
+        Закрывает соединение для чтения состояния очередей
+        """
+        connection, self._stats_connection, self._stats_channel = self._stats_connection, None, None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except AMQPError:
+                pass
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        for consumer in self._consumers:
+            consumer.stop(timeout)
+        self.publisher.stop(timeout)
+        with self._stats_lock:
+            self._close_stats()
+        self._started = False
+
+
+class _Inflight:
+    """
+    Счётчик неподтверждённых сообщений подписки на очередь в памяти
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._cond:
+            if self.limit and self.count >= self.limit:
+                self._cond.wait(timeout)
+                if self.count >= self.limit:
+                    return False
+            self.count += 1
+            return True
+
+    def release(self) -> None:
+        with self._cond:
+            self.count -= 1
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: not self.count, timeout)
+
+
+class InProcessTransport(Transport):
+    """
+    Транспорт через очереди в памяти процесса. Каждая подписка получает сообщения в собственном потоке
+
+    :ivar `float` poll_interval: Период проверки остановки потоками подписок, в секундах
+    """
+
+    def __init__(self, poll_interval: float = 0.1):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._queues: Dict[str, queue.Queue] = {}
+        self._subscriptions: List[Tuple[str, Handler, _Inflight]] = []
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._started = False
+
+    def _queue(self, name: str) -> queue.Queue:
+        with self._lock:
+            if name not in self._queues:
+                self._queues[name] = queue.Queue()
+            return self._queues[name]
+
+    def start(self) -> NoReturn:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self._stopping.clear()
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            self._start(*subscription)
+
+    def publish(self, queue_name: str, message: Message) -> Future:
+        self._queue(queue_name).put(message)
+        future = Future()
+        future.set_result(True)
+        return future
+
+    def defer(self, queue_name: str, message: Message, delay: float, key: str = '') -> Future:
+        timer = threading.Timer(delay, self.publish, (queue_name, message))
+        timer.daemon = True
+        timer.start()
+        future = Future()
+        future.set_result(True)
+        return future
+
+    def consume(self, queue_name: str, handler: Handler, prefetch: int = 0, expires: float = 0) -> NoReturn:
+        subscription = (queue_name, handler, _Inflight(prefetch))
+        with self._lock:
+            self._subscriptions.append(subscription)
+            started = self._started
+        if started:
+            self._start(*subscription)
+
+    def stats(self, queue_name: str) -> Optional[QueueStats]:
+        with self._lock:
+            consumers = sum(name == queue_name for name, _, _ in self._subscriptions) if self._started else 0
+        return QueueStats(self._queue(queue_name).qsize(), consumers)
+
+    def _start(self, queue_name: str, handler: Handler, inflight: _Inflight) -> NoReturn:
+        thread = threading.Thread(target=self._run, args=(queue_name, handler, inflight),
+                                  name=f'consumer-{queue_name}', daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _run(self, queue_name: str, handler: Handler, inflight: _Inflight) -> NoReturn:
+        """
+        Выдаёт сообщения очереди обработчику, пока транспорт не остановлен
+
+        :param queue_name: Имя очереди
+        :param handler: Обработчик
+        :param inflight: Счётчик неподтверждённых сообщений подписки
+        """
+        messages = self._queue(queue_name)
+        while not self._stopping.is_set():
+            if not inflight.acquire(self.poll_interval):
+                continue
+            try:
+                message = messages.get(timeout=self.poll_interval)
+            except queue.Empty:
+                inflight.release()
+                continue
+            self._dispatch(handler, message, inflight.release if inflight.limit else lambda: None)
+            if not inflight.limit:
+                inflight.release()
+        logger.info("Consumer of %s stopped", queue_name)
+
+    def stop(self, timeout: float = None) -> NoReturn:
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        for _, _, inflight in self._subscriptions:
+            inflight.wait_idle(timeout)
+        with self._lock:
+            self._threads = []
+            self._started = False
+
+
+_memory: Optional[InProcessTransport] = None
+_memory_lock = threading.Lock()
+
+
+def create_transport(url: str, queues: Iterable[str] = ()) -> Transport:
+    """
+    Создаёт транспорт по адресу
+
+    :param url: `amqp://host:port` для RabbitMQ или `memory://` для очередей в памяти процесса. Все вызовы
+        с `memory://` в одном процессе возвращают один и тот же транспорт
+    :param queues: Очереди RabbitMQ, объявляемые издателем при подключении
+    :return: Транспорт
+    """
+    global _memory
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        with _memory_lock:
+            if _memory is None:
+                _memory = InProcessTransport()
+            return _memory
+    if parsed.scheme != 'amqp':
+        raise ValueError(f"Unsupported transport: {url}")
+    return RabbitMQTransport(parsed.hostname, parsed.port or 5672, queues)
@@ -0,0 +1,256 @@
+"""
+Потоковая загрузка видео на локальный сервер Telegram
+
+`TeleBot.send_video` собирает тело multipart-запроса целиком в памяти, поэтому одновременная загрузка нескольких
+больших файлов требует памяти по размеру файлов. `MultipartFile` формирует то же тело по частям: заголовки полей,
+затем файл, читаемый с диска блоками по `chunk_size` байт, затем завершающую границу. Размер тела известен заранее,
+поэтому запрос отправляется с Content-Length, а память процесса не зависит от размера файла.
+
+Если локальный сервер запущен с `--local` и видит тот же том с видео, файл не передаётся вовсе: `send_video_path`
+отправляет серверу путь `file://...`, и сервер читает файл со своей файловой системы. `server_path` переводит путь
+к файлу у Worker-а в путь у сервера.
+"""
+import asyncio
+import os
+import time
+import uuid
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Optional
+
+import requests
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+from common.src.logs import get_logger
+
+logger = get_logger("Upload")
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadProgress:
+    """
+    Журналирует ход загрузки: переданный объём и скорость каждые `interval` секунд и итог после завершения
+
+    :ivar `str` name: Имя загружаемого файла
+    :ivar `int` total: Размер тела запроса, в байтах
+    :ivar `float` interval: Интервал между записями в журнал, в секундах
+    :ivar `int` sent: Передано байт
+    """
+
+    def __init__(self, name: str, total: int, interval: float = 5.0, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.sent = 0
+        self._clock = clock
+        self._start = clock()
+        self._logged = self._start
+
+    @property
+    def rate(self) -> float:
+        """
+        :return: Средняя скорость с начала загрузки, байт в секунду
+        """
+        return self.sent / max(self._clock() - self._start, 1e-9)
+
+    def __call__(self, sent: int) -> None:
+        self.sent += sent
+        now = self._clock()
+        if now - self._logged >= self.interval:
+            self._logged = now
+            logger.info("Uploading %s: %.1f/%.1f MiB (%.0f%%), %.2f MiB/s", self.name, self.sent / 2 ** 20,
+                        self.total / 2 ** 20, 100 * self.sent / max(self.total, 1), self.rate / 2 ** 20)
+
+    def finish(self) -> None:
+        logger.info("Upload complete %s: %.1f MiB in %.1fs, %.2f MiB/s", self.name, self.sent / 2 ** 20,
+                    self._clock() - self._start, self.rate / 2 ** 20)
+
+
+class MultipartFile:
+    """
+    Тело multipart/form-data запроса с одним файлом, читаемое по частям
+
+    :ivar `dict` fields: Текстовые поля формы
+    :ivar `str` file_field: Имя поля с файлом
+    :ivar `BinaryIO` file: Открытый файл
+    :ivar `str` content_type: Значение заголовка Content-Type запроса
+    :ivar `int` chunk_size: Размер блока чтения файла, в байтах
+    """
+
+    def __init__(self, fields: Dict[str, str], file_field: str, file: BinaryIO, file_type: str = 'video/mp4',
+                 chunk_size: int = CHUNK_SIZE, on_progress: Optional[Callable[[int], None]] = None):
+        self.fields = fields
+        self.file_field = file_field
+        self.file = file
+        self.chunk_size = chunk_size
+        self.on_progress = on_progress
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        filename = os.path.basename(getattr(file, 'name', file_field)).replace('"', '')
+        preamble = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items())
+        preamble += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                     f'Content-Type: {file_type}\r\n\r\n').encode()
+        self._parts = [preamble, None, f'\r\n--{boundary}--\r\n'.encode()]
+        self._file_size = os.fstat(file.fileno()).st_size - file.tell()
+        self._part = 0
+        self._offset = 0
+
+    def __len__(self) -> int:
+        return len(self._parts[0]) + self._file_size + len(self._parts[2])
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Возвращает следующую часть тела. За один вызов читается не больше `chunk_size` байт файла
+
+        :param size: Максимальный размер части, по умолчанию `chunk_size`
+        :return: Часть тела, пустая строка в конце
+        """
+        size = self.chunk_size if size is None or size < 0 else min(size, self.chunk_size)
+        while self._part < len(self._parts):
+            if self._parts[self._part] is None:
+                chunk = self.file.read(size)
+            else:
+                chunk = self._parts[self._part][self._offset:self._offset + size]
+                self._offset += len(chunk)
+            if chunk:
+                if self.on_progress is not None:
+                    self.on_progress(len(chunk))
+                return chunk
+            self._part += 1
+            self._offset = 0
+        return b''
+
+    async def aiter(self) -> AsyncIterator[bytes]:
+        """
+        Асинхронно возвращает части тела, чтение файла выполняется вне цикла событий
+
+        :return: Части тела
+        """
+        loop = asyncio.get_running_loop()
+        while chunk := await loop.run_in_executor(None, self.read, self.chunk_size):
+            yield chunk
+
+
+def _file_id(result: dict, method: str) -> str:
+    """
+    Извлекает file_id из ответа Bot API
+
+    :param result: Ответ Bot API
+    :param method: Вызванный метод
+    :return: file_id загруженного видео
+    """
+    if not result.get('ok'):
+        raise ApiTelegramException(method, None, result)
+    return result['result']['video']['file_id']
+
+
+def server_path(path: str, media_root: str, server_root: Optional[str]) -> Optional[str]:
+    """
+    Переводит путь к файлу в каталоге `media_root` в путь к нему у локального сервера, к которому тот же каталог
+    подключён как `server_root`
+
+    :param path: Путь к файлу
+    :param media_root: Каталог с видео
+    :param server_root: Путь к каталогу с видео у локального сервера, пусто если каталог не подключён
+    :return: Путь у локального сервера или None, если каталог не подключён или файл лежит вне него
+    """
+    if not server_root:
+        return None
+    path, media_root = os.path.normpath(os.path.abspath(path)), os.path.normpath(media_root)
+    if os.path.commonpath([path, media_root]) != media_root:
+        return None
+    return os.path.join(server_root, os.path.relpath(path, media_root)).replace(os.sep, '/')
+
+
+def send_video_path(token: str, chat_id, path: str, timeout: float = 60, session: requests.Session = None) -> str:
+    """
+    Отправляет видео методом sendVideo по пути на локальном сервере, без передачи самого файла
+
+    :param token: Токен бота
+    :param chat_id: Чат, в который загружается видео
+    :param path: Путь к файлу у локального сервера
+    :param timeout: Время ожидания ответа, в секундах
+    :param session: HTTP-сессия, по умолчанию `requests`
+    :return: file_id загруженного видео
+    """
+    start = time.monotonic()
+    response = (session or requests).post(apihelper.API_URL.format(token, 'sendVideo'),
+                                          data={'chat_id': str(chat_id), 'video': f'file://{path}'}, timeout=timeout)
+    file_id = _file_id(response.json(), 'sendVideo')
+    logger.info("Sent by path %s in %.1fs", path, time.monotonic() - start)
+    return file_id
+
+
+async def asend_video_path(session, token: str, chat_id, path: str, timeout: float = 60) -> str:
+    """
+    Асинхронный вариант `send_video_path`
+
+    :param session: `aiohttp.ClientSession`
+    :param token: Токен бота
+    :param chat_id: Чат, в который загружается видео
+    :param path: Путь к файлу у локального сервера
+    :param timeout: Время ожидания ответа, в секундах
+    :return: file_id загруженного видео
+    """
+    import aiohttp
+
+    start = time.monotonic()
+    async with session.post(apihelper.API_URL.format(token, 'sendVideo'),
+                            data={'chat_id': str(chat_id), 'video': f'file://{path}'},
+                            timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        result = await response.json(content_type=None)
+    file_id = _file_id(result, 'sendVideo')
+    logger.info("Sent by path %s in %.1fs", path, time.monotonic() - start)
+    return file_id
+
+
+def _prepare(token: str, chat_id, file: BinaryIO, chunk_size: int):
+    progress = UploadProgress(os.path.basename(getattr(file, 'name', 'video')), 0)
+    body = MultipartFile({'chat_id': str(chat_id)}, 'video', file, chunk_size=chunk_size, on_progress=progress)
+    progress.total = len(body)
+    headers = {'Content-Type': body.content_type, 'Content-Length': str(len(body))}
+    return apihelper.API_URL.format(token, 'sendVideo'), body, headers, progress
+
+
+def upload_video(token: str, chat_id, file: BinaryIO, timeout: float = 1000,
+                 session: requests.Session = None, chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    Загружает видео методом sendVideo, передавая файл по частям
+
+    :param token: Токен бота
+    :param chat_id: Чат, в который загружается видео
+    :param file: Открытый файл видео
+    :param timeout: Время ожидания ответа, в секундах
+    :param session: HTTP-сессия, по умолчанию `requests`
+    :param chunk_size: Размер блока чтения файла, в байтах
+    :return: file_id загруженного видео
+    """
+    url, body, headers, progress = _prepare(token, chat_id, file, chunk_size)
+    response = (session or requests).post(url, data=body, headers=headers, timeout=timeout)
+    progress.finish()
+    return _file_id(response.json(), 'sendVideo')
+
+
+async def aupload_video(session, token: str, chat_id, file: BinaryIO, timeout: float = 1000,
+                        chunk_size: int = CHUNK_SIZE) -> str:
+    """
+    Асинхронный вариант `upload_video`
+
+    :param session: `aiohttp.ClientSession`
+    :param token: Токен бота
+    :param chat_id: Чат, в который загружается видео
+    :param file: Открытый файл видео
+    :param timeout: Время ожидания ответа, в секундах
+    :param chunk_size: Размер блока чтения файла, в байтах
+    :return: file_id загруженного видео
+    """
+    import aiohttp
+
+    url, body, headers, progress = _prepare(token, chat_id, file, chunk_size)
+    async with session.post(url, data=body.aiter(), headers=headers,
+                            timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        result = await response.json(content_type=None)
+    progress.finish()
+    return _file_id(result, 'sendVideo')
@@ -2,8 +2,9 @@
 Управление поведением телеграм-бота
 """
 
+import math
 from http import HTTPStatus
-from typing import NoReturn
+from typing import NoReturn, Optional
 
 import flask
 import requests
@@ -13,9 +14,14 @@ from telebot import apihelper, asyncio_helper, TeleBot, formatting
 from telebot.apihelper import ApiTelegramException
 from telebot.handler_backends import State, StatesGroup
 from telebot.custom_filters import StateFilter
-from telebot.types import ReplyParameters
 from telebot.types import Update, Message
 
+from common.src.probe import TTLCache
+from common.src.profiling import Profiler, register_admin
+from common.src.readiness import Readiness, register_health
+from common.src.send_scheduler import SendScheduler, create_send_queue
+from common.src.state_storage import create_state_storage
+
 API_KEY = config('TELEGRAM_BOT_API_KEY')
 
 DOMAIN = config('TELEGRAM_BOT_HANDLER_PROXY')
@@ -28,6 +34,19 @@ TELEGRAM_SERVER_PORT = config('LOCAL_TELEGRAM_API_SERVER_PORT')
 
 WEBHOOK_TOKEN = config('TELEGRAM_BOT_WEBHOOK_TOKEN')
 
+STATE_STORAGE_URL = config('STATE_STORAGE_URL', default='')
+STATE_TTL = config('STATE_TTL', default=3600, cast=int)
+
+HANDLER_WORKERS = config('TELEGRAM_BOT_HANDLER_WORKERS', default=1, cast=int)
+
+SEND_RATE = config('TELEGRAM_SEND_RATE', default=30, cast=float)
+
+FILE_CACHE_TTL = config('FILE_CACHE_TTL', default=0, cast=float)
+
+ADMIN_TOKEN = config('ADMIN_TOKEN', default='')
+
+profiler = Profiler(config('PROFILE_EVERY', default=0, cast=int), config('PROFILE_THRESHOLD', default=0, cast=float))
+
 
 class DownloadVideoState(StatesGroup):
     """
@@ -63,22 +82,30 @@ class TBotHandler:
 
     :ivar `telebot.TeleBot` bot: Экземпляр бота
     :ivar `flask.app.Flask` app: Flask-приложение для общения с остальными модулями
+    :ivar `common.src.send_scheduler.SendScheduler` outbox: Планировщик отправки уведомлений о загрузке
+    :ivar `common.src.readiness.Readiness` readiness: Шаги запуска, выполняемые после старта приложения
+    :ivar `common.src.probe.TTLCache | None` file_cache: Загруженные видео по ссылке из сообщения, повторная ссылка
+        отправляется без обращения к Downloader. None, если `FILE_CACHE_TTL` не задан
     :ivar `str` host: Хост для запуска
     :ivar `int` port: Порт для запуска
+    :ivar `bool` log_out: Выходить ли из облачного Bot API при подключении. При запуске через gunicorn выход
+        выполняется один раз в главном процессе (`log_out_of_cloud` в `gunicorn.conf.py`), а не в каждом рабочем
     """
 
-    def __init__(self):
-        self.bot: TeleBot = TeleBot(API_KEY, threaded=False)
+    def __init__(self, log_out: bool = True):
+        self.bot: TeleBot = TeleBot(API_KEY, threaded=False,
+                                    state_storage=create_state_storage(STATE_STORAGE_URL, STATE_TTL))
         self.app = flask.Flask(__name__)
+        self.outbox = SendScheduler(self.bot, create_send_queue(STATE_STORAGE_URL, HANDLER_WORKERS), SEND_RATE)
+        self.file_cache = TTLCache(FILE_CACHE_TTL) if FILE_CACHE_TTL else None
         self.host = config('TELEGRAM_BOT_HANDLER_HOST')
         self.port = int(config('TELEGRAM_BOT_HANDLER_PORT'))
-        try:
-            self.bot.delete_webhook(timeout=30)
-            self.bot.log_out()
-        except ApiTelegramException as e:
-            pass
+        self.readiness = Readiness()
+        self.log_out = log_out
+        self._local = False
         self.configure_router()
         self.configure_bot()
+        self.readiness.run('webhook', self.connect)
 
     def configure_bot(self) -> NoReturn:
         """
@@ -104,13 +131,34 @@ class TBotHandler:
         @self.bot.message_handler(state=DownloadVideoState.link)
         def __t_on_download_link(message: Message):
             self.bot.delete_state(message.from_user.id, message.chat.id)
+            video = self.file_cache.get(message.text) if self.file_cache is not None else None
+            if video is not None:
+                self.outbox.submit('send_video', message.chat.id, video['file_id'],
+                                   caption=self.caption(video['video_url']), parse_mode='MarkdownV2',
+                                   reply_to=message.id)
+                return
             response = requests.post(f'http://{DOWNLOADER_HOST}:{DOWNLOADER_PORT}/api/download/start',
                                      json={'chat_id': message.chat.id, 'message_id': message.id,
                                            'url': message.text})
+            if response.status_code == HTTPStatus.OK and response.headers.get('Content-Type') == 'application/json':
+                video = response.json()
+                if self.file_cache is not None:
+                    self.file_cache.put(message.text, video)
+                self.outbox.submit('send_video', message.chat.id, video['file_id'],
+                                   caption=self.caption(video['video_url']), parse_mode='MarkdownV2',
+                                   reply_to=message.id)
+                return
             if response.status_code == HTTPStatus.NOT_FOUND:
                 text = 'Некорректная ссылка'
-            elif response.status_code == HTTPStatus.OK:
-                text = 'Видео добавлено в очередь'
+            elif response.status_code == HTTPStatus.ACCEPTED:
+                text = self.queued(response.json())
+            elif response.status_code == HTTPStatus.UNAUTHORIZED:
+                text = 'Загрузка невозможна: требуется авторизация'
+            elif response.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
+                text = 'Загрузка невозможна: видео весит больше 1ГБ'
+            elif response.status_code == HTTPStatus.SERVICE_UNAVAILABLE and 'Retry-After' in response.headers:
+                text = (f'Очередь загрузки переполнена, повторите запрос через '
+                        f'{self.duration(int(response.headers["Retry-After"]))}')
             else:
                 text = 'Непредвиденная ошибка'
             self.bot.reply_to(message, text)
@@ -149,11 +197,24 @@ class TBotHandler:
                 text = 'Непредвиденная ошибка'
             self.bot.reply_to(message, text)
 
-        apihelper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
-        asyncio_helper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
-        self.config_webhook()
         self.bot.add_custom_filter(StateFilter(self.bot))
 
+    def connect(self) -> NoReturn:
+        """
+        Переводит бота на локальный сервер: выходит из облачного Bot API, если задан `log_out`, устанавливает веб-хук
+        на локальном сервере и запускает отправку уведомлений. Выполняется в фоне, пока приложение уже принимает
+        запросы, и повторяется при ошибке; выход из облачного Bot API при повторе не выполняется
+        """
+        if not self._local:
+            if self.log_out:
+                log_out_of_cloud(self.bot)
+            apihelper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
+            asyncio_helper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
+            self._local = True
+        if not self.config_webhook():
+            raise RuntimeError('Webhook is not set')
+        self.outbox.start()
+
     def config_webhook(self) -> bool:
         """
         Устанавливает веб-хук Telegram на сервер `DOMAIN` с секретным ключом  `WEBHOOK_TOKEN`
@@ -162,6 +223,7 @@ class TBotHandler:
         """
         return self.bot.set_webhook(url=DOMAIN, secret_token=WEBHOOK_TOKEN)
 
+    @profiler.profile('t_request_handler')
     async def t_request_handler(self) -> Response:
         """
         Обрабатывает поступающие от Telegram запросы, вызывает срабатывание хэндлеров
@@ -183,21 +245,61 @@ class TBotHandler:
         """
         return Response(f'Everything is good', HTTPStatus.OK)
 
+    @staticmethod
+    def caption(video_url: Optional[str], playlist_url: Optional[str] = None) -> str:
+        """
+        Формирует подпись к видео со ссылками на видео и плейлист
+
+        :param video_url: Ссылка на видео
+        :param playlist_url: Ссылка на плейлист
+        :return: Подпись в разметке MarkdownV2
+        """
+        return (f' [Видео]({video_url})' if video_url else '') + (
+            f' [Плейлист]({playlist_url})' if playlist_url else '')
+
+    @staticmethod
+    def duration(seconds: float) -> str:
+        """
+        Формирует приблизительную длительность для сообщения пользователю
+
+        :param seconds: Длительность, в секундах
+        :return: Длительность в минутах или часах
+        """
+        if seconds < 3600:
+            return f'{max(math.ceil(seconds / 60), 1)} мин'
+        return f'{seconds / 3600:.1f} ч'
+
+    @staticmethod
+    def queued(estimate: dict) -> str:
+        """
+        Формирует сообщение о постановке видео в очередь
+
+        :param estimate: Ответ загрузчика `{"position": ..., "eta": ...}`, значения могут быть неизвестны
+        :return: Текст сообщения с позицией в очереди и оценкой времени ожидания, если они известны
+        """
+        text = 'Видео добавлено в очередь'
+        if estimate.get('position'):
+            text += f', позиция {estimate["position"]}'
+        if estimate.get('eta') is not None:
+            text += f', ожидание около {TBotHandler.duration(estimate["eta"])}'
+        return text
+
+    @profiler.profile('on_download_complete')
     async def on_download_complete(self) -> Response:
         """
-        Обрабатывает POST-запрос при завершении загрузки, отправляет пользователю загруженное видео
+        Обрабатывает POST-запрос при завершении загрузки, ставит загруженное видео или сообщение об ошибке в очередь
+        отправки пользователю
 
         :return: Response 200
         """
         payload: dict = request.json
-        chat_id = int(payload.get('chat_id', 0))
-        message_id = int(payload.get('message_id', 0))
+        chat_id = int(payload.get('chat_id') or 0)
+        message_id = int(payload.get('message_id') or 0)
         file_id = payload.get('file_id', None)
         playlist_url = payload.get('playlist_url', None)
         video_url = payload.get('video_url', None)
         error_code = payload.get('error_code', None)
-        caption = (f' [Видео]({video_url})' if video_url else '') + (
-            f' [Плейлист]({playlist_url})' if playlist_url else '')
+        caption = self.caption(video_url, playlist_url)
         if error_code is not None:
             if error_code == HTTPStatus.UNAUTHORIZED:
                 message_text = 'Загрузка невозможна: требуется авторизация'
@@ -206,13 +308,17 @@ class TBotHandler:
             elif error_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
                 message_text = ('Загрузка невозможна: Видео недоступно, или видеохостинг ещё не обновил информацию, '
                                 'или оно весит больше 1ГБ.')
+            elif error_code == HTTPStatus.SERVICE_UNAVAILABLE:
+                message_text = 'Видеохостинг временно недоступен, повторите запрос позже'
+            elif error_code == HTTPStatus.GATEWAY_TIMEOUT:
+                message_text = 'Загрузка не успела завершиться вовремя, повторите запрос позже'
             else:
                 message_text = 'Непредвиденная ошибка при попытке загрузки'
-            self.bot.send_message(chat_id, formatting.escape_markdown(message_text) + caption, parse_mode='MarkdownV2',
-                                  reply_parameters=ReplyParameters(message_id, chat_id, True))
+            self.outbox.submit('send_message', chat_id, formatting.escape_markdown(message_text) + caption,
+                               parse_mode='MarkdownV2', reply_to=message_id)
         else:
-            self.bot.send_video(chat_id, file_id, caption=caption, parse_mode='MarkdownV2',
-                                reply_parameters=ReplyParameters(message_id, chat_id, True))
+            self.outbox.submit('send_video', chat_id, file_id, caption=caption, parse_mode='MarkdownV2',
+                               reply_to=message_id)
 
         return Response(status=HTTPStatus.OK)
 
@@ -223,6 +329,8 @@ class TBotHandler:
         self.app.add_url_rule('/', view_func=self.main_page, methods=['GET'])
         self.app.add_url_rule('/', view_func=self.t_request_handler, methods=['POST'])
         self.app.add_url_rule('/api/download/complete', view_func=self.on_download_complete, methods=['POST'])
+        register_admin(self.app, profiler, ADMIN_TOKEN)
+        register_health(self.app, self.readiness)
 
     def run(self, debug: bool = True) -> NoReturn:
         """
@@ -233,6 +341,30 @@ class TBotHandler:
         self.app.run(debug=debug, host=self.host, port=self.port, use_reloader=False)
 
 
+def log_out_of_cloud(bot: TeleBot) -> NoReturn:
+    """
+    Удаляет веб-хук и выходит из облачного Bot API, после чего бот может работать через локальный сервер. Должна
+    вызываться до перевода `apihelper.API_URL` на локальный сервер
+
+    :param bot: Телеграм-бот
+    """
+    try:
+        bot.delete_webhook(timeout=30)
+        bot.log_out()
+    except ApiTelegramException:
+        pass
+
+
+def create_app() -> flask.Flask:
+    """
+    Создаёт Flask-приложение бота для запуска через WSGI-сервер в нескольких процессах. Выход из облачного Bot API
+    выполняет главный процесс gunicorn до создания рабочих, поэтому рабочие его не повторяют
+
+    :return: Flask-приложение
+    """
+    return TBotHandler(log_out=False).app
+
+
 if __name__ == '__main__':
     botik = TBotHandler()
     botik.run(config('DEBUG', False))
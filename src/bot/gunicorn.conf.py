@@ -0,0 +1,17 @@
+"""
+Настройки gunicorn для бота
+"""
+from typing import NoReturn
+
+from telebot import TeleBot
+
+
+def on_starting(server) -> NoReturn:
+    """
+    Выходит из облачного Bot API один раз в главном процессе, до создания рабочих процессов
+
+    :param server: Главный процесс gunicorn
+    """
+    from bot_handler import API_KEY, log_out_of_cloud
+
+    log_out_of_cloud(TeleBot(API_KEY, threaded=False))
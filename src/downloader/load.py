@@ -1,44 +1,83 @@
 """
 Управление состоянием загружаемых видеозаписей
 """
-import json
-import logging
+import asyncio
+import datetime
+import math
 import re
 import threading
 import time
+from dataclasses import asdict
 from http import HTTPStatus
-from typing import NoReturn, Optional
+from typing import Callable, NoReturn, Optional
 from urllib.parse import urlparse
 
+import aiohttp
 import flask
-import pika
 import requests
 import requests as req
 import schedule
 from decouple import config
 from flask import request, Response
-from pika.adapters.blocking_connection import BlockingChannel
-from pika.spec import BasicProperties, Basic
-from pytube import extract
-from pytube.exceptions import RegexMatchError
 
+from batadaze.src.async_main import AsyncDB
+from batadaze.src.leader import LeaderLease, SCHEDULER_LOCK
 from batadaze.src.main import DB
+from common.src.admission import Admission, Estimate, Limit
+from common.src.deadline import deadline_after
+from common.src.hostings import PLAYLIST_URLS, VIDEO_URLS, youtube_playlist_id, youtube_video_id
+from common.src.logs import get_logger
+from common.src.messages import Message, VideoTask, PlaylistTask, VideoAnswer, PlaylistAnswer
+from common.src.probe import REJECTED
+from common.src.profiling import Profiler, register_admin
+from common.src.readiness import Readiness, register_health
+from common.src.transport import create_transport
+
+logger = get_logger("Loader")
 
-logger = logging.getLogger("Loader")
+TBOT_HOST = config('TELEGRAM_BOT_HANDLER_HOST')
+TBOT_PORT = config('TELEGRAM_BOT_HANDLER_PORT')
 
-logger.setLevel(logging.INFO)
+RMQ_HOST = config('RMQ_HOST', default='')
+RMQ_PORT = config('RMQ_PORT', default=5672)
+TRANSPORT_URL = config('TRANSPORT_URL', default=f'amqp://{RMQ_HOST}:{RMQ_PORT}')
 
-handler = logging.StreamHandler()
+LOADER_INSTANCE = config('LOADER_INSTANCE')
+REPLY_QUEUE_EXPIRES = config('REPLY_QUEUE_EXPIRES', default=3600, cast=float)
 
-handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+LOADERS = {
+    'youtube': (config('YOUTUBE_LOADER_HOST'), config('YOUTUBE_LOADER_PORT')),
+    'vk': (config('VK_LOADER_HOST'), config('VK_LOADER_PORT')),
+}
 
-logger.addHandler(handler)
+PROBE_TIMEOUT = config('PROBE_TIMEOUT', default=5, cast=float)
 
-TBOT_HOST = config('TELEGRAM_BOT_HANDLER_HOST')
-TBOT_PORT = config('TELEGRAM_BOT_HANDLER_PORT')
+PUBLISH_TIMEOUT = config('PUBLISH_TIMEOUT', default=10, cast=float)
+
+PLAYLIST_UPDATE_REQUEST_TIMEOUT = config('PLAYLIST_UPDATE_REQUEST_TIMEOUT', default=10, cast=float)
 
-RMQ_HOST = config('RMQ_HOST')
-RMQ_PORT = config('RMQ_PORT')
+DOWNLOAD_DEADLINE = config('DOWNLOAD_DEADLINE', default=7200, cast=float)
+PLAYLIST_DEADLINE = config('PLAYLIST_DEADLINE', default=600, cast=float)
+
+ADMIN_TOKEN = config('ADMIN_TOKEN', default='')
+
+PREFETCH_INTERVAL = config('PREFETCH_INTERVAL', default=60, cast=int)
+PREFETCH_BATCH = config('PREFETCH_BATCH', default=5, cast=int)
+PREFETCH_MAX_QUEUE = config('PREFETCH_MAX_QUEUE', default=0, cast=int)
+PREFETCH_WINDOW = datetime.timedelta(seconds=config('PREFETCH_WINDOW', default=7 * 86400, cast=int))
+PREFETCH_RETRY = datetime.timedelta(seconds=config('PREFETCH_RETRY', default=86400, cast=int))
+PREFETCH_MIN_SCORE = config('PREFETCH_MIN_SCORE', default=2, cast=float)
+
+ADMISSION_WORKER_SLOTS = config('ADMISSION_WORKER_SLOTS', default=config('WORKER_THREADS', default=10), cast=int)
+ADMISSION_RETRY_AFTER = config('ADMISSION_RETRY_AFTER', default=60, cast=float)
+ADMISSION_LIMITS = {
+    'user': Limit(config('ADMISSION_MAX_QUEUE', default=0, cast=int) or None,
+                  config('ADMISSION_MAX_WAIT', default=0, cast=float) or None),
+    'playlist': Limit(config('ADMISSION_PLAYLIST_MAX_QUEUE', default=0, cast=int) or None),
+    'prefetch': Limit(PREFETCH_MAX_QUEUE + 1),
+}
+
+profiler = Profiler(config('PROFILE_EVERY', default=0, cast=int), config('PROFILE_THRESHOLD', default=0, cast=float))
 
 
 class Loader:
@@ -49,11 +88,18 @@ class Loader:
     :ivar `flask.app.Flask` app: Flask-приложение для общения с другими модулями
     :ivar `str` host: Хост для запуска
     :ivar `int` port: Порт для запуска
-    :ivar `pika.adapters.blocking_connection.BlockingConnection` connection: Объект соединения с RabbitMQ
-    :ivar `pika.adapters.blocking_connection.BlockingChannel` channel: Канал для общения с RabbitMQ
-    :ivar `pika.adapters.blocking_connection.BlockingConnection` RPC_connection: Объект соединения с RabbitMQ для\
-    получения ответных сообщений. (Non-thread-safe) Использовать только внутри одного потока
-    :ivar `pika.adapters.blocking_connection.BlockingChannel` RPC_channel: Канал для общения с RabbitMQ
+    :ivar `common.src.transport.Transport` transport: Транспорт задач и ответов, общий для потоков запросов
+    и получателя ответов
+    :ivar `str` reply_queue: Очередь ответов этого экземпляра. Задачи публикуются с `reply_to`, поэтому ответы на
+    задачи экземпляра, в том числе все части одного плейлиста, приходят ему же и обрабатываются по порядку, а
+    экземпляры не конкурируют за общую `answer_queue`. Loader не хранит состояния задач в памяти, поэтому
+    экземпляров может быть несколько. Имя экземпляра `LOADER_INSTANCE` обязательно и должно сохраняться при
+    пересоздании контейнера, иначе ответы на уже опубликованные задачи останутся в очереди прежнего имени
+    :ivar `asyncio.AbstractEventLoop` db_loop: Цикл событий, в котором асинхронные представления обращаются к
+    базе данных через `AsyncDB` с общим пулом соединений
+    :ivar `common.src.readiness.Readiness` readiness: Шаги запуска, выполняемые после старта приложения
+    :ivar `common.src.admission.Admission` admission: Допуск задач в `task_queue` по её загрузке: запросы
+    пользователей (`user`), плановые обновления плейлистов (`playlist`) и предварительная загрузка (`prefetch`)
     """
     netlocs = {
         'youtube': [
@@ -74,71 +120,164 @@ class Loader:
         self.app = flask.Flask(__name__)
         self.host = config('DOWNLOADER_HOST')
         self.port = int(config('DOWNLOADER_PORT'))
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=RMQ_HOST, port=RMQ_PORT, heartbeat=0))
-        self.RPC_connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=RMQ_HOST, port=RMQ_PORT, heartbeat=0))
-        self.channel = self.connection.channel()
-        self.RPC_channel = self.RPC_connection.channel()
-        self.channel.queue_declare('task_queue')
-        self.RPC_channel.queue_declare('answer_queue')
-        self.RPC_channel.basic_consume('answer_queue', self.process_answer, auto_ack=True)
+        self.transport = create_transport(TRANSPORT_URL, queues=('task_queue', 'answer_queue'))
+        self.reply_queue = f'answer_queue.{LOADER_INSTANCE}'
+        self.transport.start()
+        self.admission = Admission(self.transport, 'task_queue', ADMISSION_WORKER_SLOTS, ADMISSION_LIMITS,
+                                   retry_after=ADMISSION_RETRY_AFTER)
+        self.admission.start()
+        self.db_loop = asyncio.new_event_loop()
+        threading.Thread(target=self.db_loop.run_forever, daemon=True).start()
+        self.readiness = Readiness()
         self.configure_router()
+        self.readiness.run('db', lambda: asyncio.run_coroutine_threadsafe(AsyncDB.get_video(''),
+                                                                          self.db_loop).result())
 
-    def process_answer(self, channel: BlockingChannel, method: Basic.Deliver, properties: BasicProperties,
-                       body: bytes) -> NoReturn:
+    async def _db(self, coro):
         """
-        Обработка полученных от worker-а ответов
+        Выполняет корутину `AsyncDB` в цикле событий базы данных. Flask запускает каждое асинхронное представление
+        в собственном цикле, поэтому пул соединений живёт в отдельном долгоживущем цикле `db_loop`
+
+        :param coro: Корутина, обращающаяся к базе данных
+        :return: Результат корутины
         """
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.db_loop))
 
-        def __on_return(payload: dict) -> None:
-            file_id = DB.get_video(payload['video_id']).file_id
-            if payload.get('playlist_id', None) is None:
-                req.post(f'http://{TBOT_HOST}:{TBOT_PORT}/api/download/complete', json=payload | {'file_id': file_id})
-            else:
-                users = DB.get_subscribed_users(payload['playlist_id'])
-                for user in users:
-                    req.post(f'http://{TBOT_HOST}:{TBOT_PORT}/api/download/complete',
-                             json=payload | {'file_id': file_id, 'chat_id': user})
-
-        def __on_download(payload: dict) -> None:
-            video_id = payload['video_id']
-            if payload.get('playlist_id', None) and payload.get('error_code',
-                                                                None) == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
-                DB.delete_video(payload['video_id'])
-            elif DB.get_video(video_id) is None:
-                DB.add_video(video_id, payload['file_id'])
-            else:
-                DB.update_video(video_id, payload['file_id'])
+    @staticmethod
+    def deadline(task: Message) -> float:
+        """
+        :param task: Задача
+        :return: Срок задачи: `PLAYLIST_DEADLINE` секунд для плейлиста, `DOWNLOAD_DEADLINE` для видео, включая
+            ожидание в очереди
+        """
+        return deadline_after(PLAYLIST_DEADLINE if isinstance(task, PlaylistTask) else DOWNLOAD_DEADLINE)
+
+    async def _publish(self, task: Message) -> bool:
+        """
+        Публикует задачу в `task_queue` с ответом в очередь экземпляра и сроком выполнения и ожидает подтверждения
+        брокера не дольше `PUBLISH_TIMEOUT` секунд. Если подтверждения нет, издатель продолжает попытки в фоне
 
-            if payload.get('playlist_id', None) is None:
+        :param task: Задача
+        :return: True, если брокер подтвердил получение задачи
+        """
+        task.reply_to = self.reply_queue
+        if task.deadline is None:
+            task.deadline = self.deadline(task)
+        future = self.transport.publish('task_queue', task)
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), PUBLISH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Task %s is not confirmed in %ss", task.type, PUBLISH_TIMEOUT)
+            return False
+        return True
+
+    def _record_request(self, video_id: str) -> NoReturn:
+        """
+        Учитывает запрос видео в фоне, не задерживая ответ
+
+        :param video_id: Идентификатор видео
+        """
+
+        def _done(future) -> None:
+            if future.exception() is not None:
+                logger.warning("Request of %s is not recorded: %s", video_id, future.exception())
+
+        asyncio.run_coroutine_threadsafe(AsyncDB.record_video_request(video_id), self.db_loop).add_done_callback(_done)
+
+    def prefetch(self) -> int:
+        """
+        Ставит в очередь загрузку ещё не загруженных видео из плейлистов, к которым недавно обращались. Задачи
+        публикуются, только если в `task_queue` ожидают не больше `PREFETCH_MAX_QUEUE` задач, и не больше
+        `PREFETCH_BATCH` за раз, поэтому они занимают Worker-ы, когда запросов пользователей мало, и задерживают
+        новые запросы не больше, чем на `PREFETCH_BATCH` задач
+
+        :return: Количество поставленных задач
+        """
+        estimate = self.admission.estimate('prefetch')
+        if not estimate.admitted or estimate.position is None:
+            logger.debug("Prefetch skipped, task_queue position: %s", estimate.position)
+            return 0
+        videos = DB.claim_prefetch_videos(PREFETCH_BATCH, PREFETCH_WINDOW, PREFETCH_RETRY, PREFETCH_MIN_SCORE)
+        for video_id, hosting in videos:
+            self.transport.publish('task_queue', VideoTask('download', video_id, hosting, reply_to=self.reply_queue,
+                                                           deadline=deadline_after(DOWNLOAD_DEADLINE)))
+        self.admission.enqueued(len(videos))
+        if videos:
+            logger.info("Prefetch %s videos", len(videos))
+        return len(videos)
+
+    @profiler.profile('process_answer')
+    def process_answer(self, answer: Message, ack: Callable[[], None]) -> NoReturn:
+        """
+        Обработка полученных от worker-а ответов
+
+        :param answer: Ответное сообщение
+        :param ack: Функция подтверждения, ответы подтверждаются при получении
+        """
+
+        def __notify(answer: VideoAnswer, file_id: Optional[str], users: list) -> None:
+            payload = asdict(answer) | {'file_id': file_id}
+            if answer.playlist_id is None:
+                if answer.chat_id is None:
+                    logger.info("Prefetched %s, file_id: %s", answer.video_id, file_id)
+                    return
                 req.post(f'http://{TBOT_HOST}:{TBOT_PORT}/api/download/complete', json=payload)
             else:
-                users = DB.get_subscribed_users(payload['playlist_id'])
                 for user in users:
                     req.post(f'http://{TBOT_HOST}:{TBOT_PORT}/api/download/complete', json=payload | {'chat_id': user})
 
-        def __on_playlist(payload: dict) -> None:
-            playlist_id = payload.get('playlist_id', '0')
-            current_ids = DB.get_all_videos(playlist_id)
-            new_ids = {_id for _id in payload['video_ids'] if _id not in current_ids}
-            for _id in new_ids:
-                video = DB.get_video(_id)
-                if video is None:
-                    DB.add_video(_id, None)
-                DB.add_playlist_video(_id, playlist_id)
-                task_type = 'return' if video and video.file_id else 'download'
-                if payload.get('upload', None):
-                    self.channel.basic_publish(exchange='', routing_key='task_queue',
-                                               body=json.dumps(payload | {'type': task_type, 'video_id': _id}))
-            DB.update_playlist_status(playlist_id, False)
-
-        payload: dict = json.loads(body.decode("utf-8"))
-        if payload['type'] == 'return':
-            __on_return(payload)
-        elif payload['type'] == 'download':
-            __on_download(payload)
-        elif payload['type'] == 'playlist':
-            __on_playlist(payload)
+        def __subscribers(answer: VideoAnswer) -> list:
+            return DB.get_subscribed_users(answer.playlist_id) if answer.playlist_id else []
+
+        def __on_return(answer: VideoAnswer) -> None:
+            with DB.unit_of_work():
+                file_id = DB.get_video(answer.video_id).file_id
+                users = __subscribers(answer)
+            __notify(answer, file_id, users)
+
+        def __on_download(answer: VideoAnswer) -> None:
+            if answer.elapsed is not None:
+                self.admission.observe(answer.elapsed)
+            with DB.unit_of_work():
+                if answer.playlist_id and answer.error_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
+                    DB.delete_video(answer.video_id)
+                else:
+                    DB.upsert_video_file_id(answer.video_id, answer.file_id)
+                users = __subscribers(answer)
+            __notify(answer, answer.file_id, users)
+
+        def __on_playlist(answer: PlaylistAnswer) -> None:
+            playlist_id = answer.playlist_id
+            logger.info("Playlist %s part %s: %s videos", playlist_id, answer.seq, len(answer.video_ids))
+            video_ids = list(dict.fromkeys(answer.video_ids))
+            with DB.unit_of_work():
+                cached = {video.id: video.file_id for video in DB.get_videos(video_ids) if video.file_id}
+                DB.add_videos(video_ids)
+                added = set(DB.add_playlist_videos(playlist_id, video_ids))
+                if answer.last:
+                    DB.update_playlist_status(playlist_id, False)
+                hits = [_id for _id in video_ids if _id in added and _id in cached] if answer.upload else []
+                users = DB.get_subscribed_users(playlist_id) if hits else []
+            if not answer.upload:
+                return
+            downloads = [_id for _id in video_ids if _id in added and _id not in cached]
+            for _id in downloads:
+                self.transport.publish('task_queue', VideoTask('download', _id, answer.hosting,
+                                                               playlist_id=playlist_id, reply_to=self.reply_queue,
+                                                               deadline=deadline_after(DOWNLOAD_DEADLINE)))
+            self.admission.enqueued(len(downloads))
+            playlist_url = answer.playlist_url or PLAYLIST_URLS[answer.hosting].format(playlist_id)
+            for _id in hits:
+                __notify(VideoAnswer('return', _id, answer.hosting, playlist_id=playlist_id, file_id=cached[_id],
+                                     video_url=VIDEO_URLS[answer.hosting].format(_id), playlist_url=playlist_url),
+                         cached[_id], users)
+
+        if answer.type == 'return':
+            __on_return(answer)
+        elif answer.type == 'download':
+            __on_download(answer)
+        elif answer.type == 'playlist':
+            __on_playlist(answer)
 
     @staticmethod
     async def main_page() -> Response:
@@ -149,6 +288,21 @@ class Loader:
         """
         return Response(f'Ok', HTTPStatus.OK)
 
+    @staticmethod
+    def overloaded(estimate: Estimate) -> Response:
+        """
+        Ответ на задачу, отклонённую из-за перегрузки очереди
+
+        :param estimate: Оценка очереди
+        :return: Response 503 с заголовком Retry-After и JSON `{"retry_after": ..., "position": ..., "eta": ...}`
+        """
+        retry_after = math.ceil(estimate.retry_after)
+        response = flask.jsonify({'retry_after': retry_after, 'position': estimate.position,
+                                  'eta': math.ceil(estimate.eta) if estimate.eta is not None else None})
+        response.status_code = HTTPStatus.SERVICE_UNAVAILABLE
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
     @staticmethod
     def extract_video_id(url_raw: str, host: str) -> Optional[str]:
         """
@@ -161,13 +315,10 @@ class Loader:
         url = urlparse(url_raw)
         if url.netloc not in Loader.netlocs[host]:
             return None
-        try:
-            if host == 'youtube':
-                return extract.video_id(url_raw)
-            elif host == 'vk':
-                return re.split('[%?]', '_'.join(url_raw.split('video')[-1].split('_')[:2]))[0]
-        except RegexMatchError as e:
-            return None
+        if host == 'youtube':
+            return youtube_video_id(url_raw)
+        elif host == 'vk':
+            return re.split('[%?]', '_'.join(url_raw.split('video')[-1].split('_')[:2]))[0]
 
     @staticmethod
     def extract_playlist_id(url_raw: str, host: str) -> Optional[str]:
@@ -183,19 +334,44 @@ class Loader:
             return None
         try:
             if host == 'youtube':
-                return extract.playlist_id(url_raw)
+                return youtube_playlist_id(url_raw)
             elif host == 'vk':
                 return re.split('[%?]', '_'.join(url_raw.split('playlist/')[1].split('_')[:2]))[0]
-        except RegexMatchError as e:
-            return None
         except IndexError as e:
             return None
 
-    async def download_start(self) -> Response:
+    @staticmethod
+    async def probe(hosting: str, url: str) -> Optional[int]:
         """
-        Обрабатывает POST-запрос на начало загрузки, определяет видео-хостинг, добавляет задачу в очередь
+        Проверяет видео через `/api/probe` загрузчика, не дожидаясь загрузки
 
-        :return: Response 200 если ссылка верная, BadResponse 404 иначе
+        :param hosting: Видео-хостинг
+        :param url: Ссылка на видео
+        :return: 401 или 413, если загрузка заведомо закончится ошибкой, иначе None
+        """
+        host, port = LOADERS[hosting]
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as session:
+                async with session.get(f'http://{host}:{port}/api/probe', params={'url': url}) as response:
+                    if response.status != HTTPStatus.OK:
+                        return None
+                    status = (await response.json())['status']
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            logger.warning("Probe fail: %s, %s", e.__class__.__name__, e)
+            return None
+        return status if status in REJECTED else None
+
+    @profiler.profile('download_start')
+    async def download_start(self) -> Response:
+        """
+        Обрабатывает POST-запрос на начало загрузки, определяет видео-хостинг, добавляет задачу в очередь. Видео,
+        которые не могут быть загружены по размеру или из-за ограничений доступа, отклоняются до постановки в очередь.
+        Если видео уже загружено, задача не ставится, а `file_id` возвращается в ответе. Если очередь перегружена,
+        задача не ставится, а в ответе указано, когда повторить запрос
+
+        :return: Response 200 с JSON `{"file_id": ..., "video_url": ...}` если видео уже загружено, 202 с JSON
+            `{"position": ..., "eta": ...}` если задача поставлена, BadResponse 404 если ссылка неверная, 401|413
+            если видео нельзя загрузить, 503 если очередь перегружена или задача не принята
         """
         payload = request.json
         url_raw = payload['url']
@@ -211,17 +387,27 @@ class Loader:
         if video_id is None:
             return Response(status=HTTPStatus.NOT_FOUND)
 
-        task_type = 'download'
-        video = DB.get_video(video_id)
+        self._record_request(video_id)
+        video = await self._db(AsyncDB.get_video(video_id))
         if video and video.file_id is not None:
-            task_type = 'return'
-
-        self.channel.basic_publish(exchange='', routing_key='task_queue',
-                                   body=json.dumps(
-                                       payload | {'type': task_type, 'video_id': video_id, 'hosting': hosting}))
-
-        return Response(status=HTTPStatus.OK)
-
+            logger.info("Cache hit %s", video_id)
+            return flask.jsonify({'file_id': video.file_id, 'video_url': VIDEO_URLS[hosting].format(video_id)})
+        estimate = self.admission.estimate('user')
+        if not estimate.admitted:
+            return self.overloaded(estimate)
+        rejected = await self.probe(hosting, VIDEO_URLS[hosting].format(video_id))
+        if rejected is not None:
+            return Response(status=rejected)
+
+        if not await self._publish(VideoTask('download', video_id, hosting, chat_id=payload['chat_id'],
+                                             message_id=payload.get('message_id'))):
+            return Response(status=HTTPStatus.SERVICE_UNAVAILABLE)
+        self.admission.enqueued()
+
+        eta = math.ceil(estimate.eta) if estimate.eta is not None else None
+        return flask.jsonify({'position': estimate.position, 'eta': eta}), HTTPStatus.ACCEPTED
+
+    @profiler.profile('add_playlist')
     async def add_playlist(self) -> NoReturn:
         """
         Обрабатывает POST запрос на добавление плейлиста
@@ -240,16 +426,20 @@ class Loader:
         if playlist_id is None:
             return Response(status=HTTPStatus.NOT_FOUND)
 
-        if DB.get_user(payload['chat_id']) is None:
-            DB.add_user(payload['chat_id'])
-        if DB.get_playlist(playlist_id) is None:
-            DB.add_playlist(playlist_id, hosting, True)
+        async def _subscribe() -> bool:
+            async with AsyncDB.unit_of_work():
+                await AsyncDB.add_user(payload['chat_id'])
+                _created = await AsyncDB.add_playlist(playlist_id, hosting, True)
+                await AsyncDB.add_playlist_user(payload['chat_id'], playlist_id)
+            return _created
+
+        created = await self._db(_subscribe())
+        if created:
             await self._update_playlist(playlist_id, hosting, False)
-        if payload['chat_id'] not in DB.get_subscribed_users(playlist_id):
-            DB.add_playlist_user(payload['chat_id'], playlist_id)
 
         return Response(status=HTTPStatus.OK)
 
+    @profiler.profile('delete_playlist')
     async def delete_playlist(self) -> NoReturn:
         """
         Обрабатывает POST запрос на удаление плейлиста
@@ -264,9 +454,13 @@ class Loader:
         if playlist_id is None:
             return Response(status=HTTPStatus.OK)
 
-        DB.delete_playlist_user(playlist_id, payload['chat_id'])
-        if len(DB.get_subscribed_users(playlist_id)) == 0:
-            DB.delete_playlist(playlist_id)
+        async def _unsubscribe() -> None:
+            async with AsyncDB.unit_of_work():
+                await AsyncDB.delete_playlist_user(playlist_id, payload['chat_id'])
+                if len(await AsyncDB.get_subscribed_users(playlist_id)) == 0:
+                    await AsyncDB.delete_playlist(playlist_id)
+
+        await self._db(_unsubscribe())
 
         return Response(status=HTTPStatus.OK)
 
@@ -278,25 +472,23 @@ class Loader:
         :param hosting: Имя хостинга
         :param upload: Если установленно True, то загружает на сервер новые видео
         """
-        self.channel.basic_publish(
-            exchange='',
-            routing_key='task_queue',
-            body=json.dumps({
-                'type': 'playlist',
-                'playlist_id': playlist_id,
-                'hosting': hosting,
-                'upload': upload,
-            }),
-        )
+        await self._publish(PlaylistTask(playlist_id, hosting, upload))
 
+    @profiler.profile('update_playlist')
     async def update_playlist(self) -> NoReturn:
         """
-        Обрабатывает POST запрос на обновление данных о плейлисте
+        Обрабатывает POST запрос на обновление данных о плейлисте. Если очередь перегружена, обновление
+        откладывается до следующего срока
         """
         payload = request.json
         playlist_id = payload['playlist_id']
         hosting = payload['hosting']
         upload = bool(payload['upload'])
+        estimate = self.admission.estimate('playlist')
+        if not estimate.admitted:
+            logger.info("Playlist %s update postponed", playlist_id)
+            await self._db(AsyncDB.update_playlist_status(playlist_id, False))
+            return self.overloaded(estimate)
         await self._update_playlist(playlist_id, hosting, upload)
         return Response(status=HTTPStatus.OK)
 
@@ -309,6 +501,8 @@ class Loader:
         self.app.add_url_rule('/api/playlist/add', view_func=self.add_playlist, methods=['POST'])
         self.app.add_url_rule('/api/playlist/delete', view_func=self.delete_playlist, methods=['POST'])
         self.app.add_url_rule('/api/playlist/update', view_func=self.update_playlist, methods=['POST'])
+        register_admin(self.app, profiler, ADMIN_TOKEN)
+        register_health(self.app, self.readiness)
 
     def run(self, debug: bool = True) -> NoReturn:
         """
@@ -316,33 +510,74 @@ class Loader:
 
         :param debug: Запуск приложения в debug режиме
         """
-        threading.Thread(target=self.RPC_channel.start_consuming).start()
-        self.app.run(debug=debug, host=self.host, port=self.port, use_reloader=False)
+        self.transport.consume(self.reply_queue, self.process_answer, expires=REPLY_QUEUE_EXPIRES)
+        self.transport.consume('answer_queue', self.process_answer)
+        try:
+            self.app.run(debug=debug, host=self.host, port=self.port, use_reloader=False)
+        finally:
+            self.transport.stop()
+
 
+def update_all_playlists(lease: LeaderLease) -> NoReturn:
+    """
+    Отправляет на обновление плейлисты, срок обновления которых наступил. Выполняется только ведущим экземпляром.
+    Если запрос на обновление плейлиста не удался, плейлист снимается с обновления до следующего срока
 
-def update_all_playlists() -> NoReturn:
+    :param lease: Аренда роли ведущего планировщика
+    """
+    if not lease.hold():
+        return
     logger.info("update_all process start")
-    all_playlists = DB.select_playlists()
-    for playlist in all_playlists:
-        if playlist.is_updating:
-            continue
-        DB.update_playlist_status(playlist.id, True)
-        requests.post(f'http://{config("DOWNLOADER_HOST")}:{config("DOWNLOADER_PORT")}/api/playlist/update',
-                      json={'playlist_id': playlist.id, 'hosting': playlist.host, 'upload': True})
-    logger.info("update_all process finish")
+    due_playlists = DB.claim_due_playlists()
+    for playlist in due_playlists:
+        try:
+            requests.post(f'http://{config("DOWNLOADER_HOST")}:{config("DOWNLOADER_PORT")}/api/playlist/update',
+                          json={'playlist_id': playlist.id, 'hosting': playlist.host, 'upload': True},
+                          timeout=PLAYLIST_UPDATE_REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            logger.error("Playlist %s update request fail: %s, %s", playlist.id, e.__class__.__name__, e)
+            DB.update_playlist_status(playlist.id, False)
+    logger.info("update_all process finish, playlists: %s", len(due_playlists))
+
 
+def prefetch_popular(lease: LeaderLease, loader: Loader) -> NoReturn:
+    """
+    Ставит в очередь предварительную загрузку популярных видео. Выполняется только ведущим экземпляром
+
+    :param lease: Аренда роли ведущего планировщика
+    :param loader: Loader, через транспорт которого публикуются задачи
+    """
+    if not lease.hold():
+        return
+    try:
+        loader.prefetch()
+    except Exception as e:
+        logger.error("Prefetch fail: %s, %s", e.__class__.__name__, e)
 
-def schedule_tasks():
+
+def schedule_tasks(loader: Optional[Loader] = None):
+    """
+    Запускает планировщик обновления плейлистов и предварительной загрузки. Планировщик работает во всех экземплярах,
+    но задачи запускает только тот, кто удерживает advisory-блокировку `SCHEDULER_LOCK`; остальные каждую секунду
+    пытаются её получить
+
+    :param loader: Loader этого процесса, без него предварительная загрузка не запускается
+    """
     logger.info("Generating schedule tasks")
-    schedule.every(5).minutes.do(update_all_playlists)
+    lease = LeaderLease(SCHEDULER_LOCK)
+    schedule.every(1).minutes.do(update_all_playlists, lease)
+    if loader is not None and PREFETCH_INTERVAL:
+        schedule.every(PREFETCH_INTERVAL).seconds.do(prefetch_popular, lease, loader)
     logger.info("Schedule pending start")
     while True:
+        was_leader = lease.is_leader
+        if lease.hold() and not was_leader:
+            update_all_playlists(lease)
         schedule.run_pending()
         time.sleep(1)
 
 
 if __name__ == '__main__':
     app = Loader()
-    threading.Thread(target=schedule_tasks).start()
+    threading.Thread(target=schedule_tasks, args=(app,)).start()
     app.run(config('DEBUG', False))
-    app.connection.close()
@@ -0,0 +1,38 @@
+"""
+Запуск Downloader и Worker одним процессом для небольших установок и замеров
+
+Задачи и ответы передаются через очереди в памяти процесса (`TRANSPORT_URL=memory://`), поэтому RabbitMQ не нужен,
+а сообщения не кодируются. Задачи, не выполненные к остановке процесса, теряются.
+
+Запуск из корня проекта::
+
+    TRANSPORT_URL=memory:// python -m src.standalone.standalone
+"""
+import threading
+
+from decouple import config
+
+from common.src.logs import get_logger
+from src.downloader.load import Loader, TRANSPORT_URL, schedule_tasks
+from src.worker.worker import Worker, WORKER_THREADS
+
+logger = get_logger("Standalone")
+
+
+def main() -> None:
+    if not TRANSPORT_URL.startswith('memory://'):
+        logger.warning("Transport is %s, Loader and Worker will exchange messages through it", TRANSPORT_URL)
+    loader = Loader()
+    worker = Worker(WORKER_THREADS)
+    worker_thread = threading.Thread(target=worker.run, name='worker')
+    worker_thread.start()
+    threading.Thread(target=schedule_tasks, args=(loader,), daemon=True).start()
+    try:
+        loader.run(config('DEBUG', False))
+    finally:
+        worker.stop()
+        worker_thread.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,34 @@
 """
 Модуль для взаимодействия с vk api
+
+yt-dlp со всеми экстракторами импортируется дольше, чем запускается остальной сервис, поэтому он импортируется
+в обработчиках, а при запуске загружается в фоне шагом готовности `yt_dlp`
 """
 import datetime
-import json
+import importlib
 import os
 from http import HTTPStatus
 
 import flask
-import yt_dlp
 from decouple import config
 from flask import Response, request
-from yt_dlp.utils import YoutubeDLError, DownloadError
-
-import logging
 
-logger = logging.getLogger("VK_LOADER")
+from common.src.deadline import check, expired, from_headers
+from common.src.logs import get_logger
+from common.src.playlist_stream import CHUNK_SIZE, CONTENT_TYPE, stream_chunks
+from common.src.probe import TTLCache, probe_result
+from common.src.profiling import Profiler, register_admin
+from common.src.readiness import Readiness, register_health
 
-logger.setLevel(logging.INFO)
+logger = get_logger("VK_LOADER")
 
-handler = logging.StreamHandler()
+sep = os.sep
 
-handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+probes = TTLCache(config('PROBE_TTL', default=600, cast=int))
 
-logger.addHandler(handler)
+ADMIN_TOKEN = config('ADMIN_TOKEN', default='')
 
-sep = os.sep
+profiler = Profiler(config('PROFILE_EVERY', default=0, cast=int), config('PROFILE_THRESHOLD', default=0, cast=float))
 
 
 class VKLoader:
@@ -32,15 +36,18 @@ class VKLoader:
     Класс для загрузки видео и получения информация о плейлистах Вконтакте
 
     :ivar `flask.app.Flask` app: Flask-приложение для общения с другими модулями
+    :ivar `common.src.readiness.Readiness` readiness: Шаги запуска, выполняемые после старта приложения
     :ivar `str` host: Хост для запуска
     :ivar `int` port: Порт для запуска
     """
 
     def __init__(self):
         self.app = flask.Flask(__name__)
+        self.readiness = Readiness()
         self.host = config('VK_LOADER_HOST')
         self.port = int(config('VK_LOADER_PORT'))
         self.configure_router()
+        self.readiness.run('yt_dlp', lambda: importlib.import_module('yt_dlp'))
 
     @staticmethod
     async def main_page() -> Response:
@@ -52,69 +59,142 @@ class VKLoader:
         return Response(f'Ok', HTTPStatus.OK)
 
     @staticmethod
+    @profiler.profile('download')
     async def download() -> Response:
         """
-        Загружает видео с использованием библиотеки youtube_dlp
+        Загружает видео с использованием библиотеки youtube_dlp. Если передан `format` из `/api/probe`,
+        загружается этот формат, иначе лучший формат меньше 999 МБ. Загрузка прерывается, когда наступает срок из
+        заголовка `X-Deadline`, недозагруженный файл удаляется
 
-        :return: Response 200 с путём к файлу если загрузка удалась, BadResponse 413|401|400 иначе
+        :return: Response 200 с путём к файлу если загрузка удалась, BadResponse 413|401|400|504 иначе
         """
+        import yt_dlp
+        from yt_dlp.utils import YoutubeDLError, DownloadError, DownloadCancelled
+
         payload = request.json
         url_raw = payload['url']
+        deadline = from_headers(request.headers)
+        if expired(deadline):
+            logger.warning('Download abandoned, url: %s', url_raw)
+            return Response(status=HTTPStatus.GATEWAY_TIMEOUT)
         code = HTTPStatus.OK
         file_path = None
         name = str(datetime.datetime.now()) + '.%(ext)s'
+        partial = []
+
+        def _progress(status: dict) -> None:
+            if status.get('filename'):
+                partial[:] = [status['filename']]
+            if expired(deadline):
+                raise DownloadCancelled(f'deadline {deadline:.3f} exceeded')
+
         params = {
             'paths': {'home': '../media'},
             'nocheckcertificate': True,
-            'format': 'b[filesize_approx<999M]',
+            'format': payload.get('format', None) or 'b[filesize_approx<999M]',
             'nopart': True,
             'noprogress': True,
             'quiet': True,
             'compat_opts': {'manifest-filesize-approx': True},
             'outtmpl': name,
-            'noplaylist': True
+            'noplaylist': True,
+            'progress_hooks': [_progress]
         }
         try:
-            logger.info(f'Download start url: {url_raw}')
+            logger.info('Download start url: %s', url_raw)
             with yt_dlp.YoutubeDL(params) as ydlp:
                 ext = ydlp.extract_info(url_raw)['video_ext']
             file_path = os.getcwd() + f'{sep}..{sep}media{sep}{name[:-8]}.' + ext
-            logger.info(f'Download complete, file: {file_path}')
+            logger.info('Download complete, file: %s', file_path)
+        except DownloadCancelled as e:
+            logger.warning("Download abandoned, url: %s, %s", url_raw, e)
+            for path in partial:
+                if os.path.exists(path):
+                    os.remove(path)
+            code = HTTPStatus.GATEWAY_TIMEOUT
         except DownloadError as e:
-            logger.warning(f"Cath: {e.__class__.__name__}, {e}, {e.args}")
+            logger.warning("Cath: %s, %s, %s", e.__class__.__name__, e, e.args)
             if 'Sign up' in e.msg:
                 code = HTTPStatus.UNAUTHORIZED
             else:
                 code = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
         except YoutubeDLError as e:
-            logger.error(f"Catch unexpected error: {e.__class__.__name__}, {e}, {e.args}")
+            logger.error("Catch unexpected error: %s, %s, %s", e.__class__.__name__, e, e.args)
             code = HTTPStatus.BAD_REQUEST
         return Response(file_path, status=code)
 
     @staticmethod
+    @profiler.profile('probe')
+    async def probe() -> Response:
+        """
+        Возвращает размер, длительность, доступные форматы и ограничения видео без его загрузки. Результат
+        кэшируется на `PROBE_TTL` секунд, формат ответа описан в `common.src.probe`
+
+        :return: Response 200 с описанием видео, BadResponse 400 если не указан url или проверка не удалась
+        """
+        import yt_dlp
+        from yt_dlp.utils import YoutubeDLError, DownloadError
+
+        url = request.args.get('url', None)
+        if url is None:
+            return Response(status=HTTPStatus.BAD_REQUEST)
+        result = probes.get(url)
+        if result is None:
+            params = {
+                'nocheckcertificate': True,
+                'quiet': True,
+                'compat_opts': {'manifest-filesize-approx': True},
+                'noplaylist': True
+            }
+            try:
+                with yt_dlp.YoutubeDL(params) as ydlp:
+                    info = ydlp.extract_info(url, download=False)
+                formats = [{'id': fmt['format_id'], 'ext': fmt.get('ext'), 'height': fmt.get('height'),
+                            'size': fmt.get('filesize') or fmt.get('filesize_approx')}
+                           for fmt in info.get('formats', None) or []
+                           if fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none']
+                result = probe_result(formats, info.get('duration', None))
+            except DownloadError as e:
+                if 'Sign up' not in e.msg:
+                    logger.error("Probe %s failed: %s, %s", url, e.__class__.__name__, e)
+                    return Response(status=HTTPStatus.BAD_REQUEST)
+                logger.warning("Probe %s: authorization required", url)
+                result = probe_result([], restricted=True)
+            except YoutubeDLError as e:
+                logger.error("Probe %s failed: %s, %s", url, e.__class__.__name__, e)
+                return Response(status=HTTPStatus.BAD_REQUEST)
+            probes.put(url, result)
+        return flask.jsonify(result)
+
+    @staticmethod
+    @profiler.profile('get_playlist')
     async def get_playlist() -> Response:
         """
-        Возвращает информацию о всех видео в плейлисте с использованием библиотеки youtube_dlp
+        Возвращает информацию о всех видео в плейлисте с использованием библиотеки youtube_dlp. Идентификаторы
+        отдаются частями по мере обхода плейлиста, формат описан в `common.src.playlist_stream`
 
-        :return: Response 200 со списком video_id если загрузка удалась, BadResponse 400|404 иначе
+        :return: Response 200 с потоком частей списка video_id, BadResponse 400 если не указан url
         """
+        import yt_dlp
+        from yt_dlp.utils import YoutubeDLError
+
         url = request.args.get('url', None)
-        video_ids = []
-        code = HTTPStatus.OK
         if url is None:
             return Response(status=HTTPStatus.BAD_REQUEST)
-        try:
-            logger.info(f'Fetching all videos in playlist {url}')
+        chunk_size = request.args.get('chunk', CHUNK_SIZE, type=int)
+        deadline = from_headers(request.headers)
+
+        def _video_ids():
+            logger.info('Fetching all videos in playlist %s', url)
             with yt_dlp.YoutubeDL({'quiet': True, 'nocheckcertificate': True}) as ydlp:
-                ent = ydlp.extract_info(url, download=False, process=False).get('entries', [])
-                video_ids = list(x for x in map(lambda x: x.get('id', None), list(ent)) if x is not None)
-        except KeyError as e:
-            logger.error(f"Cath KeyError: {e} ")
-            code = HTTPStatus.BAD_REQUEST
-        except YoutubeDLError as e:
-            logger.error(f"Catch unexpected error: {e.__class__.__name__}, {e}, {e.args}")
-            code = HTTPStatus.BAD_REQUEST
-        return Response(json.dumps({'video_ids': video_ids}), status=code)
+                entries = ydlp.extract_info(url, download=False, process=False).get('entries', None) or []
+                for entry in entries:
+                    check(deadline)
+                    if entry.get('id', None) is not None:
+                        yield entry['id']
+
+        return Response(stream_chunks(_video_ids(), (KeyError, YoutubeDLError), chunk_size), status=HTTPStatus.OK,
+                        content_type=CONTENT_TYPE)
 
     def configure_router(self):
         """
@@ -122,7 +202,10 @@ class VKLoader:
         """
         self.app.add_url_rule('/', view_func=self.main_page, methods=['GET'])
         self.app.add_url_rule('/api/download', view_func=self.download, methods=['POST'])
+        self.app.add_url_rule('/api/probe', view_func=self.probe, methods=['GET'])
         self.app.add_url_rule('/api/get/playlist', view_func=self.get_playlist, methods=['GET'])
+        register_admin(self.app, profiler, ADMIN_TOKEN)
+        register_health(self.app, self.readiness)
 
     def run(self, debug: bool = True) -> None:
         """
@@ -1,48 +1,68 @@
 """
 Обработка запросов на работу с Downloader-ми, загрузка видео на Local Telegram Server
+
+Обращения к загрузчику каждого хостинга защищены автоматом (`common.src.circuit_breaker`). Пока автомат хостинга
+разомкнут, его задачи не занимают потоки: они откладываются у брокера на `BREAKER_OPEN_TIMEOUT` секунд
+(`Transport.defer`) и подтверждаются только после того, как брокер принял отложенную копию. Вернувшаяся задача
+выполняется, если автомат замкнулся, служит пробным обращением, если он полуразомкнут, и откладывается снова, если
+он всё ещё разомкнут. Задачи с наступившим сроком получают ответ 504, а задачи, которые не удалось отложить, - 503.
+
+Задача загрузки видео учитывается в автомате один раз: проба (`/api/probe`) сама результат не записывает, а время
+пробы передаётся вместе с итогом загрузки. Если загрузчик недоступен уже при пробе, загрузка не запрашивается.
 """
-import json
-import logging
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import signal
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from http import HTTPStatus
-from threading import current_thread
-from typing import Tuple, NoReturn
+from threading import Event, Lock, local
+from typing import TYPE_CHECKING, Callable, List, NoReturn, Optional, Set, Tuple
+from urllib.parse import urlparse
 
-import pika
 import requests
 from decouple import config
-from pika.adapters.blocking_connection import BlockingChannel
-from pika.spec import Basic
-from pika.spec import BasicProperties
-from telebot import asyncio_helper, apihelper, TeleBot
-
-logger = logging.getLogger("Worker")
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 
-logger.setLevel(logging.INFO)
+from common.src.circuit_breaker import CircuitBreaker
+from common.src.deadline import DeadlineExceeded, check, expired, remaining, to_headers
+from common.src.hostings import VIDEO_URLS, PLAYLIST_URLS
+from common.src.logs import get_logger
+from common.src.messages import (Message, MessageError, VideoTask, PlaylistTask, VideoAnswer, PlaylistAnswer,
+                                 CONTENT_TYPE, encode, decode)
+from common.src.playlist_stream import aiter_chunks, iter_chunks
+from common.src.probe import REJECTED
+from common.src.profiling import Profiler, serve_admin
+from common.src.transport import create_transport, deferred_arguments, deferred_queue
+from common.src.upload import asend_video_path, aupload_video, send_video_path, server_path, upload_video
 
-handler = logging.StreamHandler()
+if TYPE_CHECKING:
+    import asyncio
 
-handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+    import aiohttp
+    from aio_pika.abc import AbstractIncomingMessage
 
-logger.addHandler(handler)
+logger = get_logger("Worker")
 
 videohostings = {
     'youtube': {
         'host': config('YOUTUBE_LOADER_HOST'),
         'port': config('YOUTUBE_LOADER_PORT'),
-        'playlist': 'https://www.youtube.com/playlist?list={0}',
-        'video': 'https://www.youtube.com/watch?v={0}',
+        'playlist': PLAYLIST_URLS['youtube'],
+        'video': VIDEO_URLS['youtube'],
     },
     'vk': {
         'host': config('VK_LOADER_HOST'),
         'port': config('VK_LOADER_PORT'),
-        'playlist': 'https://vk.com/video/playlist/{0}',
-        'video': 'https://vk.com/video?z=video{0}',
+        'playlist': PLAYLIST_URLS['vk'],
+        'video': VIDEO_URLS['vk'],
     }
 }
 
-RMQ_HOST = config('RMQ_HOST')
-RMQ_PORT = config('RMQ_PORT')
+RMQ_HOST = config('RMQ_HOST', default='')
+RMQ_PORT = config('RMQ_PORT', default=5672)
+TRANSPORT_URL = config('TRANSPORT_URL', default=f'amqp://{RMQ_HOST}:{RMQ_PORT}')
 
 DOWNLOADER_BOT_API_KEY = config('DOWNLOADER_BOT_API_KEY')
 
@@ -50,44 +70,203 @@ DOWNLOAD_CHAT_ID = config('DOWNLOAD_CHAT_ID')
 
 TELEGRAM_SERVER_HOST = config('LOCAL_TELEGRAM_API_SERVER_HOST')
 TELEGRAM_SERVER_PORT = config('LOCAL_TELEGRAM_API_SERVER_PORT')
+TELEGRAM_SERVER_MEDIA_ROOT = config('LOCAL_TELEGRAM_API_SERVER_MEDIA_ROOT', default='')
+
+MEDIA_ROOT = config('MEDIA_ROOT', default='/media')
+
+PROBE_TIMEOUT = config('PROBE_TIMEOUT', default=30, cast=float)
+LOADER_TIMEOUT = config('LOADER_TIMEOUT', default=1000, cast=float)
+PLAYLIST_TIMEOUT = config('PLAYLIST_TIMEOUT', default=100, cast=float)
+UPLOAD_TIMEOUT = config('UPLOAD_TIMEOUT', default=1000, cast=float)
+
+WORKER_PROCESSES = config('WORKER_PROCESSES', default=1, cast=int)
+WORKER_THREADS = config('WORKER_THREADS', default=10, cast=int)
+WORKER_SHUTDOWN_TIMEOUT = config('WORKER_SHUTDOWN_TIMEOUT', default=110, cast=float)
+WORKER_ENGINE = config('WORKER_ENGINE', default='thread')
+WORKER_CONCURRENCY = config('WORKER_CONCURRENCY', default=200, cast=int)
+WORKER_ADMIN_PORT = config('WORKER_ADMIN_PORT', default=0, cast=int)
+
+BREAKER_WINDOW = config('BREAKER_WINDOW', default=20, cast=int)
+BREAKER_MIN_CALLS = config('BREAKER_MIN_CALLS', default=5, cast=int)
+BREAKER_FAILURE_RATE = config('BREAKER_FAILURE_RATE', default=0.5, cast=float)
+BREAKER_SLOW_CALL = config('BREAKER_SLOW_CALL', default=10, cast=float)
+BREAKER_SLOW_RATE = config('BREAKER_SLOW_RATE', default=0.5, cast=float)
+BREAKER_OPEN_TIMEOUT = config('BREAKER_OPEN_TIMEOUT', default=30, cast=float)
+
+ADMIN_TOKEN = config('ADMIN_TOKEN', default='')
+
+_locals = local()
+
+transport = create_transport(TRANSPORT_URL, queues=('task_queue', 'answer_queue'))
+
+profiler = Profiler(config('PROFILE_EVERY', default=0, cast=int), config('PROFILE_THRESHOLD', default=0, cast=float))
+
+breakers = {hosting: CircuitBreaker(hosting, BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE,
+                                    BREAKER_SLOW_CALL or None, BREAKER_SLOW_RATE, BREAKER_OPEN_TIMEOUT)
+            for hosting in videohostings}
+
+
+def get_local() -> requests.Session:
+    """
+    Возвращает HTTP-сессию рабочего потока для загрузки видео на локальный сервер (non-thread-safe)
+    Создаёт новую сессию, если таковой еще нет
+
+    :return: Сессия рабочего потока
+    """
+    if not hasattr(_locals, 'session'):
+        logger.info("New local generating")
+        _locals.session = requests.Session()
+    return _locals.session
+
+
+def unhealthy(status: int) -> bool:
+    """
+    :param status: Код ответа загрузчика
+    :return: True, если код означает сбой загрузчика. Коды 4xx - отказ по конкретному видео, 504 - загрузчик
+        прервал работу по сроку задачи
+    """
+    return status >= HTTPStatus.INTERNAL_SERVER_ERROR and status != HTTPStatus.GATEWAY_TIMEOUT
+
+
+def observe(hosting: str, failed: bool, elapsed: Optional[float] = None, deadline: Optional[float] = None) -> None:
+    """
+    Учитывает обращение к загрузчику в автомате хостинга. Ошибка после наступления срока задачи не учитывается:
+    ожидание было ограничено остатком срока, а не временем ответа загрузчика
+
+    :param hosting: Видео-хостинг
+    :param failed: Обращение завершилось сбоем загрузчика
+    :param elapsed: Время обращения в секундах, None - время не учитывается
+    :param deadline: Срок задачи
+    """
+    if failed and expired(deadline):
+        return
+    breakers[hosting].record(failed, elapsed)
+
+
+def refusal(task: Message, error_code: int) -> Message:
+    """
+    Составляет ответ на задачу, которая не выполнялась
+
+    :param task: Задача на загрузку видео или получение плейлиста
+    :param error_code: Код ошибки
+    :return: Ответное сообщение
+    """
+    urls = videohostings[task.hosting]
+    if isinstance(task, PlaylistTask):
+        return PlaylistAnswer.from_task(task, error_code=error_code,
+                                        playlist_url=urls['playlist'].format(task.playlist_id))
+    playlist_url = urls['playlist'].format(task.playlist_id) if task.playlist_id else None
+    return VideoAnswer.from_task(task, error_code=error_code, video_url=urls['video'].format(task.video_id),
+                                 playlist_url=playlist_url)
+
+
+def circuits(transport=transport) -> dict:
+    """
+    :param transport: Транспорт, у которого запрашивается число отложенных задач
+    :return: Состояние автоматов хостингов и число отложенных задач для `/admin/profile`
+    """
+    return {hosting: {**breaker.stats(),
+                      'parked': transport.depth(deferred_queue('task_queue', BREAKER_OPEN_TIMEOUT, hosting))}
+            for hosting, breaker in breakers.items()}
+
+
+def send_video(path: str, deadline: Optional[float] = None) -> str:
+    """
+    Загружает видео на локальный сервер. Если каталог с видео подключён к серверу, передаёт только путь к файлу,
+    иначе или если сервер не смог прочитать файл - передаёт сам файл
+
+    :param path: Путь к файлу видео
+    :param deadline: Срок задачи
+    :return: file_id загруженного видео
+    """
+    remote = server_path(path, MEDIA_ROOT, TELEGRAM_SERVER_MEDIA_ROOT)
+    if remote is not None:
+        try:
+            check(deadline)
+            return send_video_path(DOWNLOADER_BOT_API_KEY, DOWNLOAD_CHAT_ID, remote, timeout=remaining(deadline, 60),
+                                   session=get_local())
+        except (ApiTelegramException, requests.RequestException) as e:
+            logger.warning("Send by path failed, uploading file: %s, %s", e.__class__.__name__, e)
+    check(deadline)
+    with open(path, 'rb') as f:
+        return upload_video(DOWNLOADER_BOT_API_KEY, DOWNLOAD_CHAT_ID, f, timeout=remaining(deadline, UPLOAD_TIMEOUT),
+                            session=get_local())
+
+
+def probe(hosting: str, url: str, deadline: Optional[float] = None) -> Optional[dict]:
+    """
+    Запрашивает у загрузчика описание видео перед загрузкой. Результат в автомате хостинга не учитывается: его
+    учитывает загрузка вместе со своим итогом
+
+    :param hosting: Видео-хостинг
+    :param url: Ссылка на видео
+    :param deadline: Срок задачи
+    :return: Ответ `/api/probe` или None, если загрузчик не смог проверить видео
+    :raises requests.ConnectionError: Загрузчик недоступен
+    """
+    try:
+        response = requests.get(
+            f'http://{videohostings[hosting]["host"]}:{videohostings[hosting]["port"]}/api/probe',
+            params={'url': url},
+            headers=to_headers(deadline),
+            timeout=remaining(deadline, PROBE_TIMEOUT)
+        )
+    except requests.ConnectionError:
+        raise
+    except requests.RequestException as e:
+        logger.warning("Probe fail: %s, %s", e.__class__.__name__, e)
+        return None
+    if response.status_code != HTTPStatus.OK:
+        logger.warning("Probe fail with status code: %s", response.status_code)
+        return None
+    return response.json()
+
+
+def broker_address(url: str = TRANSPORT_URL) -> Tuple[str, int]:
+    """
+    Возвращает адрес RabbitMQ для `AsyncWorker`, который получает задачи и публикует ответы через `aio_pika`,
+    а не через `common.src.transport`
 
-_locals = {}
+    :param url: Адрес транспорта `TRANSPORT_URL`
+    :return: Хост и порт RabbitMQ
+    :raises ValueError: Транспорт не RabbitMQ, например `memory://`
+    """
+    parsed = urlparse(url)
+    if parsed.scheme != 'amqp':
+        raise ValueError(f"WORKER_ENGINE=asyncio supports only amqp:// transport, got: {url}")
+    return parsed.hostname, parsed.port or 5672
 
 
-def get_local() -> Tuple[TeleBot, pika.BlockingConnection, BlockingChannel]:
+def reply(answer: Message) -> NoReturn:
     """
-    Возвращает список из объектов, требующих уникальное соединение для работы внутри потоков(non-thread-safe)
-    Создаёт новые соединения, если таковых еще нет
+    Передаёт ответное сообщение общему транспорту процесса. Ответ публикуется в очередь `reply_to` экземпляра Loader,
+    поставившего задачу, или в общую `answer_queue`
 
-    :return: Список локальных атрибутов рабочего потока
+    :param answer: Ответное сообщение
     """
-    thread = current_thread()
-    key = '_local.' + str(id(thread))
-    if key not in _locals.keys():
-        logger.info(f"New local generating")
-        _bot = TeleBot(DOWNLOADER_BOT_API_KEY)
-        _con = pika.BlockingConnection(pika.ConnectionParameters(host=RMQ_HOST, port=RMQ_PORT, heartbeat=0))
-        _ch = _con.channel()
-        _ch.queue_declare('answer_queue')
-        _locals[key] = [_bot, _con, _ch]
-    return _locals[key]
+    transport.publish(answer.reply_to or 'answer_queue', answer)
+    logger.info("Reply-message send")
 
 
 class Worker:
     """
     Обрабатывает запросы на добавление видеозаписей и запускает параллельные процессы загрузки
 
+    Задача подтверждается только после завершения, а транспорт выдаёт процессу не больше задач, чем у него
+    потоков, поэтому задачи распределяются между процессами равномерно, а задачи упавшего процесса получают другие.
+
     :ivar `concurrent.futures.ThreadPoolExecutor` pool: Группа потоков для выполнения задач
-    :ivar `pika.adapters.blocking_connection.BlockingConnection` connection: Объект соединения с RabbitMQ
-    :ivar `pika.adapters.blocking_connection.BlockingChannel` channel: Канал для общения с RabbitMQ
+    :ivar `common.src.transport.Transport` transport: Транспорт задач и ответов
     """
 
-    def __init__(self):
-        self.pool = ThreadPoolExecutor(max_workers=10)
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=RMQ_HOST, port=RMQ_PORT, heartbeat=0))
-        self.channel = self.connection.channel()
-        self.channel.queue_declare('task_queue')
-        self.channel.basic_consume('task_queue', self.process_task, auto_ack=True)
+    def __init__(self, threads: int = WORKER_THREADS):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.transport = transport
+        self.transport.consume('task_queue', self.process_task, prefetch=threads)
+        profiler.expose('circuits', circuits)
+        self._inflight = 0
+        self._inflight_lock = Lock()
+        self._stopping = Event()
         self.configure_bot()
 
     @staticmethod
@@ -98,119 +277,676 @@ class Worker:
         :return: None
         """
         apihelper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
-        asyncio_helper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
 
-    def process_task(self, channel: BlockingChannel, method: Basic.Deliver, properties: BasicProperties,
-                     body: bytes) -> NoReturn:
+    def process_task(self, task: Message, ack: Callable[[], None]) -> NoReturn:
+        """
+        Обрабатывает добавленные в очередь задачи, подтверждает задачу после её выполнения. Задачи хостинга
+        с разомкнутым автоматом откладываются и подтверждаются после приёма брокером отложенной копии
+
+        :param task: Задача
+        :param ack: Функция подтверждения задачи
         """
-        Обрабатывает добавленные в очередь задачи
+        logger.info("Receive message: %s", task.type)
+        handlers = {'download': self.download, 'playlist': self.playlist, 'return': self._return}
+        if task.type not in handlers:
+            ack()
+            return
+        if task.type != 'return' and not breakers[task.hosting].allow():
+            self.park(task, ack)
+            return
+        self._submit(handlers[task.type], task, ack)
+
+    def _submit(self, handler: Callable[[Message], NoReturn], task: Message, ack: Callable[[], None]) -> NoReturn:
+        with self._inflight_lock:
+            self._inflight += 1
+        self.pool.submit(handler, task).add_done_callback(partial(self._done, ack))
+
+    def park(self, task: Message, ack: Callable[[], None]) -> NoReturn:
         """
-        payload = json.loads(body.decode("utf-8"))
-        logger.info(f"Receive message: {payload['type']}")
-        if payload['type'] == 'download':
-            self.pool.submit(self.download, payload)
-        elif payload['type'] == 'playlist':
-            self.pool.submit(self.playlist, payload)
-        elif payload['type'] == 'return':
-            self.pool.submit(self._return, payload)
+        Откладывает задачу у брокера на `BREAKER_OPEN_TIMEOUT` секунд, исходная задача подтверждается после приёма
+        отложенной копии. Задача с наступившим сроком получает ответ 504, а если отложить её не удалось - ответ 503
+
+        :param task: Задача на загрузку видео или получение плейлиста
+        :param ack: Функция подтверждения задачи
+        """
+        if expired(task.deadline):
+            reply(refusal(task, HTTPStatus.GATEWAY_TIMEOUT))
+            ack()
+            return
+        future = self.transport.defer('task_queue', task, BREAKER_OPEN_TIMEOUT, task.hosting)
+        future.add_done_callback(partial(self._parked, task, ack))
 
     @staticmethod
-    def download(payload: dict) -> NoReturn:
+    def _parked(task: Message, ack: Callable[[], None], future: Future) -> NoReturn:
         """
-        Загружает видео на сервер telegram
+        Подтверждает отложенную задачу. Вызывается из потока издателя
 
-        :param payload: Словарь с параметрами, для начала загрузки требуются поля `url`, `hosting`
+        :param task: Задача
+        :param ack: Функция подтверждения задачи
+        :param future: Результат публикации отложенной копии
         """
-        bot, con, ch = get_local()
-        hosting = payload['hosting']
-        url = videohostings[hosting]['video'].format(payload['video_id'])
+        if future.exception() is not None:
+            logger.warning("Circuit %s open, task not parked: %s", task.hosting, future.exception())
+            reply(refusal(task, HTTPStatus.SERVICE_UNAVAILABLE))
+        ack()
+
+    def _done(self, ack: Callable[[], None], future: Future) -> NoReturn:
+        """
+        Подтверждает выполненную задачу. Вызывается из потока задачи
+
+        :param ack: Функция подтверждения задачи
+        :param future: Результат выполнения задачи
+        """
+        if future.exception() is not None:
+            logger.error("Task failed: %s, %s", future.exception().__class__.__name__, future.exception())
+        ack()
+        with self._inflight_lock:
+            self._inflight -= 1
+
+    def stop(self) -> NoReturn:
+        """
+        Прекращает получение новых задач, начатые задачи будут выполнены. Можно вызывать из любого потока и из
+        обработчика сигнала
+        """
+        self._stopping.set()
+
+    @staticmethod
+    @profiler.profile('download')
+    def download(task: VideoTask) -> NoReturn:
+        """
+        Загружает видео на сервер telegram. Видео, которые загрузчик заранее отклонил по размеру или из-за
+        ограничений доступа, не загружаются. Каждый этап ожидает не дольше срока задачи, после срока задача
+        завершается ответом с кодом 504
+
+        :param task: Задача на загрузку видео
+        """
+        start = time.monotonic()
+        hosting = task.hosting
+        url = videohostings[hosting]['video'].format(task.video_id)
+        playlist_url = videohostings[hosting]['playlist'].format(task.playlist_id) if task.playlist_id else None
         file_id = None
         error_code = None
-        logger.info(f"Download start, url: {url}")
-        response = requests.post(
-            f'http://{videohostings[hosting]["host"]}:{videohostings[hosting]["port"]}/api/download',
-            json={'url': url},
-            timeout=1000
-        )
-        if response.status_code == HTTPStatus.OK:
-            path = response.text
-            logger.info(f"Download complete, file_path: {path}")
-            try:
-                with open(path, 'rb') as f:
-                    file_id = bot.send_video(DOWNLOAD_CHAT_ID, f, timeout=1000).video.file_id
-            except Exception as e:
-                logger.error(f"Fatal error: {e.__class__.__name__}, {e}, {e.args}")
-                error_code = HTTPStatus.INTERNAL_SERVER_ERROR
-        else:
-            logger.warning(f"Download fail with status code: {response.status_code}")
-            error_code = response.status_code
-        ch.basic_publish(
-            exchange='',
-            routing_key='answer_queue',
-            body=json.dumps(payload | {'file_id': file_id, 'error_code': error_code, 'video_url': url}))
-        logger.info(f"Reply-message send")
+        try:
+            check(task.deadline)
+            info = probe(hosting, url, task.deadline)
+            probed = time.monotonic() - start
+            if info is not None and info['status'] in REJECTED:
+                logger.warning("Download rejected by probe with status code: %s", info['status'])
+                observe(hosting, False, probed)
+                reply(VideoAnswer.from_task(task, error_code=info['status'], video_url=url, playlist_url=playlist_url,
+                                            elapsed=time.monotonic() - start))
+                return
+            logger.info("Download start, url: %s", url)
+            check(task.deadline)
+            response = requests.post(
+                f'http://{videohostings[hosting]["host"]}:{videohostings[hosting]["port"]}/api/download',
+                json={'url': url, 'format': info['format'] if info else None},
+                headers=to_headers(task.deadline),
+                timeout=remaining(task.deadline, LOADER_TIMEOUT)
+            )
+            observe(hosting, unhealthy(response.status_code), probed)
+            if response.status_code == HTTPStatus.OK:
+                path = response.text
+                logger.info("Download complete, file_path: %s", path)
+                try:
+                    file_id = send_video(path, task.deadline)
+                except Exception as e:
+                    logger.error("Fatal error: %s, %s, %s", e.__class__.__name__, e, e.args)
+                    error_code = HTTPStatus.GATEWAY_TIMEOUT if expired(task.deadline) else \
+                        HTTPStatus.INTERNAL_SERVER_ERROR
+            else:
+                logger.warning("Download fail with status code: %s", response.status_code)
+                error_code = response.status_code
+        except DeadlineExceeded as e:
+            logger.warning("Download abandoned: %s", e)
+            error_code = HTTPStatus.GATEWAY_TIMEOUT
+        except requests.RequestException as e:
+            logger.error("Download fail: %s, %s", e.__class__.__name__, e)
+            observe(hosting, True, deadline=task.deadline)
+            error_code = HTTPStatus.GATEWAY_TIMEOUT if expired(task.deadline) else HTTPStatus.BAD_GATEWAY
+        reply(VideoAnswer.from_task(task, file_id=file_id, error_code=error_code, video_url=url,
+                                    playlist_url=playlist_url, elapsed=time.monotonic() - start))
 
     @staticmethod
-    def playlist(payload: dict) -> NoReturn:
+    @profiler.profile('playlist')
+    def playlist(task: PlaylistTask) -> NoReturn:
         """
-        Получает информацию о всех видеозаписях в плейлисте
+        Получает информацию о всех видеозаписях в плейлисте и пересылает её частями по мере получения
 
-        :param payload: Словарь параметров, для работы требуются поля `playlist_id`, `hosting`
+        :param task: Задача на получение плейлиста
         """
-        bot, con, ch = get_local()
-        playlist_id = payload['playlist_id']
-        hosting = payload['hosting']
-        url = videohostings[hosting]['playlist'].format(playlist_id)
-
-        logger.info(f"Playlist get start, url: {url}")
-        response = requests.get(
-            f'http://{videohostings[hosting]["host"]}:{videohostings[hosting]["port"]}/api/get/playlist',
-            params={'url': url},
-            timeout=100
-        )
-        error_code = None
-        video_ids = json.loads(response.text)['video_ids']
-        if response.status_code == HTTPStatus.OK:
-            logger.info(f"Playlist get complete")
-        else:
-            logger.warning(f"Playlist get fail with status code: {response.status_code}")
-            error_code = response.status_code
-        ch.basic_publish(
-            exchange='',
-            routing_key='answer_queue',
-            body=json.dumps(payload | {'video_ids': video_ids, 'error_code': error_code, 'playlist_url': url}))
-        logger.info(f"Reply-message send")
+        hosting = task.hosting
+        url = videohostings[hosting]['playlist'].format(task.playlist_id)
+
+        logger.info("Playlist get start, url: %s", url)
+        parts = 0
+        start = time.monotonic()
+        try:
+            check(task.deadline)
+            with requests.get(
+                    f'http://{videohostings[hosting]["host"]}:{videohostings[hosting]["port"]}/api/get/playlist',
+                    params={'url': url},
+                    headers=to_headers(task.deadline),
+                    timeout=remaining(task.deadline, PLAYLIST_TIMEOUT),
+                    stream=True
+            ) as response:
+                observe(hosting, unhealthy(response.status_code), time.monotonic() - start)
+                if response.status_code == HTTPStatus.OK:
+                    for seq, video_ids, last, error_code in iter_chunks(response.iter_lines()):
+                        reply(PlaylistAnswer.from_task(task, video_ids=video_ids, error_code=error_code,
+                                                       playlist_url=url, seq=seq, last=last))
+                        parts = seq + 1
+                    if error_code is None:
+                        logger.info("Playlist get complete, parts: %s", parts)
+                    else:
+                        logger.warning("Playlist get fail with status code: %s", error_code)
+                    return
+                error_code = response.status_code
+        except DeadlineExceeded as e:
+            logger.warning("Playlist get abandoned: %s", e)
+            error_code = HTTPStatus.GATEWAY_TIMEOUT
+        except requests.RequestException as e:
+            logger.error("Playlist get fail: %s, %s", e.__class__.__name__, e)
+            observe(hosting, True, deadline=task.deadline)
+            error_code = HTTPStatus.GATEWAY_TIMEOUT if expired(task.deadline) else HTTPStatus.BAD_GATEWAY
+        logger.warning("Playlist get fail with status code: %s", error_code)
+        reply(PlaylistAnswer.from_task(task, error_code=error_code, playlist_url=url, seq=parts))
 
     @staticmethod
-    def _return(payload: dict) -> NoReturn:
+    @profiler.profile('return')
+    def _return(task: VideoTask) -> NoReturn:
         """
         Возвращает запрос как ответ
 
-        :param payload: Словарь параметров
+        :param task: Задача на возврат загруженного видео
         """
-        bot, con, ch = get_local()
-        video_url = None
+        video_url = videohostings[task.hosting]['video'].format(task.video_id)
         playlist_url = None
-        if payload.get('video_id', None):
-            video_url = videohostings[payload['hosting']]['video'].format(payload['video_id'])
-        if payload.get('playlist_id', None):
-            playlist_url = videohostings[payload['hosting']]['playlist'].format(payload['playlist_id'])
-        logger.info(f"Return task accept")
-        ch.basic_publish(
-            exchange='',
-            routing_key='answer_queue',
-            body=json.dumps(payload | {'video_url': video_url, 'playlist_url': playlist_url}))
-        logger.info(f"Reply-message send")
+        if task.playlist_id:
+            playlist_url = videohostings[task.hosting]['playlist'].format(task.playlist_id)
+        logger.info("Return task accept")
+        reply(VideoAnswer.from_task(task, video_url=video_url, playlist_url=playlist_url))
 
     def run(self) -> NoReturn:
         """
         Запускает приложение
         """
         logger.info("Worker start")
-        self.channel.start_consuming()
+        self.transport.start()
+        try:
+            while not self._stopping.wait(1):
+                pass
+            logger.info("Worker stopping, tasks in progress: %s", self._inflight)
+        finally:
+            self.transport.stop()
+            self.pool.shutdown()
+
+
+class AsyncWorker:
+    """
+    Асинхронный вариант Worker: задачи выполняются корутинами в одном потоке, поэтому процесс может держать сотни
+    задач, ожидающих загрузчики и локальный сервер, без потока на каждую задачу. Принимает те же задачи и отправляет
+    те же ответы, что и `Worker`. `asyncio`, `aiohttp` и `aio_pika` импортируются в методах, поэтому процесс
+    с `WORKER_ENGINE=thread` их не загружает
+
+    :ivar `int` concurrency: Максимальное количество одновременно выполняемых задач
+    :ivar `str` host: Хост RabbitMQ из `TRANSPORT_URL`
+    :ivar `int` port: Порт RabbitMQ из `TRANSPORT_URL`
+    :ivar `aiohttp.ClientSession` session: HTTP-сессия для обращения к загрузчикам и локальному серверу
+    :ivar `aio_pika.abc.AbstractExchange` exchange: Точка обмена для ответных сообщений
+    """
+
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY):
+        self.concurrency = concurrency
+        self.host, self.port = broker_address()
+        self.session: Optional['aiohttp.ClientSession'] = None
+        self.exchange = None
+        profiler.expose('circuits', circuits)
+        self._tasks: Set['asyncio.Task'] = set()
+        self._stopping: Optional['asyncio.Event'] = None
+        self.configure_bot()
+
+    @staticmethod
+    def configure_bot() -> NoReturn:
+        """
+        Привязка бота и асинхронного клиента telebot к локальному серверу
+        """
+        from telebot import asyncio_helper
+
+        Worker.configure_bot()
+        asyncio_helper.API_URL = f"http://{TELEGRAM_SERVER_HOST}:{TELEGRAM_SERVER_PORT}" + "/bot{0}/{1}"
+
+    @staticmethod
+    def _loader(hosting: str, path: str) -> str:
+        return f'http://{videohostings[hosting]["host"]}:{videohostings[hosting]["port"]}{path}'
+
+    @staticmethod
+    def _timeout(deadline: Optional[float], limit: Optional[float] = None, **kwargs) -> 'aiohttp.ClientTimeout':
+        """
+        Ограничивает ожидание запроса остатком срока задачи. aiohttp считает нулевой `total` отсутствием
+        ограничения, поэтому остаток не бывает меньше миллисекунды
+
+        :param deadline: Срок задачи
+        :param limit: Ограничение ожидания этапа, None - только срок
+        :param kwargs: Остальные параметры `aiohttp.ClientTimeout`
+        :return: Ограничение ожидания, без срока и `limit` - не ограничено
+        """
+        import aiohttp
+
+        total = remaining(deadline, limit)
+        return aiohttp.ClientTimeout(total=max(total, 0.001) if total is not None else None, **kwargs)
+
+    async def reply(self, answer: Message) -> NoReturn:
+        """
+        Публикует ответное сообщение и ожидает подтверждения брокера
+
+        :param answer: Ответное сообщение
+        """
+        import aio_pika
+
+        await self.exchange.publish(aio_pika.Message(encode(answer), content_type=CONTENT_TYPE),
+                                    routing_key=answer.reply_to or 'answer_queue')
+        logger.info("Reply-message send")
+
+    async def probe(self, hosting: str, url: str, deadline: Optional[float] = None) -> Optional[dict]:
+        """
+        Асинхронный вариант `probe`
+
+        :param hosting: Видео-хостинг
+        :param url: Ссылка на видео
+        :param deadline: Срок задачи
+        :return: Ответ `/api/probe` или None, если загрузчик не смог проверить видео
+        :raises aiohttp.ClientConnectorError: Загрузчик недоступен
+        """
+        import asyncio
+
+        import aiohttp
+
+        try:
+            async with self.session.get(self._loader(hosting, '/api/probe'), params={'url': url},
+                                        headers=to_headers(deadline),
+                                        timeout=self._timeout(deadline, PROBE_TIMEOUT)) as response:
+                if response.status != HTTPStatus.OK:
+                    logger.warning("Probe fail with status code: %s", response.status)
+                    return None
+                return await response.json()
+        except aiohttp.ClientConnectorError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Probe fail: %s, %s", e.__class__.__name__, e)
+            return None
+
+    async def send_video(self, path: str, deadline: Optional[float] = None) -> str:
+        """
+        Асинхронный вариант `send_video`
+
+        :param path: Путь к файлу видео
+        :param deadline: Срок задачи
+        :return: file_id загруженного видео
+        """
+        import asyncio
+
+        import aiohttp
+
+        remote = server_path(path, MEDIA_ROOT, TELEGRAM_SERVER_MEDIA_ROOT)
+        if remote is not None:
+            try:
+                check(deadline)
+                return await asend_video_path(self.session, DOWNLOADER_BOT_API_KEY, DOWNLOAD_CHAT_ID, remote,
+                                              timeout=remaining(deadline, 60))
+            except (ApiTelegramException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Send by path failed, uploading file: %s, %s", e.__class__.__name__, e)
+        check(deadline)
+        with open(path, 'rb') as f:
+            return await aupload_video(self.session, DOWNLOADER_BOT_API_KEY, DOWNLOAD_CHAT_ID, f,
+                                       timeout=remaining(deadline, UPLOAD_TIMEOUT))
+
+    @profiler.profile('download')
+    async def download(self, task: VideoTask) -> NoReturn:
+        """
+        Загружает видео на сервер telegram
+
+        :param task: Задача на загрузку видео
+        """
+        import asyncio
+
+        import aiohttp
+
+        start = time.monotonic()
+        hosting = task.hosting
+        url = videohostings[hosting]['video'].format(task.video_id)
+        playlist_url = videohostings[hosting]['playlist'].format(task.playlist_id) if task.playlist_id else None
+        file_id = None
+        error_code = None
+        if expired(task.deadline):
+            logger.warning("Download abandoned: deadline %.3f exceeded", task.deadline)
+            await self.reply(VideoAnswer.from_task(task, error_code=HTTPStatus.GATEWAY_TIMEOUT, video_url=url,
+                                                   playlist_url=playlist_url, elapsed=time.monotonic() - start))
+            return
+        try:
+            info = await self.probe(hosting, url, task.deadline)
+            probed = time.monotonic() - start
+            if info is not None and info['status'] in REJECTED:
+                logger.warning("Download rejected by probe with status code: %s", info['status'])
+                observe(hosting, False, probed)
+                await self.reply(VideoAnswer.from_task(task, error_code=info['status'], video_url=url,
+                                                       playlist_url=playlist_url, elapsed=time.monotonic() - start))
+                return
+            logger.info("Download start, url: %s", url)
+            check(task.deadline)
+            async with self.session.post(self._loader(hosting, '/api/download'),
+                                         json={'url': url, 'format': info['format'] if info else None},
+                                         headers=to_headers(task.deadline),
+                                         timeout=self._timeout(task.deadline, LOADER_TIMEOUT)) as response:
+                status, path = response.status, await response.text()
+            observe(hosting, unhealthy(status), probed)
+        except (aiohttp.ClientError, asyncio.TimeoutError, DeadlineExceeded) as e:
+            logger.error("Download fail: %s, %s", e.__class__.__name__, e)
+            observe(hosting, True, deadline=task.deadline)
+            status = HTTPStatus.GATEWAY_TIMEOUT if expired(task.deadline) else HTTPStatus.BAD_GATEWAY
+            path = None
+        if status == HTTPStatus.OK:
+            logger.info("Download complete, file_path: %s", path)
+            try:
+                file_id = await self.send_video(path, task.deadline)
+            except Exception as e:
+                logger.error("Fatal error: %s, %s, %s", e.__class__.__name__, e, e.args)
+                error_code = HTTPStatus.GATEWAY_TIMEOUT if expired(task.deadline) else \
+                    HTTPStatus.INTERNAL_SERVER_ERROR
+        else:
+            logger.warning("Download fail with status code: %s", status)
+            error_code = status
+        await self.reply(VideoAnswer.from_task(task, file_id=file_id, error_code=error_code, video_url=url,
+                                               playlist_url=playlist_url, elapsed=time.monotonic() - start))
+
+    @profiler.profile('playlist')
+    async def playlist(self, task: PlaylistTask) -> NoReturn:
+        """
+        Получает информацию о всех видеозаписях в плейлисте и пересылает её частями по мере получения
+
+        :param task: Задача на получение плейлиста
+        """
+        import asyncio
+
+        import aiohttp
+
+        url = videohostings[task.hosting]['playlist'].format(task.playlist_id)
+        logger.info("Playlist get start, url: %s", url)
+        parts = 0
+        start = time.monotonic()
+        try:
+            check(task.deadline)
+            async with self.session.get(self._loader(task.hosting, '/api/get/playlist'), params={'url': url},
+                                        headers=to_headers(task.deadline),
+                                        timeout=self._timeout(task.deadline, sock_read=PLAYLIST_TIMEOUT)) as response:
+                observe(task.hosting, unhealthy(response.status), time.monotonic() - start)
+                if response.status == HTTPStatus.OK:
+                    async for seq, video_ids, last, error_code in aiter_chunks(response.content):
+                        await self.reply(PlaylistAnswer.from_task(task, video_ids=video_ids, error_code=error_code,
+                                                                  playlist_url=url, seq=seq, last=last))
+                        parts = seq + 1
+                    if error_code is None:
+                        logger.info("Playlist get complete, parts: %s", parts)
+                    else:
+                        logger.warning("Playlist get fail with status code: %s", error_code)
+                    return
+                error_code = response.status
+        except DeadlineExceeded as e:
+            logger.warning("Playlist get abandoned: %s", e)
+            error_code = HTTPStatus.GATEWAY_TIMEOUT
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error("Playlist get fail: %s, %s", e.__class__.__name__, e)
+            observe(task.hosting, True, deadline=task.deadline)
+            error_code = HTTPStatus.GATEWAY_TIMEOUT if expired(task.deadline) else HTTPStatus.BAD_GATEWAY
+        logger.warning("Playlist get fail with status code: %s", error_code)
+        await self.reply(PlaylistAnswer.from_task(task, error_code=error_code, playlist_url=url, seq=parts))
+
+    @profiler.profile('return')
+    async def _return(self, task: VideoTask) -> NoReturn:
+        """
+        Возвращает запрос как ответ
+
+        :param task: Задача на возврат загруженного видео
+        """
+        video_url = videohostings[task.hosting]['video'].format(task.video_id)
+        playlist_url = None
+        if task.playlist_id:
+            playlist_url = videohostings[task.hosting]['playlist'].format(task.playlist_id)
+        logger.info("Return task accept")
+        await self.reply(VideoAnswer.from_task(task, video_url=video_url, playlist_url=playlist_url))
+
+    async def process_task(self, message: 'AbstractIncomingMessage') -> NoReturn:
+        """
+        Запускает выполнение полученной задачи, задача подтверждается после выполнения. Задачи хостинга
+        с разомкнутым автоматом откладываются и подтверждаются после приёма брокером отложенной копии
+
+        :param message: Сообщение с задачей
+        """
+        import asyncio
+
+        try:
+            task = decode(message.body)
+        except MessageError as e:
+            logger.error("Skip message: %s", e)
+            await message.ack()
+            return
+        logger.info("Receive message: %s", task.type)
+        handlers = {'download': self.download, 'playlist': self.playlist, 'return': self._return}
+        if task.type not in handlers:
+            await message.ack()
+            return
+        if task.type != 'return' and not breakers[task.hosting].allow():
+            await self.park(task)
+            await message.ack()
+            return
+        running = asyncio.create_task(self._handle(handlers[task.type], task, message))
+        self._tasks.add(running)
+        running.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _handle(handler: Callable, task: Message, message: 'AbstractIncomingMessage') -> NoReturn:
+        try:
+            await handler(task)
+        except Exception as e:
+            logger.error("Task failed: %s, %s", e.__class__.__name__, e)
+        finally:
+            await message.ack()
+
+    async def park(self, task: Message) -> NoReturn:
+        """
+        Асинхронный вариант `Worker.park`. Публикация ожидает подтверждения брокера
+
+        :param task: Задача на загрузку видео или получение плейлиста
+        """
+        import aio_pika
+
+        if expired(task.deadline):
+            await self.reply(refusal(task, HTTPStatus.GATEWAY_TIMEOUT))
+            return
+        try:
+            await self.exchange.publish(aio_pika.Message(encode(task), content_type=CONTENT_TYPE),
+                                        routing_key=deferred_queue('task_queue', BREAKER_OPEN_TIMEOUT, task.hosting))
+        except Exception as e:
+            logger.warning("Circuit %s open, task not parked: %s, %s", task.hosting, e.__class__.__name__, e)
+            await self.reply(refusal(task, HTTPStatus.SERVICE_UNAVAILABLE))
+
+    def stop(self) -> NoReturn:
+        """
+        Прекращает получение новых задач, начатые задачи будут выполнены
+        """
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self) -> NoReturn:
+        """
+        Получает задачи до вызова `stop`, затем дожидается выполнения начатых задач
+        """
+        import asyncio
+
+        import aio_pika
+        import aiohttp
+
+        self._stopping = asyncio.Event()
+        self.session = aiohttp.ClientSession()
+        connection = await aio_pika.connect_robust(host=self.host, port=self.port, heartbeat=60)
+        try:
+            channel = await connection.channel()
+            await channel.set_qos(prefetch_count=self.concurrency)
+            await channel.declare_queue('answer_queue')
+            queue = await channel.declare_queue('task_queue')
+            for hosting in videohostings:
+                await channel.declare_queue(deferred_queue('task_queue', BREAKER_OPEN_TIMEOUT, hosting),
+                                            arguments=deferred_arguments('task_queue', BREAKER_OPEN_TIMEOUT))
+            self.exchange = channel.default_exchange
+            consumer_tag = await queue.consume(self.process_task)
+            logger.info("Async worker start, concurrency: %s", self.concurrency)
+            await self._stopping.wait()
+            await queue.cancel(consumer_tag)
+            logger.info("Async worker stopping, tasks in progress: %s", len(self._tasks))
+            while self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+        finally:
+            await connection.close()
+            await self.session.close()
+
+
+def admin_port() -> int:
+    """
+    Возвращает порт `/admin/profile` текущего процесса. Процессы, запущенные `Supervisor`, занимают порты подряд,
+    начиная с `WORKER_ADMIN_PORT`
+
+    :return: Порт или 0, если профиль не нужно отдавать
+    """
+    if not WORKER_ADMIN_PORT:
+        return 0
+    name = multiprocessing.current_process().name
+    return WORKER_ADMIN_PORT + (int(name.split('-')[1]) if name.startswith('worker-') else 0)
+
+
+def run_worker(threads: int = WORKER_THREADS) -> NoReturn:
+    """
+    Запускает Worker в текущем процессе. По SIGTERM или SIGINT перестаёт получать задачи и завершается после
+    выполнения начатых
+
+    :param threads: Количество потоков выполнения задач
+    """
+    serve_admin(profiler, admin_port(), ADMIN_TOKEN)
+    worker = Worker(threads)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.run()
+
+
+def run_async_worker(concurrency: int = WORKER_CONCURRENCY) -> NoReturn:
+    """
+    Запускает AsyncWorker в текущем процессе. По SIGTERM или SIGINT перестаёт получать задачи и завершается после
+    выполнения начатых
+
+    :param concurrency: Максимальное количество одновременно выполняемых задач
+    """
+    import asyncio
+
+    async def _main():
+        serve_admin(profiler, admin_port(), ADMIN_TOKEN)
+        worker = AsyncWorker(concurrency)
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, worker.stop)
+        loop.add_signal_handler(signal.SIGINT, worker.stop)
+        await worker.run()
+
+    asyncio.run(_main())
+
+
+class Supervisor:
+    """
+    Запускает несколько процессов Worker, перезапускает упавшие и корректно останавливает все процессы по SIGTERM
+
+    :ivar `int` processes: Количество процессов
+    :ivar `int` threads: Количество потоков выполнения задач в каждом процессе
+    :ivar `float` shutdown_timeout: Время ожидания завершения начатых задач при остановке, в секундах
+    :ivar `Callable` target: Функция, выполняемая в дочернем процессе
+    """
+
+    def __init__(self, processes: int = WORKER_PROCESSES, threads: int = WORKER_THREADS,
+                 shutdown_timeout: float = WORKER_SHUTDOWN_TIMEOUT, target: Callable = run_worker):
+        self.processes = processes
+        self.threads = threads
+        self.shutdown_timeout = shutdown_timeout
+        self.target = target
+        self._children: List[Optional[multiprocessing.Process]] = [None] * processes
+        self._started = [0.0] * processes
+        self._delays = [0.0] * processes
+        self._stopping = Event()
+
+    def _spawn(self, slot: int) -> NoReturn:
+        """
+        Запускает процесс в слоте `slot`
+
+        :param slot: Номер слота
+        """
+        process = multiprocessing.Process(target=self.target, args=(self.threads,), name=f'worker-{slot}')
+        process.start()
+        self._children[slot] = process
+        self._started[slot] = time.monotonic()
+        logger.info("Started worker-%s, pid %s", slot, process.pid)
+
+    def check(self) -> NoReturn:
+        """
+        Перезапускает завершившиеся процессы. Процесс, упавший вскоре после запуска, перезапускается с растущей
+        задержкой, чтобы не перезапускать его непрерывно
+        """
+        now = time.monotonic()
+        for slot, process in enumerate(self._children):
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                logger.warning("worker-%s exited with code %s", slot, process.exitcode)
+                process.join()
+                self._children[slot] = None
+                crashed_early = now - self._started[slot] < 10
+                self._delays[slot] = min(max(self._delays[slot] * 2, 1), 30) if crashed_early else 0
+                self._started[slot] = now + self._delays[slot]
+            if now >= self._started[slot]:
+                self._spawn(slot)
+
+    def stop(self) -> NoReturn:
+        """
+        Останавливает все процессы: отправляет SIGTERM и ждёт `shutdown_timeout` секунд, после чего завершает
+        оставшиеся принудительно
+        """
+        self._stopping.set()
+        alive = [process for process in self._children if process is not None and process.is_alive()]
+        for process in alive:
+            process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in alive:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("%s did not stop in %ss, killing", process.name, self.shutdown_timeout)
+                process.kill()
+                process.join()
+        logger.info("All workers stopped")
+
+    def run(self) -> NoReturn:
+        """
+        Запускает процессы и следит за ними до получения SIGTERM или SIGINT
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self._stopping.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stopping.set())
+        logger.info("Supervisor start: %s processes x %s threads", self.processes, self.threads)
+        while not self._stopping.is_set():
+            self.check()
+            self._stopping.wait(0.5)
+        self.stop()
 
 
 if __name__ == '__main__':
-    app = Worker()
-    app.run()
-    app.connection.close()
+    if WORKER_ENGINE == 'asyncio':
+        broker_address()
+        engine, capacity = run_async_worker, WORKER_CONCURRENCY
+    else:
+        engine, capacity = run_worker, WORKER_THREADS
+    if WORKER_PROCESSES > 1:
+        Supervisor(threads=capacity, target=engine).run()
+    else:
+        engine(capacity)
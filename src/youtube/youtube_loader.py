@@ -7,24 +7,27 @@ from http import HTTPStatus
 import flask
 from decouple import config
 from flask import request, Response
-from pytube import YouTube, Playlist
+from pytube import YouTube, Playlist, extract
 from pytube.exceptions import AgeRestrictedError, VideoPrivate, PytubeError
 
-import json
-import logging
 import os
 
-logger = logging.getLogger("YOUTUBE_LOADER")
+from common.src.deadline import DeadlineExceeded, check, expired, from_headers
+from common.src.logs import get_logger
+from common.src.playlist_stream import CHUNK_SIZE, CONTENT_TYPE, stream_chunks
+from common.src.probe import MAX_SIZE, TTLCache, probe_result
+from common.src.profiling import Profiler, register_admin
+from common.src.readiness import Readiness, register_health
 
-logger.setLevel(logging.INFO)
+logger = get_logger("YOUTUBE_LOADER")
 
-handler = logging.StreamHandler()
+sep = os.sep
 
-handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+probes = TTLCache(config('PROBE_TTL', default=600, cast=int))
 
-logger.addHandler(handler)
+ADMIN_TOKEN = config('ADMIN_TOKEN', default='')
 
-sep = os.sep
+profiler = Profiler(config('PROFILE_EVERY', default=0, cast=int), config('PROFILE_THRESHOLD', default=0, cast=float))
 
 
 class YoutubeLoader:
@@ -32,12 +35,14 @@ class YoutubeLoader:
     Класс для загрузки видео и получения информация о плейлистах Youtube
 
     :ivar `flask.app.Flask` app: Flask-приложение для общения с другими модулями
+    :ivar `common.src.readiness.Readiness` readiness: Шаги запуска, выполняемые после старта приложения
     :iver `str` host: Хост для запуска
     :ivar `int` port: Порт для запуска
     """
 
     def __init__(self):
         self.app = flask.Flask(__name__)
+        self.readiness = Readiness()
         self.host = config('YOUTUBE_LOADER_HOST')
         self.port = config('YOUTUBE_LOADER_PORT')
         self.configure_router()
@@ -52,56 +57,108 @@ class YoutubeLoader:
         return Response(f'Ok', HTTPStatus.OK)
 
     @staticmethod
+    @profiler.profile('download')
     async def download() -> Response:
         """
-        Загружает видео с использованием библиотеки pytube
+        Загружает видео с использованием библиотеки pytube. Если передан `format` из `/api/probe`, загружается поток
+        с этим itag, иначе лучший поток меньше `MAX_SIZE`. Загрузка прерывается, когда наступает срок из заголовка
+        `X-Deadline`, недозагруженный файл удаляется
 
-        :return: Response 200 с путём к файлу если загрузка удалась, BadResponse 413|400 иначе
+        :return: Response 200 с путём к файлу если загрузка удалась, BadResponse 413|400|504 иначе
         """
         payload = request.json
         url_raw = payload['url']
+        itag = payload.get('format', None)
+        deadline = from_headers(request.headers)
+        if expired(deadline):
+            logger.warning('Download abandoned, url: %s', url_raw)
+            return Response(status=HTTPStatus.GATEWAY_TIMEOUT)
         code = HTTPStatus.OK
         file_path = None
+        target = None
         try:
-            logger.info(f'Download start url: {url_raw}')
-            videos = YouTube(url_raw).streams.filter(progressive=True, file_extension='mp4').order_by(
-                'resolution').desc()
-            for video in videos:
-                if video.filesize_mb < 1000:
-                    file_path = videos.first().download('../media')
-                    logger.info(f'Download complete, file: {file_path}')
+            logger.info('Download start url: %s', url_raw)
+            youtube = YouTube(url_raw, on_progress_callback=lambda stream, chunk, left: check(deadline))
+            videos = youtube.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc()
+            chosen = videos.get_by_itag(int(itag)) if itag else None
+            for video in ([chosen] if chosen else videos):
+                if video.filesize < MAX_SIZE:
+                    target = video.get_file_path(output_path='../media')
+                    file_path = video.download('../media')
+                    logger.info('Download complete, file: %s', file_path)
                     break
             else:
                 code = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        except DeadlineExceeded as e:
+            logger.warning("Download abandoned, url: %s, %s", url_raw, e)
+            if target is not None and os.path.exists(target):
+                os.remove(target)
+            code = HTTPStatus.GATEWAY_TIMEOUT
         except (AgeRestrictedError, VideoPrivate) as e:
-            logger.warning(f"Cath: {e.__class__.__name__}, {e}, {e.args}")
+            logger.warning("Cath: %s, %s, %s", e.__class__.__name__, e, e.args)
             code = HTTPStatus.UNAUTHORIZED
         except PytubeError as e:
-            logger.error(f"Cath unexpected error: {e.__class__.__name__}, {e}, {e.args}")
+            logger.error("Cath unexpected error: %s, %s, %s", e.__class__.__name__, e, e.args)
             code = HTTPStatus.BAD_REQUEST
         return Response(file_path, status=code)
 
     @staticmethod
+    @profiler.profile('probe')
+    async def probe() -> Response:
+        """
+        Возвращает размер, длительность, доступные форматы и ограничения видео без его загрузки. Результат
+        кэшируется на `PROBE_TTL` секунд, формат ответа описан в `common.src.probe`
+
+        :return: Response 200 с описанием видео, BadResponse 400 если не указан url или проверка не удалась
+        """
+        url = request.args.get('url', None)
+        if url is None:
+            return Response(status=HTTPStatus.BAD_REQUEST)
+        result = probes.get(url)
+        if result is None:
+            try:
+                video = YouTube(url)
+                video.check_availability()
+                streams = video.streams.filter(progressive=True, file_extension='mp4').order_by('resolution')
+                formats = [{'id': str(stream.itag), 'ext': stream.subtype,
+                            'height': int(stream.resolution[:-1]) if stream.resolution else None,
+                            'size': stream.filesize} for stream in streams]
+                result = probe_result(formats, video.length)
+            except (AgeRestrictedError, VideoPrivate) as e:
+                logger.warning("Probe %s: %s", url, e.__class__.__name__)
+                result = probe_result([], restricted=True)
+            except PytubeError as e:
+                logger.error("Probe %s failed: %s, %s", url, e.__class__.__name__, e)
+                return Response(status=HTTPStatus.BAD_REQUEST)
+            probes.put(url, result)
+        return flask.jsonify(result)
+
+    @staticmethod
+    @profiler.profile('get_playlist')
     async def get_playlist() -> Response:
         """
-        Возвращает информацию о всех видео в плейлисте с использованием библиотеки pytube
+        Возвращает информацию о всех видео в плейлисте с использованием библиотеки pytube. Идентификаторы
+        отдаются частями по мере обхода страниц плейлиста, формат описан в `common.src.playlist_stream`
 
-        :return: Response 200 со списком video_id если загрузка удалась, BadResponse 400 иначе
+        :return: Response 200 с потоком частей списка video_id, BadResponse 400 если не указан url
         """
         url = request.args.get('url', None)
-        video_ids = []
-        code = HTTPStatus.OK
         if url is None:
             return Response(status=HTTPStatus.BAD_REQUEST)
-        try:
-            logger.info(f'Fetching all videos in {url}')
-            for video in Playlist(url).videos:
-                video_ids += [video.video_id]
-            logger.info(f'Fetching complete, video_ids: {video_ids}')
-        except PytubeError as e:
-            logger.error(f"Cath unexpected error: {e.__class__.__name__}, {e}, {e.args}")
-            code = HTTPStatus.BAD_REQUEST
-        return Response(json.dumps({'video_ids': video_ids}), status=code)
+        chunk_size = request.args.get('chunk', CHUNK_SIZE, type=int)
+        deadline = from_headers(request.headers)
+
+        def _video_ids():
+            logger.info('Fetching all videos in %s', url)
+            count = 0
+            for video_url in Playlist(url).url_generator():
+                check(deadline)
+                count += 1
+                yield extract.video_id(video_url)
+            logger.info('Fetching complete, videos: %s', count)
+
+        return Response(stream_chunks(_video_ids(), (PytubeError, KeyError), chunk_size), status=HTTPStatus.OK,
+                        content_type=CONTENT_TYPE)
 
     def configure_router(self):
         """
@@ -109,7 +166,10 @@ class YoutubeLoader:
         """
         self.app.add_url_rule('/', view_func=self.main_page, methods=['GET'])
         self.app.add_url_rule('/api/download', view_func=self.download, methods=['POST'])
+        self.app.add_url_rule('/api/probe', view_func=self.probe, methods=['GET'])
         self.app.add_url_rule('/api/get/playlist', view_func=self.get_playlist, methods=['GET'])
+        register_admin(self.app, profiler, ADMIN_TOKEN)
+        register_health(self.app, self.readiness)
 
     def run(self, debug: bool = True) -> None:
         """
@@ -1,21 +1,58 @@
+import asyncio
+import email.parser
+import json
+import logging
 import os
+import socket
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import Future
+from queue import Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from threading import Event, Lock, Thread
 from typing import NoReturn, Callable
-from unittest import TestCase
-from unittest.mock import patch, Mock, MagicMock
+from urllib.parse import parse_qs
+from unittest import TestCase, skipUnless
+from unittest.mock import patch, AsyncMock, Mock, MagicMock
 
-from src.worker.worker import Worker, videohostings
+import aiohttp
+import fakeredis
+import flask
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import msgpack
+import pika
+import requests
+from pika.exceptions import ChannelClosedByBroker, NackError, StreamLostError
+from sqlalchemy.exc import OperationalError
+from telebot.apihelper import ApiTelegramException
 
-sep = os.sep
-
-
-def mock_to_dict(mock: MagicMock):
-    """
-    Преобразует Mock объект в словарь
+from batadaze.src.explain import seq_scans
+from batadaze.src.leader import LeaderLease
+from batadaze.src.main import DB
+from common.src.admission import Admission, Limit
+from common.src.circuit_breaker import CircuitBreaker
+from common.src.consumer import Consumer
+from common.src.deadline import DeadlineExceeded, check, deadline_after, from_headers, remaining, to_headers
+from common.src.logs import RateLimitFilter, StructuredFormatter, get_logger
+from common.src.messages import VideoTask, VideoAnswer, PlaylistTask, PlaylistAnswer, MessageError, PROPERTIES, \
+    encode, decode
+from common.src.playlist_stream import stream_chunks, iter_chunks
+from common.src.probe import TTLCache, probe_result
+from common.src.profiling import Profiler, serve_admin
+from common.src.publisher import Publisher
+from common.src.readiness import Readiness, register_health
+from common.src.send_scheduler import SendScheduler, MemorySendQueue, RedisSendQueue, create_send_queue
+from common.src.state_storage import TTLMemoryStorage, RedisStateStorage
+from common.src.transport import InProcessTransport, QueueStats, RabbitMQTransport, Transport, create_transport
+from common.src.upload import MultipartFile, send_video_path, server_path, upload_video
+from src.downloader.load import Loader, update_all_playlists
+from src.worker.worker import AsyncWorker, Worker, Supervisor, broker_address, send_video, videohostings
 
-    :param mock:
-    :return: Полученный словарь
-    """
-    return mock | {}
+sep = os.sep
 
 
 class BaseWorker(TestCase):
@@ -28,12 +65,12 @@ class BaseWorker(TestCase):
     hosting = None
     client = Worker
 
-    def base_download(self, local_mock: MagicMock, req_post_mock: MagicMock, video_id: str, error: bool, body: dict,
+    def base_download(self, upload_mock: MagicMock, req_post_mock: MagicMock, video_id: str, error: bool, body: dict,
                       pre_logic: Callable = None, post_logic: Callable = None) -> NoReturn:
         """
         Имитирует отправку запроса на загрузку видео
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
         :param video_id: Ссылка на загружаемое видео
         :param error: True если загрузка видео завершилось ошибкой
@@ -41,28 +78,30 @@ class BaseWorker(TestCase):
         :param pre_logic: Функция, вызываемая до отправки запроса
         :param post_logic: Функция, вызываемая после отправки запроса
         """
-        payload = {
-            'video_id': video_id,
-            'hosting': self.hosting
-        }
-        mocks = MagicMock(), MagicMock(), MagicMock()
-        local_mock.return_value = mocks
+        task = VideoTask('download', video_id, self.hosting)
+        mocks = upload_mock, MagicMock()
         if pre_logic:
             pre_logic(mocks)
-        self.client.download(payload)
+        with patch('src.worker.worker.transport', mocks[1]), patch('src.worker.worker.probe', return_value=None):
+            self.client.download(task)
         req_post_mock.assert_called_once_with(
             f"http://{videohostings[self.hosting]['host']}:{videohostings[self.hosting]['port']}/api/download",
-            json={'url': videohostings[self.hosting]['video'].format(video_id)},
+            json={'url': videohostings[self.hosting]['video'].format(video_id), 'format': None},
+            headers={},
             timeout=1000
         )
         if error:
-            mocks[0].send_video.assert_not_called()
+            mocks[0].assert_not_called()
         else:
-            mocks[0].send_video.assert_called_once()
-        mocks[2].basic_publish.assert_called_once_with(
-            exchange='',
-            routing_key='answer_queue',
-            body=payload | body | {'video_url': videohostings[self.hosting]['video'].format(video_id)}
+            mocks[0].assert_called_once()
+        mocks[1].publish.assert_called_once()
+        routing_key, message = mocks[1].publish.call_args.args
+        self.assertEqual(routing_key, 'answer_queue')
+        self.assertGreaterEqual(message.elapsed, 0)
+        self.assertEqual(
+            message,
+            VideoAnswer.from_task(task, **body, video_url=videohostings[self.hosting]['video'].format(video_id),
+                                  elapsed=message.elapsed)
         )
         if post_logic:
             post_logic(mocks)
@@ -74,24 +113,22 @@ class WorkerYoutubeTestCase(BaseWorker):
     """
     hosting = 'youtube'
 
-    @patch('json.dumps', side_effect=mock_to_dict)
-    @patch('src.worker.worker.get_local')
+    @patch('src.worker.worker.upload_video')
     @patch('requests.post', return_value=Mock(status_code=200, text=os.path.dirname(
         os.path.abspath(__file__)) + f'{sep}data{sep}video.mp4'))
-    def test_youtube_download(self, req_post_mock: Mock, local_mock: Mock, json_dumps_mock: Mock):
+    def test_youtube_download(self, req_post_mock: Mock, upload_mock: Mock):
         """
         Тестирование отправки корректно загруженного видео `data/video.mp4`
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
-        :param json_dumps_mock: Mock для имитации сериализаци данных
         """
 
         def _pre(mocks):
-            mocks[0].send_video.return_value.video.file_id = '7986223'
+            mocks[0].return_value = '7986223'
 
         self.base_download(
-            local_mock,
+            upload_mock,
             req_post_mock,
             'dQw4w9WgXcQ&pp=ygULcmljayBhc3RsZXk%3D',
             False,
@@ -99,39 +136,35 @@ class WorkerYoutubeTestCase(BaseWorker):
             _pre
         )
 
-    @patch('json.dumps', side_effect=mock_to_dict)
-    @patch('src.worker.worker.get_local')
+    @patch('src.worker.worker.upload_video')
     @patch('requests.post', return_value=Mock(status_code=200, text=os.path.dirname(
         os.path.abspath(__file__)) + f'{sep}data{sep}no_video.mp4'))
-    def test_youtube_incorrect_download(self, req_post_mock: Mock, local_mock: Mock, json_dumps_mock: Mock):
+    def test_youtube_incorrect_download(self, req_post_mock: Mock, upload_mock: Mock):
         """
         Тестирование случая некорректной загрузки видео `data/no_video.mp4`
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
-        :param json_dumps_mock: Mock для имитации сериализаци данных
         """
         self.base_download(
-            local_mock,
+            upload_mock,
             req_post_mock,
             'dQw4w9WgXcQ&pp=ygULcmljayBhc3RsZXk%3D',
             True,
             {'file_id': None, 'error_code': 500},
         )
 
-    @patch('json.dumps', side_effect=mock_to_dict)
-    @patch('src.worker.worker.get_local')
+    @patch('src.worker.worker.upload_video')
     @patch('requests.post', return_value=Mock(status_code=413))
-    def test_youtube_download_error(self, req_post_mock: Mock, local_mock: Mock, json_dumps_mock: Mock):
+    def test_youtube_download_error(self, req_post_mock: Mock, upload_mock: Mock):
         """
         Тестирование загрузки, окончившейся ошибкой
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
-        :param json_dumps_mock: Mock для имитации сериализаци данных
         """
         self.base_download(
-            local_mock,
+            upload_mock,
             req_post_mock,
             '777777777777777777777777777777',
             True,
@@ -145,24 +178,22 @@ class WorkerVkTestCase(BaseWorker):
     """
     hosting = 'vk'
 
-    @patch('json.dumps', side_effect=mock_to_dict)
-    @patch('src.worker.worker.get_local')
+    @patch('src.worker.worker.upload_video')
     @patch('requests.post', return_value=Mock(status_code=200, text=os.path.dirname(
         os.path.abspath(__file__)) + f'{sep}data{sep}video.mp4'))
-    def test_vk_download(self, req_post_mock: Mock, local_mock: Mock, json_dumps_mock: Mock):
+    def test_vk_download(self, req_post_mock: Mock, upload_mock: Mock):
         """
         Тестирование отправки корректно загруженного видео `data/video.mp4`
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
-        :param json_dumps_mock: Mock для имитации сериализаци данных
         """
 
         def _pre(mocks):
-            mocks[0].send_video.return_value.video.file_id = 'ERTGHJKUYTFG498'
+            mocks[0].return_value = 'ERTGHJKUYTFG498'
 
         self.base_download(
-            local_mock,
+            upload_mock,
             req_post_mock,
             '704977679_456239136',
             False,
@@ -170,41 +201,1620 @@ class WorkerVkTestCase(BaseWorker):
             _pre
         )
 
-    @patch('json.dumps', side_effect=mock_to_dict)
-    @patch('src.worker.worker.get_local')
+    @patch('src.worker.worker.upload_video')
     @patch('requests.post', return_value=Mock(status_code=200, text=os.path.dirname(
         os.path.abspath(__file__)) + f'{sep}data{sep}no_video.mp4'))
-    def test_vk_incorrect_download(self, req_post_mock: Mock, local_mock: Mock, json_dumps_mock: Mock):
+    def test_vk_incorrect_download(self, req_post_mock: Mock, upload_mock: Mock):
         """
         Тестирование случая некорректной загрузки видео `data/no_video.mp4`
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
-        :param json_dumps_mock: Mock для имитации сериализаци данных
         """
         self.base_download(
-            local_mock,
+            upload_mock,
             req_post_mock,
             '704977679_36',
             True,
             {'file_id': None, 'error_code': 500},
         )
 
-    @patch('json.dumps', side_effect=mock_to_dict)
-    @patch('src.worker.worker.get_local')
+    @patch('src.worker.worker.upload_video')
     @patch('requests.post', return_value=Mock(status_code=400))
-    def test_youtube_download_error(self, req_post_mock: Mock, local_mock: Mock, json_dumps_mock: Mock):
+    def test_youtube_download_error(self, req_post_mock: Mock, upload_mock: Mock):
         """
         Тестирование загрузки, окончившейся ошибкой
 
-        :param local_mock: Mock для имитации получения локальных значений потока
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
         :param req_post_mock: Mock для имитации отправки post запросов
-        :param json_dumps_mock: Mock для имитации сериализаци данных
         """
         self.base_download(
-            local_mock,
+            upload_mock,
             req_post_mock,
             '704977679_36',
             True,
             {'file_id': None, 'error_code': req_post_mock.return_value.status_code},
         )
+
+
+class FakeBroker:
+    """
+    Имитация RabbitMQ для `Publisher`: соединение `pika.SelectConnection` с циклом событий в потоке издателя,
+    которое подтверждает, отклоняет или обрывает соединение на каждое опубликованное сообщение
+
+    :ivar `Callable` respond: Ответ на сообщение по его телу: 'ack', 'nack', 'hold' - подтвердить по `confirm`,
+        'lost' - оборвать соединение
+    :ivar `int` connections: Количество открытых соединений
+    :ivar `list` declared: Объявленные очереди и их аргументы
+    :ivar `list[bytes]` published: Тела опубликованных сообщений
+    """
+
+    def __init__(self, respond: Callable = lambda *_: 'ack'):
+        self.respond = respond
+        self.connections = 0
+        self.declared = []
+        self.published = []
+        self._connection = None
+
+    def connect(self, parameters, on_open_callback, on_open_error_callback, on_close_callback):
+        broker = self
+        self.connections += 1
+
+        class _IOLoop:
+            def __init__(self):
+                self.callbacks = Queue()
+                self.stopped = False
+
+            def add_callback_threadsafe(self, callback):
+                self.callbacks.put(callback)
+
+            def call_later(self, delay, callback):
+                timer = threading.Timer(delay, self.callbacks.put, (callback,))
+                timer.start()
+                return timer
+
+            def start(self):
+                while not self.stopped:
+                    self.callbacks.get()()
+
+            def stop(self):
+                self.stopped = True
+
+            def close(self):
+                pass
+
+        class _Channel:
+            def __init__(self, connection):
+                self.connection = connection
+                self.tag = 0
+                self.held = 0
+                self.on_confirm = None
+
+            def add_on_close_callback(self, callback):
+                pass
+
+            def queue_declare(self, queue, arguments=None, callback=None):
+                broker.declared.append((queue, arguments))
+                self.connection.ioloop.add_callback_threadsafe(lambda: callback(Mock()))
+
+            def confirm_delivery(self, ack_nack_callback, callback=None):
+                self.on_confirm = ack_nack_callback
+                self.connection.ioloop.add_callback_threadsafe(lambda: callback(Mock()))
+
+            def basic_publish(self, exchange, routing_key, body, properties=None):
+                broker.published.append(body)
+                self.tag += 1
+                response = broker.respond(body)
+                if response == 'lost':
+                    self.connection.lose()
+                elif response == 'hold':
+                    self.held = self.tag
+                else:
+                    method = (pika.spec.Basic.Ack if response == 'ack' else pika.spec.Basic.Nack)(self.tag)
+                    self.connection.ioloop.add_callback_threadsafe(lambda: self.on_confirm(Mock(method=method)))
+
+            def confirm(self):
+                method = pika.spec.Basic.Ack(self.held, multiple=True)
+                self.on_confirm(Mock(method=method))
+
+        class _Connection:
+            def __init__(self):
+                self.ioloop = _IOLoop()
+                self.is_open = True
+                self.channel_ = None
+                self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+
+            def channel(self, on_open_callback):
+                self.channel_ = _Channel(self)
+                self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self.channel_))
+
+            def close(self):
+                self.is_open = False
+                self.ioloop.add_callback_threadsafe(lambda: on_close_callback(self, Exception('closed')))
+
+            def lose(self):
+                self.is_open = False
+                self.ioloop.add_callback_threadsafe(lambda: on_close_callback(self, StreamLostError('lost')))
+
+        self._connection = _Connection()
+        return self._connection
+
+    def confirm(self) -> NoReturn:
+        """
+        Подтверждает все удержанные сообщения одним `Basic.Ack` с флагом `multiple`
+        """
+        connection = self._connection
+        connection.ioloop.add_callback_threadsafe(connection.channel_.confirm)
+
+    @staticmethod
+    def wait(condition: Callable[[], bool], timeout: float = 5) -> bool:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+class PublisherTestCase(TestCase):
+    """
+    Класс для тестирования общего издателя сообщений
+    """
+
+    def test_publish_from_threads(self):
+        """
+        Тестирование публикации сообщений из нескольких потоков через одно соединение с подтверждениями
+        """
+        broker = FakeBroker()
+        with patch('pika.SelectConnection', broker.connect):
+            publisher = Publisher('broker', 5672, queues=('answer_queue',))
+            publisher.start()
+            futures = []
+            threads = [Thread(target=lambda i=i: futures.append(publisher.publish('answer_queue', str(i).encode())))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            publisher.stop(5)
+        self.assertEqual(broker.connections, 1)
+        self.assertEqual(broker.declared, [('answer_queue', None)])
+        self.assertEqual(sorted(broker.published), sorted(str(i).encode() for i in range(10)))
+        self.assertTrue(all(future.result(0) for future in futures))
+
+    def test_pipelined_confirms(self):
+        """
+        Тестирование публикации до `max_inflight` сообщений без ожидания подтверждений и завершения Future
+        подтверждением нескольких сообщений сразу
+        """
+        broker = FakeBroker(lambda body: 'hold')
+        with patch('pika.SelectConnection', broker.connect):
+            publisher = Publisher('broker', 5672, max_inflight=3)
+            publisher.start()
+            futures = [publisher.publish('answer_queue', str(i).encode()) for i in range(5)]
+            self.assertTrue(broker.wait(lambda: len(broker.published) == 3))
+            time.sleep(0.05)
+            self.assertEqual(len(broker.published), 3)
+            self.assertFalse(any(future.done() for future in futures))
+            broker.confirm()
+            self.assertTrue(all(future.result(5) for future in futures[:3]))
+            self.assertTrue(broker.wait(lambda: len(broker.published) == 5))
+            broker.confirm()
+            self.assertTrue(all(future.result(5) for future in futures[3:]))
+            publisher.stop(5)
+        self.assertEqual(broker.published, [str(i).encode() for i in range(5)])
+
+    def test_reconnect(self):
+        """
+        Тестирование повторной отправки неподтверждённого сообщения после обрыва соединения
+        """
+        broker = FakeBroker(lambda body, responses=iter(['lost', 'ack']): next(responses))
+        with patch('pika.SelectConnection', broker.connect):
+            publisher = Publisher('broker', 5672, reconnect_delay=0)
+            publisher.start()
+            future = publisher.publish('answer_queue', b'body')
+            self.assertTrue(future.result(5))
+            publisher.stop(5)
+        self.assertEqual(broker.connections, 2)
+        self.assertEqual(broker.published, [b'body'] * 2)
+
+    def test_rejected(self):
+        """
+        Тестирование отбрасывания сообщения, которое брокер отклоняет, и публикации остальных сообщений
+        """
+        broker = FakeBroker(lambda body: 'nack' if body == b'rejected' else 'ack')
+        with patch('pika.SelectConnection', broker.connect):
+            publisher = Publisher('broker', 5672, reconnect_delay=0, max_attempts=3)
+            rejected = publisher.publish('answer_queue', b'rejected')
+            published = publisher.publish('answer_queue', b'published')
+            publisher.start()
+            self.assertIsInstance(rejected.exception(5), NackError)
+            self.assertTrue(published.result(5))
+            publisher.stop(5)
+        self.assertEqual(sorted(broker.published), [b'published'] + [b'rejected'] * 3)
+
+    def test_declare(self):
+        """
+        Тестирование объявления очереди с аргументами перед первой публикацией в неё и после переподключения
+        """
+        broker = FakeBroker(lambda body, responses=iter(['ack', 'lost', 'ack']): next(responses))
+        with patch('pika.SelectConnection', broker.connect):
+            publisher = Publisher('broker', 5672, reconnect_delay=0)
+            publisher.start()
+            publisher.declare('delayed', {'x-message-ttl': 1000})
+            self.assertTrue(publisher.publish('delayed', b'1').result(5))
+            self.assertTrue(publisher.publish('delayed', b'2').result(5))
+            publisher.stop(5)
+        self.assertEqual(broker.declared, [('delayed', {'x-message-ttl': 1000})] * 2)
+
+    @patch('pika.BlockingConnection')
+    def test_consumer_reconnect(self, connection_mock: MagicMock):
+        """
+        Тестирование переподключения получателя после обрыва соединения и его остановки
+
+        :param connection_mock: Mock для имитации соединения с RabbitMQ
+        """
+        channel = connection_mock.return_value.channel.return_value
+        callback = Mock()
+        consumer = Consumer('broker', 5672, 'answer_queue', callback, reconnect_delay=0)
+
+        def _consume():
+            if connection_mock.call_count == 1:
+                raise StreamLostError('lost')
+            consumer._stopping.set()
+
+        channel.start_consuming.side_effect = _consume
+        consumer.run()
+        self.assertEqual(connection_mock.call_count, 2)
+        connection_mock.assert_called_with(
+            pika.ConnectionParameters(host='broker', port=5672, heartbeat=consumer.heartbeat))
+        channel.basic_consume.assert_called_with('answer_queue', callback, auto_ack=True)
+
+    @patch('pika.BlockingConnection')
+    def test_consumer_manual_ack(self, connection_mock: MagicMock):
+        """
+        Тестирование подтверждения сообщений транспорта RabbitMQ из другого потока и пропуска некорректных
+
+        :param connection_mock: Mock для имитации соединения с RabbitMQ
+        """
+        connection, channel = connection_mock.return_value, connection_mock.return_value.channel.return_value
+        transport = RabbitMQTransport('broker', 5672)
+        received = []
+        transport.consume('task_queue', lambda message, ack: received.append((message, ack)), prefetch=3)
+        consumer = transport._consumers[0]
+
+        def _consume():
+            consumer._deliver(channel, Mock(delivery_tag=7), PROPERTIES, encode(VideoTask('return', 'a', 'youtube')))
+            consumer._deliver(channel, Mock(delivery_tag=8), PROPERTIES, b'garbage')
+            consumer._stopping.set()
+            Thread(target=received[0][1]).start()
+
+        callbacks = []
+        channel.start_consuming.side_effect = _consume
+        connection.add_callback_threadsafe.side_effect = callbacks.append
+        connection.process_data_events.side_effect = lambda time_limit: [callbacks.pop(0)() for _ in list(callbacks)]
+        consumer.run()
+        channel.basic_qos.assert_called_once_with(prefetch_count=3)
+        self.assertEqual(received[0][0], VideoTask('return', 'a', 'youtube'))
+        self.assertEqual(sorted(call.args[0] for call in channel.basic_ack.call_args_list), [7, 8])
+        self.assertEqual(consumer._unacked, 0)
+
+    @patch('pika.BlockingConnection')
+    def test_stats_connection(self, connection_mock: MagicMock):
+        """
+        Тестирование чтения состояния очередей через одно соединение, которое переоткрывается только после обрыва
+
+        :param connection_mock: Mock для имитации соединения с RabbitMQ
+        """
+        connection, channel = connection_mock.return_value, connection_mock.return_value.channel.return_value
+        connection.is_closed = channel.is_closed = False
+        channel.queue_declare.return_value.method = Mock(message_count=5, consumer_count=2)
+        transport = RabbitMQTransport('broker', 5672)
+        self.assertEqual([transport.stats('task_queue') for _ in range(3)], [QueueStats(5, 2)] * 3)
+        connection_mock.assert_called_once()
+        channel.queue_declare.side_effect = [ChannelClosedByBroker(404, 'NOT_FOUND'), StreamLostError('lost'),
+                                             channel.queue_declare.return_value]
+        self.assertIsNone(transport.stats('missing'))
+        self.assertEqual(transport.stats('task_queue'), QueueStats(5, 2))
+        self.assertEqual(connection_mock.call_count, 2)
+
+
+class MessagesTestCase(TestCase):
+    """
+    Класс для тестирования схемы сообщений очередей
+    """
+
+    def test_round_trip(self):
+        """
+        Тестирование кодирования и декодирования всех видов сообщений
+        """
+        task = VideoTask('download', 'dQw4w9WgXcQ', 'youtube', chat_id=42, message_id=7, playlist_id='PL1')
+        messages = [
+            task,
+            PlaylistTask('PL1', 'youtube', True),
+            VideoAnswer.from_task(task, file_id='7986223', video_url='https://youtu.be/dQw4w9WgXcQ'),
+            PlaylistAnswer('PL1', 'youtube', True, ['a', 'b'], None, 'https://www.youtube.com/playlist?list=PL1'),
+        ]
+        for message in messages:
+            self.assertEqual(decode(encode(message)), message)
+
+    def test_schema_evolution(self):
+        """
+        Тестирование совместимости с сообщениями, в которых добавлены новые поля в конец
+        """
+        self.assertEqual(decode(msgpack.packb([1, PlaylistTask.kind, 'PL1', 'vk', True, 'answer_queue.1', 1e9,
+                                               'new'])),
+                         PlaylistTask('PL1', 'vk', True, 'answer_queue.1', 1e9))
+        self.assertEqual(decode(msgpack.packb([1, PlaylistTask.kind, 'PL1', 'vk'])), PlaylistTask('PL1', 'vk'))
+
+    def test_invalid(self):
+        """
+        Тестирование отказа при неизвестной версии и повреждённом теле
+        """
+        self.assertRaises(MessageError, decode, b'{"type": "download"}')
+        self.assertRaises(MessageError, decode, msgpack.packb([2, PlaylistTask.kind, 'PL1', 'vk']))
+        self.assertRaises(MessageError, decode, msgpack.packb([1, PlaylistTask.kind]))
+
+
+class PlaylistStreamTestCase(TestCase):
+    """
+    Класс для тестирования потоковой передачи плейлистов
+    """
+
+    def test_round_trip(self):
+        """
+        Тестирование разбиения плейлиста на части и их чтения
+        """
+        lines = [line.encode() for line in stream_chunks((str(i) for i in range(5)), chunk_size=2)]
+        self.assertEqual(list(iter_chunks(lines)), [
+            (0, ['0', '1'], False, None),
+            (1, ['2', '3'], False, None),
+            (2, ['4'], False, None),
+            (3, [], True, None),
+        ])
+
+    def test_error(self):
+        """
+        Тестирование ошибки обхода плейлиста и оборванного потока
+        """
+
+        def _video_ids():
+            yield '0'
+            raise KeyError('contents')
+
+        lines = [line.encode() for line in stream_chunks(_video_ids(), (KeyError,), chunk_size=2)]
+        self.assertEqual(list(iter_chunks(lines)), [(0, ['0'], False, None), (1, [], True, 400)])
+        self.assertEqual(list(iter_chunks(lines[:1])), [(0, ['0'], False, None), (1, [], True, 502)])
+
+    @patch('src.worker.worker.transport')
+    @patch('requests.get')
+    def test_worker_playlist(self, req_get_mock: MagicMock, transport_mock: MagicMock):
+        """
+        Тестирование пересылки плейлиста частями из Worker
+
+        :param req_get_mock: Mock для имитации отправки get запросов
+        :param transport_mock: Mock для имитации транспорта сообщений
+        """
+        response = req_get_mock.return_value.__enter__.return_value
+        response.status_code = 200
+        response.iter_lines.return_value = [line.encode() for line in stream_chunks(['a', 'b', 'c'], chunk_size=2)]
+        task = PlaylistTask('PL1', 'youtube', True)
+        Worker.playlist(task)
+        answers = [call.args[1] for call in transport_mock.publish.call_args_list]
+        self.assertEqual([(a.seq, a.video_ids, a.last) for a in answers],
+                         [(0, ['a', 'b'], False), (1, ['c'], False), (2, [], True)])
+        self.assertTrue(all(a.playlist_id == 'PL1' and a.upload for a in answers))
+
+
+class ExplainTestCase(TestCase):
+    """
+    Класс для тестирования разбора планов запросов
+    """
+
+    def test_seq_scans(self):
+        """
+        Тестирование поиска последовательного чтения больших таблиц во вложенных узлах плана
+        """
+        plan = {'Node Type': 'Limit', 'Plans': [
+            {'Node Type': 'Nested Loop', 'Plans': [
+                {'Node Type': 'Index Only Scan', 'Relation Name': 'playlist_video'},
+                {'Node Type': 'Seq Scan', 'Relation Name': 'video'},
+                {'Node Type': 'Seq Scan', 'Relation Name': 'schema_version'},
+            ]},
+        ]}
+        self.assertEqual(seq_scans(plan), ['video'])
+        self.assertEqual(seq_scans({'Node Type': 'Index Scan', 'Relation Name': 'playlist'}), [])
+
+
+class UnitOfWorkTestCase(TestCase):
+    """
+    Класс для тестирования объединения вызовов `DB` в одну транзакцию
+    """
+
+    @patch('batadaze.src.main.get_local')
+    def test_single_commit(self, local_mock: MagicMock):
+        """
+        Тестирование одной фиксации для нескольких записей внутри единицы работы
+
+        :param local_mock: Mock для имитации получения движка базы данных
+        """
+        sessionmaker = MagicMock()
+        session = sessionmaker.return_value.__enter__.return_value
+        local_mock.return_value = [MagicMock(), sessionmaker]
+        with DB.unit_of_work():
+            DB.add_user(42)
+            DB.upsert_video_file_id('dQw4w9WgXcQ', '7986223')
+            with DB.unit_of_work():
+                DB.delete_video('777777777777777777777777777777')
+        sessionmaker.assert_called_once()
+        self.assertEqual(session.execute.call_count, 3)
+        session.commit.assert_called_once()
+
+    @patch('batadaze.src.main.get_local')
+    def test_rollback(self, local_mock: MagicMock):
+        """
+        Тестирование отсутствия фиксации при исключении внутри единицы работы
+
+        :param local_mock: Mock для имитации получения движка базы данных
+        """
+        sessionmaker = MagicMock()
+        session = sessionmaker.return_value.__enter__.return_value
+        local_mock.return_value = [MagicMock(), sessionmaker]
+        with self.assertRaises(RuntimeError):
+            with DB.unit_of_work():
+                DB.add_user(42)
+                raise RuntimeError()
+        session.commit.assert_not_called()
+        DB.add_user(42)
+        session.commit.assert_called_once()
+
+
+class StateStorageTestCase(TestCase):
+    """
+    Класс для тестирования хранилищ состояний диалогов бота
+    """
+
+    def check_dialog(self, storage):
+        """
+        Проверка общего поведения хранилища на одном диалоге
+
+        :param storage: Хранилище состояний
+        """
+        self.assertIsNone(storage.get_state(1, 2))
+        self.assertRaises(RuntimeError, storage.set_data, 1, 2, 'url', 'x')
+        storage.set_state(1, 2, 'DownloadVideoState:link')
+        storage.set_data(1, 2, 'url', 'https://youtu.be/dQw4w9WgXcQ')
+        storage.set_state(1, 2, 'AddPlaylistState:link')
+        self.assertEqual(storage.get_state(1, 2), 'AddPlaylistState:link')
+        self.assertEqual(storage.get_data(1, 2), {'url': 'https://youtu.be/dQw4w9WgXcQ'})
+        with storage.get_interactive_data(1, 2) as data:
+            data['chat'] = 1
+        self.assertEqual(storage.get_data(1, 2)['chat'], 1)
+        self.assertIsNone(storage.get_state(1, 3))
+        self.assertTrue(storage.delete_state(1, 2))
+        self.assertIsNone(storage.get_state(1, 2))
+
+    def test_memory(self):
+        """
+        Тестирование хранилища в памяти и истечения срока жизни диалога
+        """
+        now = [0.0]
+        storage = TTLMemoryStorage(ttl=60, clock=lambda: now[0])
+        self.check_dialog(storage)
+        storage.set_state(1, 2, 'DownloadVideoState:link')
+        now[0] = 59
+        storage.reset_data(1, 2)
+        now[0] = 118
+        self.assertEqual(storage.get_state(1, 2), 'DownloadVideoState:link')
+        now[0] = 119
+        self.assertIsNone(storage.get_state(1, 2))
+        self.assertFalse(storage.delete_state(1, 2))
+
+    def test_redis(self):
+        """
+        Тестирование хранилища в Redis, общего для нескольких экземпляров обработчика
+        """
+        redis = fakeredis.FakeRedis()
+        self.check_dialog(RedisStateStorage(redis, ttl=60))
+        first, second = RedisStateStorage(redis, ttl=60), RedisStateStorage(redis, ttl=60)
+        first.set_state(1, 2, 'DeletePlaylistState:link')
+        self.assertEqual(second.get_state(1, 2), 'DeletePlaylistState:link')
+        self.assertTrue(0 < redis.ttl('tbot_state:1:2') <= 60)
+
+
+class SendSchedulerTestCase(TestCase):
+    """
+    Класс для тестирования планировщика исходящих сообщений бота
+    """
+
+    def setUp(self):
+        self.bot = MagicMock()
+        self.queue = MemorySendQueue()
+        self.scheduler = SendScheduler(self.bot, self.queue, rate=2, chat_interval=1, clock=lambda: 0)
+
+    def drain(self, now: float) -> int:
+        """
+        Переносит все сообщения из очереди в расписание и отправляет подошедшие к моменту `now`
+
+        :param now: Время отправки
+        :return: Количество отправленных сообщений
+        """
+        while self.scheduler.pull(0):
+            pass
+        return self.scheduler.send_due(now)
+
+    def test_rate_limits(self):
+        """
+        Тестирование глобального ограничения частоты и интервала между сообщениями в одном чате
+        """
+        for chat_id in (1, 1, 2, 3):
+            self.scheduler.submit('send_video', chat_id, 'file', caption='c', reply_to=7)
+        self.assertEqual(self.drain(0), 2)
+        self.assertEqual([c.args[0] for c in self.bot.send_video.call_args_list], [1, 2])
+        self.assertEqual(self.scheduler.send_due(0.5), 1)
+        self.assertEqual(self.scheduler.send_due(1.0), 1)
+        self.assertEqual([c.args[0] for c in self.bot.send_video.call_args_list], [1, 2, 3, 1])
+        self.assertEqual(self.bot.send_video.call_args.kwargs['reply_parameters'].message_id, 7)
+        self.assertEqual(self.queue.recover(), 0)
+
+    def test_retry_after(self):
+        """
+        Тестирование повторной отправки после ответа 429 не раньше `retry_after`
+        """
+        self.bot.send_message.side_effect = [
+            ApiTelegramException('sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                                       'parameters': {'retry_after': 5}}),
+            None]
+        self.scheduler.submit('send_message', 1, 'text')
+        self.assertEqual(self.drain(0), 0)
+        self.assertEqual(self.scheduler.send_due(4.9), 0)
+        self.assertEqual(self.scheduler.send_due(5), 1)
+        self.assertEqual(self.bot.send_message.call_count, 2)
+
+    def test_recover(self):
+        """
+        Тестирование возврата неотправленных сообщений новым отправителем из постоянной очереди
+        """
+        queue = RedisSendQueue(fakeredis.FakeRedis())
+        first = SendScheduler(self.bot, queue)
+        first.submit('send_message', 1, 'text')
+        self.assertTrue(first._ensure_leader())
+        self.assertTrue(first.pull(0))
+        second = SendScheduler(self.bot, queue)
+        self.assertFalse(second._ensure_leader())
+        queue.redis.delete(queue.prefix + 'leader')
+        self.assertTrue(second._ensure_leader())
+        self.assertTrue(second.pull(0))
+        self.assertEqual(second.send_due(time.monotonic()), 1)
+        self.assertEqual(queue.redis.llen(queue.prefix + 'processing'), 0)
+
+    def test_bounded_pull(self):
+        """
+        Тестирование отправки между переносами сообщений из очереди и ограничения размера расписания
+        """
+        scheduler = SendScheduler(self.bot, self.queue, rate=2, pull_batch=3, max_scheduled=4, clock=lambda: 0)
+        for chat_id in range(10):
+            scheduler.submit('send_message', chat_id, 'text')
+        self.assertEqual(scheduler.step(), 2)
+        self.assertEqual((len(scheduler._scheduled), len(self.queue._pending)), (1, 7))
+        self.assertEqual(scheduler.step(), 0)
+        self.assertEqual((len(scheduler._scheduled), len(self.queue._pending)), (4, 4))
+        self.assertEqual(self.bot.send_message.call_count, 2)
+        with self.assertRaises(ValueError):
+            create_send_queue('', processes=2)
+
+
+class ProbeTestCase(TestCase):
+    """
+    Класс для тестирования предварительной проверки видео
+    """
+
+    def test_probe_result(self):
+        """
+        Тестирование выбора лучшего формата меньше допустимого размера и кодов отказа
+        """
+        formats = [{'id': '18', 'size': 10}, {'id': '22', 'size': None}, {'id': '37', 'size': 2 ** 40}]
+        self.assertEqual(probe_result(formats, 60), {'status': 200, 'duration': 60, 'formats': formats,
+                                                     'format': '18', 'size': 10})
+        self.assertEqual(probe_result(formats[1:])['status'], 413)
+        self.assertEqual(probe_result(formats, restricted=True)['status'], 401)
+
+    def test_cache(self):
+        """
+        Тестирование истечения времени жизни и вытеснения записей кэша
+        """
+        now = [0.0]
+        cache = TTLCache(ttl=10, maxsize=2, clock=lambda: now[0])
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        now[0] = 10
+        self.assertIsNone(cache.get('a'))
+
+    @patch('src.worker.worker.upload_video')
+    @patch('requests.post')
+    def test_worker_rejects(self, req_post_mock: MagicMock, upload_mock: MagicMock):
+        """
+        Тестирование ответа без загрузки на видео, отклонённое проверкой
+
+        :param req_post_mock: Mock для имитации отправки post запросов
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
+        """
+        task = VideoTask('download', 'dQw4w9WgXcQ', 'youtube', chat_id=1)
+        transport_mock = MagicMock()
+        with patch('src.worker.worker.transport', transport_mock), \
+                patch('src.worker.worker.probe', return_value=probe_result([{'id': '18', 'size': 2 ** 40}])):
+            Worker.download(task)
+        req_post_mock.assert_not_called()
+        upload_mock.assert_not_called()
+        self.assertEqual(transport_mock.publish.call_args.args[1].error_code, 413)
+
+
+class LeaderLeaseTestCase(TestCase):
+    """
+    Класс для тестирования выбора ведущего экземпляра планировщика
+    """
+
+    def test_failover(self):
+        """
+        Тестирование получения роли, удержания соединения и передачи роли после обрыва соединения ведущего
+        """
+        locks = {}
+
+        def _engine(name):
+            engine = MagicMock()
+            conn = engine.connect.return_value.execution_options.return_value
+
+            def _execute(query, params=None):
+                if 'pg_try_advisory_lock' in str(query):
+                    return MagicMock(scalar=Mock(return_value=locks.setdefault(params['key'], name) == name))
+                return MagicMock()
+
+            conn.execute.side_effect = _execute
+            conn.invalidate.side_effect = lambda: locks.pop(42, None)
+            return engine
+
+        first_engine, second_engine = _engine('first'), _engine('second')
+        first, second = LeaderLease(42, lambda: first_engine), LeaderLease(42, lambda: second_engine)
+        self.assertTrue(first.hold())
+        self.assertFalse(second.hold())
+        self.assertTrue(first.hold())
+        first_engine.connect.assert_called_once()
+        conn = first_engine.connect.return_value.execution_options.return_value
+        conn.execute.side_effect = OperationalError('SELECT 1', {}, Exception('connection lost'))
+        self.assertFalse(first.hold())
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.hold())
+
+
+def _idle_worker(threads: int) -> NoReturn:
+    """
+    Имитация процесса Worker для тестирования Supervisor
+
+    :param threads: Количество потоков
+    """
+    time.sleep(60)
+
+
+class SupervisorTestCase(TestCase):
+    """
+    Класс для тестирования многопроцессного режима Worker
+    """
+
+    def test_process_task_ack(self):
+        """
+        Тестирование подтверждения задачи только после её выполнения
+        """
+        worker = Worker.__new__(Worker)
+        worker.pool = MagicMock()
+        worker._inflight, worker._inflight_lock = 0, Lock()
+        callbacks = []
+        worker.pool.submit.return_value.add_done_callback.side_effect = callbacks.append
+        ack = Mock()
+        worker.process_task(VideoTask('return', 'dQw4w9WgXcQ', 'youtube'), ack)
+        worker.pool.submit.assert_called_once()
+        ack.assert_not_called()
+        self.assertEqual(worker._inflight, 1)
+        callbacks[0](MagicMock(exception=Mock(return_value=None)))
+        ack.assert_called_once_with()
+        self.assertEqual(worker._inflight, 0)
+
+    def test_restart_and_stop(self):
+        """
+        Тестирование перезапуска упавшего процесса и остановки всех процессов
+        """
+        supervisor = Supervisor(processes=2, threads=1, shutdown_timeout=5, target=_idle_worker)
+        supervisor.check()
+        first, second = supervisor._children
+        self.assertTrue(first.is_alive() and second.is_alive())
+        first.kill()
+        first.join()
+        supervisor._started[0] = time.monotonic() - 100
+        supervisor.check()
+        restarted = supervisor._children[0]
+        self.assertNotEqual(restarted.pid, first.pid)
+        self.assertIs(supervisor._children[1], second)
+        supervisor.stop()
+        self.assertFalse(restarted.is_alive() or second.is_alive())
+
+
+class AsyncWorkerTestCase(TestCase):
+    """
+    Класс для тестирования асинхронного Worker
+    """
+
+    def test_transport(self):
+        """
+        Тестирование подключения к брокеру из TRANSPORT_URL и отказа запускаться с транспортом в памяти процесса
+        """
+        self.assertEqual(broker_address('amqp://rabbit:5673'), ('rabbit', 5673))
+        self.assertEqual(broker_address('amqp://rabbit'), ('rabbit', 5672))
+        self.assertRaises(ValueError, broker_address, 'memory://')
+
+    @staticmethod
+    async def loader(download_delay: float) -> TestServer:
+        """
+        Запускает имитацию загрузчика
+
+        :param download_delay: Время загрузки одного видео, в секундах
+        :return: Тестовый сервер
+        """
+
+        async def _probe(request):
+            return web.json_response(probe_result([{'id': '18', 'size': 10}]))
+
+        async def _download(request):
+            await asyncio.sleep(download_delay)
+            return web.Response(text=os.path.dirname(os.path.abspath(__file__)) + f'{sep}data{sep}video.mp4')
+
+        async def _playlist(request):
+            return web.Response(text=''.join(stream_chunks(iter(['a', 'b', 'c']), chunk_size=2)))
+
+        app = web.Application()
+        app.router.add_get('/api/probe', _probe)
+        app.router.add_post('/api/download', _download)
+        app.router.add_get('/api/get/playlist', _playlist)
+        server = TestServer(app)
+        await server.start_server()
+        return server
+
+    def run_tasks(self, tasks: list, download_delay: float = 0) -> list:
+        """
+        Выполняет задачи асинхронным Worker-ом
+
+        :param tasks: Задачи
+        :param download_delay: Время загрузки одного видео, в секундах
+        :return: Ответные сообщения
+        """
+        answers = []
+
+        async def _main():
+            server = await self.loader(download_delay)
+            worker = AsyncWorker(concurrency=len(tasks))
+            worker.session = aiohttp.ClientSession()
+            worker.exchange = MagicMock(publish=AsyncMock(
+                side_effect=lambda message, routing_key: answers.append(decode(message.body))))
+            try:
+                with patch('src.worker.worker.aupload_video', AsyncMock(return_value='7986223')), \
+                        patch.dict(videohostings['youtube'], host=server.host, port=server.port):
+                    for task in tasks:
+                        await worker.process_task(MagicMock(body=encode(task), ack=AsyncMock()))
+                    while worker._tasks:
+                        await asyncio.gather(*worker._tasks)
+            finally:
+                await worker.session.close()
+                await server.close()
+
+        asyncio.run(_main())
+        return answers
+
+    def test_concurrent_downloads(self):
+        """
+        Тестирование одновременного выполнения сотни задач загрузки в одном потоке
+        """
+        tasks = [VideoTask('download', f'video{i}', 'youtube', chat_id=i) for i in range(100)]
+        start = time.monotonic()
+        answers = self.run_tasks(tasks, download_delay=0.3)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(sorted(a.chat_id for a in answers), list(range(100)))
+        self.assertTrue(all(a.file_id == '7986223' and a.error_code is None for a in answers))
+
+    def test_playlist_and_return(self):
+        """
+        Тестирование задач получения плейлиста и возврата загруженного видео
+        """
+        answers = self.run_tasks([PlaylistTask('PL1', 'youtube', True), VideoTask('return', 'v', 'youtube')])
+        parts = [a for a in answers if isinstance(a, PlaylistAnswer)]
+        self.assertEqual([(a.seq, a.video_ids, a.last) for a in parts],
+                         [(0, ['a', 'b'], False), (1, ['c'], False), (2, [], True)])
+        self.assertEqual([a.type for a in answers if isinstance(a, VideoAnswer)], ['return'])
+
+    def test_expired_playlist(self):
+        """
+        Тестирование ответа 504 на задачу плейлиста с наступившим сроком и ограничения ожидания остатком срока
+        """
+        answers = self.run_tasks([PlaylistTask('PL1', 'youtube', True, deadline=time.time() - 1)])
+        self.assertEqual([(a.error_code, a.last) for a in answers], [(504, True)])
+        self.assertEqual(AsyncWorker._timeout(time.time() - 1, 30).total, 0.001)
+        self.assertIsNone(AsyncWorker._timeout(None).total)
+
+
+class UploadTestCase(TestCase):
+    """
+    Класс для тестирования потоковой загрузки видео на локальный сервер
+    """
+
+    def setUp(self):
+        received = self.received = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                received.update(path=self.path, content_type=self.headers['Content-Type'], length=length, body=b'')
+                while length:
+                    chunk = self.rfile.read(min(length, 2 ** 20))
+                    length -= len(chunk)
+                    if received['length'] < 2 ** 20:
+                        received['body'] += chunk
+                body = json.dumps({'ok': True, 'result': {'video': {'file_id': 'F1'}}}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_port}' + '/bot{0}/{1}'
+        self.api_url = patch('telebot.apihelper.API_URL', url)
+        self.api_url.start()
+
+    def tearDown(self):
+        self.api_url.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_multipart_body(self):
+        """
+        Тестирование кодирования тела запроса: поля и файл разбираются стандартным парсером multipart
+        """
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(os.urandom(300000))
+            f.flush()
+            f.seek(0)
+            self.assertEqual(upload_video('T', 42, f, chunk_size=4096), 'F1')
+            f.seek(0)
+            content = f.read()
+        self.assertEqual(self.received['path'], '/botT/sendVideo')
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.received['content_type']}\r\n\r\n".encode() + self.received['body'])
+        fields = {part.get_param('name', header='content-disposition'): part for part in message.get_payload()}
+        self.assertEqual(fields['chat_id'].get_payload(), '42')
+        self.assertEqual(fields['video'].get_filename(), os.path.basename(f.name))
+        self.assertEqual(fields['video'].get_payload(decode=True), content)
+        self.assertEqual(self.received['length'], len(self.received['body']))
+
+    def test_flat_memory(self):
+        """
+        Тестирование загрузки большого файла: память не растёт с размером файла
+        """
+        with tempfile.NamedTemporaryFile() as f:
+            f.truncate(64 * 2 ** 20)
+            self.assertLess(len(MultipartFile({}, 'video', f)) - 64 * 2 ** 20, 1024)
+            tracemalloc.start()
+            try:
+                self.assertEqual(upload_video('T', 1, f), 'F1')
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.assertGreater(self.received['length'], 64 * 2 ** 20)
+        self.assertLess(peak, 8 * 2 ** 20)
+
+    def test_send_by_path(self):
+        """
+        Тестирование передачи локальному серверу пути к файлу в подключённом к нему каталоге
+        """
+        self.assertEqual(server_path('/app/../media/a b.mp4', '/media', '/srv/media'), '/srv/media/a b.mp4')
+        self.assertIsNone(server_path('/tmp/a.mp4', '/media', '/srv/media'))
+        self.assertIsNone(server_path('/media/a.mp4', '/media', ''))
+        self.assertEqual(send_video_path('T', 1, '/srv/media/a b.mp4'), 'F1')
+        self.assertEqual(parse_qs(self.received['body'].decode()),
+                         {'chat_id': ['1'], 'video': ['file:///srv/media/a b.mp4']})
+
+    @patch('src.worker.worker.upload_video', return_value='F2')
+    @patch('src.worker.worker.send_video_path',
+           side_effect=ApiTelegramException('sendVideo', None, {'error_code': 400, 'description': 'file not found'}))
+    def test_send_by_path_fallback(self, path_mock: MagicMock, upload_mock: MagicMock):
+        """
+        Тестирование загрузки файла, если локальный сервер не смог прочитать его по пути
+
+        :param path_mock: Mock для имитации передачи пути к файлу
+        :param upload_mock: Mock для имитации загрузки файла
+        """
+        video = os.path.dirname(os.path.abspath(__file__)) + f'{sep}data{sep}video.mp4'
+        with patch('src.worker.worker.MEDIA_ROOT', os.path.dirname(video)), \
+                patch('src.worker.worker.TELEGRAM_SERVER_MEDIA_ROOT', '/media'):
+            self.assertEqual(send_video(video), 'F2')
+        self.assertEqual(path_mock.call_args.args[2], '/media/video.mp4')
+        upload_mock.assert_called_once()
+
+
+class ProfilerTestCase(TestCase):
+    """
+    Класс для тестирования профилирования обработчиков
+    """
+
+    @staticmethod
+    def slow(duration: float) -> str:
+        time.sleep(duration)
+        return 'done'
+
+    def test_disabled(self):
+        """
+        Тестирование выключенного профилирования: обработчик вызывается, профиль не собирается
+        """
+        profiler = Profiler()
+        self.assertEqual(profiler.profile('slow')(self.slow)(0), 'done')
+        self.assertEqual(profiler.stats()['timings'], {})
+
+    def test_every_and_threshold(self):
+        """
+        Тестирование выборки каждого N-го вызова и вызовов дольше порога, в том числе корутин
+        """
+        profiler = Profiler(every=2, interval=0.002)
+        handler = profiler.profile('slow')(self.slow)
+        for _ in range(4):
+            handler(0.05)
+        stats = profiler.stats()
+        self.assertEqual(stats['timings']['slow']['count'], 4)
+        self.assertGreater(stats['functions']['test.py:slow']['total'], 0.05)
+        self.assertTrue(all(stack.startswith('slow;test.py:slow') for stack in stats['stacks']))
+
+        profiler.configure(every=0, threshold=0.04)
+        profiler.reset()
+
+        async def _slow(duration):
+            await asyncio.sleep(0)
+            return self.slow(duration)
+
+        coroutine = profiler.profile('async_slow')(_slow)
+        self.assertEqual(asyncio.run(coroutine(0.001)), 'done')
+        self.assertEqual(profiler.stats()['stacks'], {})
+        asyncio.run(coroutine(0.05))
+        stats = profiler.stats()
+        self.assertEqual([call['name'] for call in stats['slow']], ['async_slow'])
+        self.assertIn('async_slow;test.py:_slow;test.py:slow', profiler.folded())
+        profiler.configure(threshold=0)
+
+    def test_admin_endpoint(self):
+        """
+        Тестирование включения профилирования и получения профиля через `/admin/profile`
+        """
+        profiler = Profiler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.assertIsNone(serve_admin(profiler, port, ''))
+        server = serve_admin(profiler, port, 'secret', host='127.0.0.1')
+        url = f'http://127.0.0.1:{server.server_port}/admin/profile'
+        try:
+            self.assertEqual(requests.get(url).status_code, 403)
+            self.assertEqual(requests.get(url, headers={'X-Admin-Token': 'wrong'}).status_code, 403)
+            response = requests.post(url, json={'every': 1}, headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(response.json()['every'], 1)
+            profiler.profile('slow')(self.slow)(0.02)
+            stats = requests.get(url, headers={'X-Admin-Token': 'secret'}).json()
+            self.assertEqual(stats['timings']['slow']['count'], 1)
+            response = requests.delete(url, params={'format': 'folded'}, headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(response.text, '')
+        finally:
+            profiler.configure(every=0)
+            server.shutdown()
+            server.server_close()
+
+
+class LogsTestCase(TestCase):
+    """
+    Класс для тестирования общей настройки журналирования
+    """
+
+    def test_rate_limit(self):
+        """
+        Тестирование ограничения повторяющихся записей одного шаблона
+        """
+        now = [0.0]
+        limit = RateLimitFilter(burst=3, per=1.0, clock=lambda: now[0])
+
+        def _record(msg: str, level: int = logging.INFO) -> logging.LogRecord:
+            return logging.LogRecord('Test', level, __file__, 0, msg, ('v',), None)
+
+        self.assertEqual([limit.filter(_record('Download %s')) for _ in range(5)], [True] * 3 + [False] * 2)
+        self.assertTrue(limit.filter(_record('Upload %s')))
+        self.assertTrue(limit.filter(_record('Download %s', logging.ERROR)))
+        now[0] = 1.5
+        record = _record('Download %s')
+        self.assertTrue(limit.filter(record))
+        self.assertEqual(record.suppressed, 2)
+        self.assertEqual(StructuredFormatter('%(name)s - %(message)s').format(record), 'Test - Download v suppressed=2')
+
+    def test_lazy_formatting(self):
+        """
+        Тестирование отложенного форматирования: отброшенные записи не форматируются, остальные форматируются
+        в фоновом потоке
+        """
+        formatted = []
+
+        class Arg:
+            def __str__(self):
+                formatted.append(threading.get_ident())
+                return 'arg'
+
+        logger = get_logger('Logs Test')
+        logger.debug('Skipped %s', Arg())
+        for _ in range(100):
+            logger.info('Repeated %s', Arg())
+        deadline = time.monotonic() + 5
+        while len(formatted) < 20 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(len(formatted), 20)
+        self.assertNotIn(threading.get_ident(), formatted)
+
+
+class ReadinessTestCase(TestCase):
+    """
+    Класс для тестирования отложенных шагов запуска и отчёта о готовности
+    """
+
+    def test_retry_until_ready(self):
+        """
+        Тестирование повтора шага до успешного выполнения и ответов `/health/ready`
+        """
+        readiness = Readiness()
+        app = flask.Flask(__name__)
+        register_health(app, readiness)
+        client = app.test_client()
+        attempts = []
+        release = threading.Event()
+
+        def step():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConnectionError('refused')
+            release.wait(5)
+
+        readiness.run('broker', step, retry_delay=0.01)
+        self.assertEqual(client.get('/health/live').status_code, 200)
+        response = client.get('/health/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.get_json()['ready'])
+        release.set()
+        self.assertTrue(readiness.wait(5))
+        self.assertEqual(len(attempts), 3)
+        response = client.get('/health/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['steps'], {'broker': 'ok'})
+
+
+class AdmissionTestCase(TestCase):
+    """
+    Класс для тестирования оценки очереди и допуска задач по приоритетам
+    """
+
+    def test_estimate(self):
+        """
+        Тестирование позиции, времени ожидания и пределов приоритетов
+        """
+        now = [0.0]
+        transport = Mock()
+        transport.stats.return_value = QueueStats(5, 2)
+        admission = Admission(transport, 'task_queue', 3,
+                              {'user': Limit(10, 120), 'bulk': Limit(max_wait=60), 'prefetch': Limit(1)},
+                              clock=lambda: now[0])
+        self.assertEqual(admission.estimate('user'), (True, None, None, None))
+        admission.sample()
+        self.assertEqual(admission.estimate('user'), (True, 6, None, None))
+        self.assertEqual(admission.estimate('prefetch')[:3], (False, 6, None))
+        self.assertEqual(admission.estimate('prefetch').retry_after, admission.retry_after)
+        admission.observe(40)
+        admission.observe(20)
+        self.assertEqual(admission.service_time, 38)
+        self.assertEqual(admission.estimate('user'), (True, 6, 38, None))
+        admission.enqueued(2)
+        self.assertEqual(admission.estimate('user'), (True, 8, 76, None))
+        self.assertEqual(admission.estimate('bulk'), (False, 8, 76, 16))
+        admission.enqueued(3)
+        admitted, position, eta, retry_after = admission.estimate('user')
+        self.assertEqual((admitted, position, eta), (False, 11, 76))
+        self.assertAlmostEqual(retry_after, 38 / 6)
+        self.assertEqual(admission.estimate('playlist'), (True, 11, 76, None))
+        now[0] = 10
+        self.assertEqual(admission.estimate('user'), (True, None, None, None))
+
+
+class DeadlineTestCase(TestCase):
+    """
+    Класс для тестирования сроков выполнения задач
+    """
+
+    def test_helpers(self):
+        """
+        Тестирование оставшегося времени, проверки срока и передачи его в заголовках
+        """
+        self.assertEqual(remaining(None, 30), 30)
+        self.assertIsNone(remaining(None))
+        self.assertEqual(remaining(time.time() - 5, 30), 0)
+        self.assertLessEqual(remaining(deadline_after(10), 30), 10)
+        self.assertEqual(remaining(deadline_after(100), 30), 30)
+        check(None)
+        check(deadline_after(10))
+        with self.assertRaises(DeadlineExceeded):
+            check(time.time() - 1)
+        self.assertEqual(to_headers(None), {})
+        self.assertEqual(from_headers(to_headers(12.5)), 12.5)
+        self.assertIsNone(from_headers({'X-Deadline': 'soon'}))
+
+    def test_stream_chunks(self):
+        """
+        Тестирование завершения потока плейлиста кодом 504 по наступлении срока
+        """
+
+        def _video_ids():
+            yield '0'
+            check(time.time() - 1)
+
+        lines = [line.encode() for line in stream_chunks(_video_ids(), (KeyError,), chunk_size=2)]
+        self.assertEqual(list(iter_chunks(lines)), [(0, ['0'], False, None), (1, [], True, 504)])
+
+    @patch('src.worker.worker.transport')
+    @patch('requests.post')
+    def test_worker_expired(self, req_post_mock: MagicMock, transport_mock: MagicMock):
+        """
+        Тестирование ответа 504 без обращения к загрузчику на задачу с наступившим сроком
+
+        :param req_post_mock: Mock для имитации отправки post запросов
+        :param transport_mock: Mock для имитации транспорта сообщений
+        """
+        task = VideoTask('download', 'v', 'youtube', deadline=time.time() - 1)
+        with patch('src.worker.worker.probe') as probe_mock:
+            Worker.download(task)
+        probe_mock.assert_not_called()
+        req_post_mock.assert_not_called()
+        answer = transport_mock.publish.call_args.args[1]
+        self.assertEqual((answer.error_code, answer.deadline), (504, task.deadline))
+
+    @patch('src.worker.worker.upload_video')
+    @patch('src.worker.worker.transport')
+    @patch('requests.post', return_value=Mock(status_code=200, text='video.mp4'))
+    def test_worker_deadline_header(self, req_post_mock: MagicMock, transport_mock: MagicMock, upload_mock: MagicMock):
+        """
+        Тестирование передачи срока загрузчику и ограничения ожидания оставшимся временем
+
+        :param req_post_mock: Mock для имитации отправки post запросов
+        :param transport_mock: Mock для имитации транспорта сообщений
+        :param upload_mock: Mock для имитации загрузки видео на локальный сервер
+        """
+        upload_mock.return_value = '7986223'
+        task = VideoTask('download', 'v', 'youtube', deadline=deadline_after(60))
+        with patch('src.worker.worker.probe', return_value=None), patch('builtins.open'):
+            Worker.download(task)
+        kwargs = req_post_mock.call_args.kwargs
+        self.assertEqual(kwargs['headers'], to_headers(task.deadline))
+        self.assertLessEqual(kwargs['timeout'], 60)
+        self.assertLessEqual(upload_mock.call_args.kwargs['timeout'], 60)
+        self.assertEqual(transport_mock.publish.call_args.args[1].file_id, '7986223')
+
+
+class CircuitBreakerTestCase(TestCase):
+    """
+    Класс для тестирования автоматов защиты загрузчиков
+    """
+
+    def test_transitions(self):
+        """
+        Тестирование размыкания по доле ошибок и медленных обращений и пробных обращений после паузы
+        """
+        now = [0.0]
+        breaker = CircuitBreaker('youtube', window=4, min_calls=4, failure_rate=0.5, slow_call=1, slow_rate=0.75,
+                                 open_timeout=30, clock=lambda: now[0])
+        for failed in (True, False, False):
+            breaker.record(failed)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.retry_after(), 30)
+        now[0] = 30
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False, 5)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        now[0] = 60
+        self.assertTrue(breaker.allow())
+        breaker.record(False, 0.5)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        for elapsed in (2, 2, 0.5, 2):
+            breaker.record(False, elapsed)
+        self.assertEqual(breaker.stats(), {'state': 'open', 'calls': 0, 'failure_rate': 0.0, 'slow_rate': 0.0,
+                                           'opens': 3, 'rejected': 2})
+
+    @patch('src.worker.worker.transport')
+    @patch('requests.post')
+    @patch('requests.get', side_effect=requests.ConnectionError('refused'))
+    def test_worker_single_outcome(self, req_get_mock: MagicMock, req_post_mock: MagicMock,
+                                   transport_mock: MagicMock):
+        """
+        Тестирование учёта одного результата на задачу: при недоступном загрузчике загрузка после пробы не
+        запрашивается, а после успешной пробы учитывается только итог загрузки
+
+        :param req_get_mock: Mock для имитации отправки get запросов
+        :param req_post_mock: Mock для имитации отправки post запросов
+        :param transport_mock: Mock для имитации транспорта сообщений
+        """
+        breaker = CircuitBreaker('youtube', min_calls=10)
+        with patch.dict('src.worker.worker.breakers', youtube=breaker):
+            Worker.download(VideoTask('download', 'a', 'youtube'))
+            req_post_mock.assert_not_called()
+            self.assertEqual(transport_mock.publish.call_args.args[1].error_code, 502)
+            self.assertEqual(breaker.stats()['calls'], 1)
+            req_get_mock.side_effect = None
+            req_get_mock.return_value = Mock(status_code=200, json=lambda: probe_result([{'id': '18', 'size': 10}]))
+            req_post_mock.return_value = Mock(status_code=500)
+            Worker.download(VideoTask('download', 'b', 'youtube'))
+            req_post_mock.assert_called_once()
+            self.assertEqual(breaker.stats()['calls'], 2)
+            self.assertEqual(breaker.stats()['failure_rate'], 1.0)
+
+    @patch('src.worker.worker.transport')
+    def test_worker_parking(self, transport_mock: MagicMock):
+        """
+        Тестирование откладывания задач разомкнутого автомата у брокера без занятия потоков: задача
+        подтверждается только после приёма отложенной копии, при ошибке публикации и по сроку получает отказ
+
+        :param transport_mock: Mock для имитации транспорта сообщений
+        """
+        breaker = CircuitBreaker('youtube', min_calls=1, open_timeout=30)
+        breaker.record(True)
+        worker = Worker.__new__(Worker)
+        worker.pool, worker.transport = MagicMock(), transport_mock
+        worker._inflight, worker._inflight_lock = 0, Lock()
+        deferred = [Future(), Future()]
+        transport_mock.defer.side_effect = deferred
+        acks = [Mock() for _ in range(3)]
+        tasks = [VideoTask('download', 'a', 'youtube'), VideoTask('download', 'b', 'youtube'),
+                 VideoTask('download', 'c', 'youtube', deadline=time.time() - 1)]
+        with patch.dict('src.worker.worker.breakers', youtube=breaker):
+            for task, ack in zip(tasks, acks):
+                worker.process_task(task, ack)
+        worker.pool.submit.assert_not_called()
+        self.assertEqual([call.args for call in transport_mock.defer.call_args_list],
+                         [('task_queue', tasks[0], 30, 'youtube'), ('task_queue', tasks[1], 30, 'youtube')])
+        acks[2].assert_called_once_with()
+        self.assertFalse(acks[0].called or acks[1].called)
+        deferred[0].set_result(True)
+        deferred[1].set_exception(RuntimeError('nack'))
+        acks[0].assert_called_once_with()
+        acks[1].assert_called_once_with()
+        self.assertEqual([(call.args[1].video_id, call.args[1].error_code)
+                          for call in transport_mock.publish.call_args_list], [('c', 504), ('b', 503)])
+
+
+class TransportContract:
+    """
+    Общие тесты транспорта сообщений, выполняются для каждого транспорта
+    """
+
+    def create_transport(self, queues: tuple) -> Transport:
+        raise NotImplementedError
+
+    def setUp(self):
+        suffix = uuid.uuid4().hex[:8]
+        self.tasks, self.answers = f'task_queue_{suffix}', f'answer_queue_{suffix}'
+        self.transport = self.create_transport((self.tasks, self.answers))
+        self.transport.start()
+
+    def tearDown(self):
+        self.transport.stop(5)
+
+    @staticmethod
+    def _wait(condition: Callable[[], bool], timeout: float = 5) -> bool:
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_round_trip(self):
+        """
+        Тестирование доставки сообщений по порядку без изменений
+        """
+        received = []
+        self.transport.consume(self.tasks, lambda message, ack: received.append(message))
+        messages = [VideoTask('download', 'dQw4w9WgXcQ', 'youtube', chat_id=1, message_id=2),
+                    PlaylistTask('PL1', 'youtube', True)]
+        self.assertTrue(all(self.transport.publish(self.tasks, message).result(5) for message in messages))
+        self.assertTrue(self._wait(lambda: len(received) == 2))
+        self.assertEqual(received, messages)
+
+    def test_depth(self):
+        """
+        Тестирование числа сообщений, ожидающих получения
+        """
+        self.assertEqual(self.transport.depth(self.tasks), 0)
+        for video_id in ('a', 'b'):
+            self.transport.publish(self.tasks, VideoTask('download', video_id, 'youtube')).result(5)
+        self.assertTrue(self._wait(lambda: self.transport.depth(self.tasks) == 2))
+        received = []
+        self.transport.consume(self.tasks, lambda message, ack: received.append(message))
+        self.assertTrue(self._wait(lambda: len(received) == 2))
+        self.assertEqual(self.transport.depth(self.tasks), 0)
+        self.assertTrue(self._wait(lambda: self.transport.stats(self.tasks).consumers == 1))
+
+    def test_defer(self):
+        """
+        Тестирование доставки отложенного сообщения в очередь после задержки
+        """
+        received = []
+        self.transport.consume(self.tasks, lambda message, ack: received.append(message))
+        self.assertTrue(self.transport.defer(self.tasks, VideoTask('download', 'a', 'youtube'), 0.5, 'youtube')
+                        .result(5))
+        time.sleep(0.1)
+        self.assertEqual(received, [])
+        self.assertTrue(self._wait(lambda: received))
+        self.assertEqual([message.video_id for message in received], ['a'])
+
+    def test_queues_isolated(self):
+        """
+        Тестирование доставки только сообщений своей очереди
+        """
+        received = []
+        self.transport.consume(self.tasks, lambda message, ack: received.append(message))
+        self.transport.publish(self.answers, VideoAnswer('download', 'a', 'youtube'))
+        self.transport.publish(self.tasks, VideoTask('download', 'b', 'youtube'))
+        self.assertTrue(self._wait(lambda: received))
+        time.sleep(0.2)
+        self.assertEqual([message.video_id for message in received], ['b'])
+
+    def test_prefetch(self):
+        """
+        Тестирование ограничения неподтверждённых сообщений и подтверждения из другого потока
+        """
+        received = []
+        self.transport.consume(self.tasks, lambda message, ack: received.append((message, ack)), prefetch=2)
+        for i in range(5):
+            self.transport.publish(self.tasks, VideoTask('download', str(i), 'youtube'))
+        self.assertTrue(self._wait(lambda: len(received) == 2))
+        time.sleep(0.3)
+        self.assertEqual(len(received), 2)
+        Thread(target=received[0][1]).start()
+        self.assertTrue(self._wait(lambda: len(received) == 3))
+        for i in range(5):
+            self.assertTrue(self._wait(lambda: len(received) > i))
+            received[i][1]()
+        self.assertEqual([message.video_id for message, _ in received], ['0', '1', '2', '3', '4'])
+
+    def test_handler_failure(self):
+        """
+        Тестирование подтверждения сообщения, обработчик которого упал
+        """
+        received = []
+
+        def handler(message, ack):
+            received.append(message)
+            if message.video_id == 'bad':
+                raise RuntimeError('handler failed')
+            ack()
+
+        self.transport.consume(self.tasks, handler, prefetch=1)
+        self.transport.publish(self.tasks, VideoTask('download', 'bad', 'youtube'))
+        self.transport.publish(self.tasks, VideoTask('download', 'good', 'youtube'))
+        self.assertTrue(self._wait(lambda: len(received) == 2))
+
+    def test_stop_waits_for_ack(self):
+        """
+        Тестирование остановки после подтверждения выданных сообщений
+        """
+        acked = Event()
+
+        def handler(message, ack):
+            def _ack():
+                time.sleep(0.3)
+                acked.set()
+                ack()
+
+            Thread(target=_ack).start()
+
+        self.transport.consume(self.tasks, handler, prefetch=1)
+        self.transport.publish(self.tasks, VideoTask('download', 'a', 'youtube'))
+        self.assertTrue(self._wait(lambda: self._delivered()))
+        self.transport.stop(5)
+        self.assertTrue(acked.is_set())
+
+    def _delivered(self) -> bool:
+        raise NotImplementedError
+
+
+class InProcessTransportTestCase(TransportContract, TestCase):
+    """
+    Класс для тестирования транспорта через очереди в памяти процесса
+    """
+
+    def create_transport(self, queues: tuple) -> Transport:
+        return InProcessTransport(poll_interval=0.01)
+
+    def _delivered(self) -> bool:
+        return any(inflight.count for _, _, inflight in self.transport._subscriptions)
+
+    def test_shared_instance(self):
+        """
+        Тестирование общего транспорта процесса и передачи сообщений без кодирования
+        """
+        self.assertIs(create_transport('memory://'), create_transport('memory://'))
+        self.assertIsInstance(create_transport('amqp://broker:5672'), RabbitMQTransport)
+        received = []
+        self.transport.consume(self.tasks, lambda message, ack: received.append(message))
+        task = VideoTask('download', 'a', 'youtube')
+        self.transport.publish(self.tasks, task)
+        self.assertTrue(self._wait(lambda: received))
+        self.assertIs(received[0], task)
+
+
+@skipUnless(os.getenv('TEST_RMQ_URL'), 'TEST_RMQ_URL is not set')
+class RabbitMQTransportTestCase(TransportContract, TestCase):
+    """
+    Класс для тестирования транспорта через RabbitMQ. Нужен брокер по адресу TEST_RMQ_URL,
+    например amqp://localhost:5672
+    """
+
+    def create_transport(self, queues: tuple) -> Transport:
+        return create_transport(os.getenv('TEST_RMQ_URL'), queues)
+
+    def _delivered(self) -> bool:
+        return any(consumer._unacked for consumer in self.transport._consumers)
+
+
+class LoaderTestCase(TestCase):
+    """
+    Класс для тестирования ответов Loader на уже загруженные видео
+    """
+
+    def setUp(self):
+        async def _db(coro):
+            return await coro
+
+        self.loader = Loader.__new__(Loader)
+        self.loader.app = flask.Flask(__name__)
+        self.loader.readiness = Readiness()
+        self.loader.transport = MagicMock()
+        self.loader.reply_queue = 'answer_queue.loader-1'
+        self.loader._db = _db
+        self.loader._record_request = Mock()
+        self.loader.admission = Admission(self.loader.transport, 'task_queue', 2,
+                                          {'user': Limit(3), 'prefetch': Limit(1)})
+        self.loader.configure_router()
+
+    def test_download_cache_hit(self):
+        """
+        Тестирование ответа file_id без постановки задачи и проверки видео
+        """
+        with patch('src.downloader.load.AsyncDB.get_video', AsyncMock(return_value=Mock(file_id='F1'))), \
+                patch.object(Loader, 'probe', AsyncMock()) as probe_mock:
+            response = self.loader.app.test_client().post('/api/download/start', json={
+                'chat_id': 1, 'message_id': 2, 'url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(),
+                         {'file_id': 'F1', 'video_url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'})
+        probe_mock.assert_not_called()
+        self.loader.transport.publish.assert_not_called()
+        self.loader._record_request.assert_called_once_with('dQw4w9WgXcQ')
+
+    @patch('src.downloader.load.req.post')
+    @patch('src.downloader.load.DB')
+    def test_playlist_cache_hit(self, db_mock: MagicMock, post_mock: MagicMock):
+        """
+        Тестирование отправки подписчикам уже загруженных видео плейлиста без задач `return`
+
+        :param db_mock: Mock для имитации базы данных
+        :param post_mock: Mock для имитации отправки post запросов
+        """
+        db_mock.get_videos.return_value = [Mock(id='a', file_id='F1'), Mock(id='b', file_id=None)]
+        db_mock.add_playlist_videos.return_value = ['a', 'b']
+        db_mock.get_subscribed_users.return_value = [10, 11]
+        self.loader.process_answer(PlaylistAnswer('PL1', 'youtube', True, ['a', 'b', 'c']), Mock())
+        self.loader.transport.publish.assert_called_once()
+        task = self.loader.transport.publish.call_args.args[1]
+        self.assertGreater(task.deadline, time.time())
+        self.assertEqual(task, VideoTask('download', 'b', 'youtube', playlist_id='PL1',
+                                         reply_to='answer_queue.loader-1', deadline=task.deadline))
+        self.assertEqual([(call.kwargs['json']['chat_id'], call.kwargs['json']['file_id'], call.kwargs['json']['type'])
+                          for call in post_mock.call_args_list], [(10, 'F1', 'return'), (11, 'F1', 'return')])
+
+    @patch('src.worker.worker.transport')
+    def test_reply_routing(self, transport_mock: MagicMock):
+        """
+        Тестирование публикации задачи с очередью ответов экземпляра и ответа Worker в эту очередь
+
+        :param transport_mock: Mock для имитации транспорта Worker
+        """
+        self.loader.transport.publish.return_value = Future()
+        self.loader.transport.publish.return_value.set_result(True)
+        self.assertTrue(asyncio.run(self.loader._publish(VideoTask('return', 'a', 'youtube'))))
+        queue_name, task = self.loader.transport.publish.call_args.args
+        self.assertEqual((queue_name, task.reply_to), ('task_queue', 'answer_queue.loader-1'))
+        Worker._return(decode(encode(task)))
+        queue_name, answer = transport_mock.publish.call_args.args
+        self.assertEqual((queue_name, answer.reply_to), ('answer_queue.loader-1', 'answer_queue.loader-1'))
+        Worker._return(VideoTask('return', 'a', 'youtube'))
+        self.assertEqual(transport_mock.publish.call_args.args[0], 'answer_queue')
+
+    @patch('src.downloader.load.req.post')
+    @patch('src.downloader.load.DB')
+    def test_prefetch(self, db_mock: MagicMock, post_mock: MagicMock):
+        """
+        Тестирование предварительной загрузки только при пустой очереди задач и без уведомления пользователей
+
+        :param db_mock: Mock для имитации базы данных
+        :param post_mock: Mock для имитации отправки post запросов
+        """
+        db_mock.claim_prefetch_videos.return_value = [('a', 'youtube'), ('b', 'vk')]
+        self.assertEqual(self.loader.prefetch(), 0)
+        self.loader.transport.stats.return_value = QueueStats(3, 1)
+        self.loader.admission.sample()
+        self.assertEqual(self.loader.prefetch(), 0)
+        db_mock.claim_prefetch_videos.assert_not_called()
+        self.loader.transport.stats.return_value = QueueStats(0, 1)
+        self.loader.admission.sample()
+        self.assertEqual(self.loader.prefetch(), 2)
+        self.assertEqual(self.loader.prefetch(), 0)
+        self.assertEqual([(call.args[0], call.args[1].video_id, call.args[1].hosting, call.args[1].reply_to)
+                          for call in self.loader.transport.publish.call_args_list],
+                         [('task_queue', 'a', 'youtube', 'answer_queue.loader-1'),
+                          ('task_queue', 'b', 'vk', 'answer_queue.loader-1')])
+        self.assertTrue(all(call.args[1].deadline > time.time()
+                            for call in self.loader.transport.publish.call_args_list))
+        self.loader.process_answer(VideoAnswer('download', 'a', 'youtube', file_id='F1'), Mock())
+        db_mock.upsert_video_file_id.assert_called_once_with('a', 'F1')
+        post_mock.assert_not_called()
+
+    @patch('src.downloader.load.requests.post')
+    @patch('src.downloader.load.DB')
+    def test_update_all_playlists(self, db_mock: MagicMock, post_mock: MagicMock):
+        """
+        Тестирование снятия с обновления плейлиста, запрос на обновление которого не удался, без остановки обхода
+
+        :param db_mock: Mock для имитации базы данных
+        :param post_mock: Mock для имитации отправки post запросов
+        """
+        db_mock.claim_due_playlists.return_value = [Mock(id='a', host='youtube'), Mock(id='b', host='vk')]
+        post_mock.side_effect = [requests.Timeout('timeout'), Mock()]
+        update_all_playlists(Mock(**{'hold.return_value': True}))
+        self.assertEqual([call.kwargs['json']['playlist_id'] for call in post_mock.call_args_list], ['a', 'b'])
+        self.assertTrue(all(call.kwargs['timeout'] for call in post_mock.call_args_list))
+        db_mock.update_playlist_status.assert_called_once_with('a', False)
+
+    def test_download_admission(self):
+        """
+        Тестирование позиции и времени ожидания в ответе и отклонения задачи при переполненной очереди
+        """
+        client = self.loader.app.test_client()
+        self.loader.transport.publish.return_value = Future()
+        self.loader.transport.publish.return_value.set_result(True)
+        self.loader.transport.stats.return_value = QueueStats(1, 1)
+        self.loader.admission.sample()
+        self.loader.admission.observe(30)
+        with patch('src.downloader.load.AsyncDB.get_video', AsyncMock(return_value=None)), \
+                patch.object(Loader, 'probe', AsyncMock(return_value=None)):
+            payload = {'chat_id': 1, 'message_id': 2, 'url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'}
+            response = client.post('/api/download/start', json=payload)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.get_json(), {'position': 2, 'eta': 30})
+            response = client.post('/api/download/start', json=payload)
+            self.assertEqual(response.get_json(), {'position': 3, 'eta': 60})
+            response = client.post('/api/download/start', json=payload)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '15')
+        self.assertEqual(self.loader.transport.publish.call_count, 2)